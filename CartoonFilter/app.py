@@ -7,9 +7,19 @@
 import matplotlib.pyplot as plt
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 from cartoon_filter import CartoonFilter
+from render_process import RenderProcess
+import queue
 import threading
-import time
 from preset_loader import PresetLoader, create_preset_from_filter
+from batch_processor import BatchProcessor, scan_images
+from auto_tune import auto_tune
+from runtime import configure_runtime, split_threads
+
+# Milliseconds between checks for events from batch and auto-tune threads
+WORKER_POLL_MS = 100
+
+# Milliseconds between checks for finished previews
+PREVIEW_POLL_MS = 30
 
 class CartoonApp:
     def __init__(self, root):
@@ -26,8 +36,12 @@ def __init__(self, root):
         self.current_image = None
         self.original_image = None
         self.cartoon_result = None
-        self.processing_thread = None
-        self.is_processing = False
+        self.polling_preview = False
+        
+        # Previews are rendered in a separate process
+        self.renderer = RenderProcess()
+        self.renderer.start()
+        self.root.protocol("WM_DELETE_WINDOW", self.on_close)
         
         # Create main frame
         self.main_frame = ttk.Frame(self.root)
@@ -94,10 +108,18 @@ def create_control_panel(self):
         ttk.Label(edge_frame, text="Method:").pack(anchor=tk.W)
         self.edge_method_var = tk.StringVar(value=self.cartoon_filter.edge_detection_method)
         edge_methods = ttk.Combobox(edge_frame, textvariable=self.edge_method_var, 
-                                   values=["canny", "sobel", "laplacian"])
+                                   values=["canny", "sobel", "sobel_fast", "laplacian"])
         edge_methods.pack(fill=tk.X, pady=2)
         edge_methods.bind("<<ComboboxSelected>>", self.update_preview)
         
+        # Gradient normalization (Sobel methods)
+        ttk.Label(edge_frame, text="Normalization:").pack(anchor=tk.W)
+        self.edge_normalization_var = tk.StringVar(value=self.cartoon_filter.edge_normalization)
+        edge_normalizations = ttk.Combobox(edge_frame, textvariable=self.edge_normalization_var,
+                                           values=["minmax", "fixed"])
+        edge_normalizations.pack(fill=tk.X, pady=2)
+        edge_normalizations.bind("<<ComboboxSelected>>", self.update_preview)
+        
         # Canny threshold 1
         ttk.Label(edge_frame, text="Threshold 1:").pack(anchor=tk.W)
         self.threshold1_var = tk.IntVar(value=self.cartoon_filter.canny_threshold1)
@@ -125,6 +147,23 @@ def create_control_panel(self):
         )
         edge_blur_scale.pack(fill=tk.X, pady=2)
         
+        # Pyramid levels for edge detection
+        ttk.Label(edge_frame, text="Edge Start Level:").pack(anchor=tk.W)
+        self.edge_level_var = tk.IntVar(value=self.cartoon_filter.edge_level)
+        edge_level_scale = ttk.Scale(
+            edge_frame, from_=0, to=3, variable=self.edge_level_var,
+            command=lambda _: self.update_preview()
+        )
+        edge_level_scale.pack(fill=tk.X, pady=2)
+        
+        ttk.Label(edge_frame, text="Edge Scales:").pack(anchor=tk.W)
+        self.edge_levels_var = tk.IntVar(value=self.cartoon_filter.edge_levels)
+        edge_levels_scale = ttk.Scale(
+            edge_frame, from_=1, to=4, variable=self.edge_levels_var,
+            command=lambda _: self.update_preview()
+        )
+        edge_levels_scale.pack(fill=tk.X, pady=2)
+        
         # Line size
         ttk.Label(edge_frame, text="Line Size:").pack(anchor=tk.W)
         self.line_size_var = tk.IntVar(value=self.cartoon_filter.line_size)
@@ -134,6 +173,14 @@ def create_control_panel(self):
         )
         line_size_scale.pack(fill=tk.X, pady=2)
         
+        # Line shape
+        ttk.Label(edge_frame, text="Line Shape:").pack(anchor=tk.W)
+        self.line_shape_var = tk.StringVar(value=self.cartoon_filter.line_shape)
+        line_shapes = ttk.Combobox(edge_frame, textvariable=self.line_shape_var,
+                                   values=["square", "round"])
+        line_shapes.pack(fill=tk.X, pady=2)
+        line_shapes.bind("<<ComboboxSelected>>", self.update_preview)
+        
         # Bilateral filter parameters
         bilateral_frame = ttk.LabelFrame(self.scrollable_frame, text="Bilateral Filter", padding=(10, 5))
         bilateral_frame.pack(fill=tk.X, pady=5)
@@ -174,6 +221,15 @@ def create_control_panel(self):
         )
         bilateral_sigma_space_scale.pack(fill=tk.X, pady=2)
         
+        # Pyramid level for smoothing
+        ttk.Label(bilateral_frame, text="Smoothing Level:").pack(anchor=tk.W)
+        self.smoothing_level_var = tk.IntVar(value=self.cartoon_filter.smoothing_level)
+        smoothing_level_scale = ttk.Scale(
+            bilateral_frame, from_=0, to=3, variable=self.smoothing_level_var,
+            command=lambda _: self.update_preview()
+        )
+        smoothing_level_scale.pack(fill=tk.X, pady=2)
+        
         # Color quantization parameters
         color_frame = ttk.LabelFrame(self.scrollable_frame, text="Color Quantization", padding=(10, 5))
         color_frame.pack(fill=tk.X, pady=5)
@@ -183,7 +239,7 @@ def create_control_panel(self):
         self.quant_method_var = tk.StringVar(value=self.cartoon_filter.quantization_method)
         quant_methods = ttk.Combobox(
             color_frame, textvariable=self.quant_method_var, 
-            values=["kmeans", "uniform"]
+            values=["kmeans", "kmeans_fast", "kmeans_lab", "median_cut", "octree", "uniform"]
         )
         quant_methods.pack(fill=tk.X, pady=2)
         quant_methods.bind("<<ComboboxSelected>>", self.update_preview)
@@ -227,6 +283,11 @@ def create_control_panel(self):
                                      command=lambda: self.apply_preset(None))
         load_preset_btn.pack(side=tk.LEFT, padx=2)
         
+        # Auto tune button
+        auto_tune_btn = ttk.Button(preset_btn_frame, text="Auto Tune",
+                                   command=self.auto_tune_preset)
+        auto_tune_btn.pack(side=tk.LEFT, padx=2)
+        
         # Save preset button
         save_preset_btn = ttk.Button(preset_btn_frame, text="Save Current", 
                                      command=self.save_current_preset)
@@ -316,6 +377,10 @@ def load_image(self):
                 self.original_image = img.copy()
                 self.current_image = img.copy()
                 
+                # The previous preview lives in memory that is freed now
+                self.cartoon_result = None
+                self.renderer.set_image(self.original_image)
+                
                 self.progress_var.set(80)
                 self.root.update_idletasks()
                 
@@ -325,9 +390,6 @@ def load_image(self):
                 self.progress_var.set(100)
                 self.status_var.set(f"Loaded: {os.path.basename(file_path)}")
                 
-                # Clear any previous cartoon result
-                self.cartoon_result = None
-                
                 # Apply initial effect with current parameters
                 self.apply_effect()
                 
@@ -339,60 +401,73 @@ def load_image(self):
     def update_parameters(self):
         # Update the cartoon filter with the current UI values
         self.cartoon_filter.edge_detection_method = self.edge_method_var.get()
+        self.cartoon_filter.edge_normalization = self.edge_normalization_var.get()
         self.cartoon_filter.canny_threshold1 = self.threshold1_var.get()
         self.cartoon_filter.canny_threshold2 = self.threshold2_var.get()
-        self.cartoon_filter.edge_blur = self.edge_blur_var.get()
+        # Gaussian blur needs an odd kernel size (0 disables it)
+        edge_blur = self.edge_blur_var.get()
+        self.cartoon_filter.edge_blur = edge_blur if edge_blur == 0 or edge_blur % 2 else edge_blur + 1
+        self.cartoon_filter.edge_level = self.edge_level_var.get()
+        self.cartoon_filter.edge_levels = self.edge_levels_var.get()
         self.cartoon_filter.line_size = self.line_size_var.get()
+        self.cartoon_filter.line_shape = self.line_shape_var.get()
         
         self.cartoon_filter.edge_preserve = self.edge_preserve_var.get()
         self.cartoon_filter.bilateral_d = self.bilateral_d_var.get()
         self.cartoon_filter.bilateral_sigma_color = self.bilateral_sigma_color_var.get()
         self.cartoon_filter.bilateral_sigma_space = self.bilateral_sigma_space_var.get()
+        self.cartoon_filter.smoothing_level = self.smoothing_level_var.get()
         
         self.cartoon_filter.quantization_method = self.quant_method_var.get()
         self.cartoon_filter.num_colors = self.num_colors_var.get()
         self.cartoon_filter.saturation_factor = self.saturation_var.get()
         
     def update_preview(self, event=None):
-        if self.is_processing or self.original_image is None:
-            return
-            
-        # If a thread is already running, we don't want to start another
-        if self.processing_thread and self.processing_thread.is_alive():
+        if self.original_image is None:
             return
             
-        # Update parameters and start processing thread
+        # Update parameters and hand them to the render process
         self.update_parameters()
-        self.processing_thread = threading.Thread(target=self.process_image)
-        self.processing_thread.daemon = True
-        self.processing_thread.start()
+        self.request_preview()
         
-    def process_image(self):
-        self.is_processing = True
+    def request_preview(self):
+        """Send the current parameters to the render process and wait for the preview"""
         self.status_var.set("Processing image...")
         self.progress_var.set(20)
-        
+        self.renderer.render(self.cartoon_filter.get_params())
+        if not self.polling_preview:
+            self.polling_preview = True
+            self.root.after(PREVIEW_POLL_MS, self.poll_preview)
+    
+    def poll_preview(self):
+        """Show finished previews; runs on the Tk main loop until no render is left"""
         try:
-            if self.original_image is not None:
-                # Apply the cartoon effect
-                self.cartoon_result = self.cartoon_filter.apply_cartoon_effect(self.original_image)
-                self.progress_var.set(80)
-                
-                # Update the display
-                self.update_displays(
-                    original=self.original_image, 
-                    cartoon=self.cartoon_result['cartoon']
-                )
-                
-                # Update the steps display
-                self.update_steps_display()
-                
-                self.progress_var.set(100)
-                self.status_var.set("Processing complete")
+            result = self.renderer.poll()
         except Exception as e:
+            result = None
             self.status_var.set(f"Error: {str(e)}")
-        finally:
-            self.is_processing = False
+            self.progress_var.set(0)
+        
+        if result is not None:
+            self.cartoon_result = result
+            
+            # Update the display
+            self.update_displays(
+                original=self.original_image, 
+                cartoon=self.cartoon_result['cartoon']
+            )
+            
+            # Update the steps display
+            self.update_steps_display()
+            
+            if not self.renderer.busy:
+                self.progress_var.set(100)
+                self.status_var.set("Processing complete")
+        
+        if self.renderer.busy:
+            self.root.after(PREVIEW_POLL_MS, self.poll_preview)
+        else:
+            self.polling_preview = False
     
     def update_displays(self, original=None, cartoon=None):
         if original is not None:
@@ -463,14 +538,8 @@ def apply_effect(self):
         # Update parameters
         self.update_parameters()
         
-        # Start processing
-        self.status_var.set("Applying cartoon effect...")
-        self.progress_var.set(0)
-        
-        # Process in a thread to prevent UI freezing
-        self.processing_thread = threading.Thread(target=self.process_image)
-        self.processing_thread.daemon = True
-        self.processing_thread.start()
+        # Render in the background process to keep the UI responsive
+        self.request_preview()
     
     def save_cartoon(self):
         if self.cartoon_result is None or 'cartoon' not in self.cartoon_result:
@@ -513,11 +582,8 @@ def batch_process(self):
         # Update parameters
         self.update_parameters()
         
-        # Get list of image files
-        image_extensions = ('.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff')
-        image_files = [f for f in os.listdir(input_dir) 
-                       if os.path.isfile(os.path.join(input_dir, f)) 
-                       and f.lower().endswith(image_extensions)]
+        # Get list of image files, including subfolders
+        image_files = scan_images(input_dir, recursive=True)
         
         if not image_files:
             messagebox.showinfo("Info", "No image files found in the selected folder")
@@ -532,45 +598,58 @@ def batch_process(self):
         if not confirm:
             return
             
-        # Process images in a thread
+        # Process images in a thread; its events are queued and shown by the Tk main loop
+        batch_events = queue.Queue()
+        self.root.after(WORKER_POLL_MS, self.poll_batch_events, batch_events)
         threading.Thread(
             target=self.batch_process_thread, 
-            args=(input_dir, output_dir, image_files)
+            args=(input_dir, output_dir, image_files, batch_events)
         ).start()
     
-    def batch_process_thread(self, input_dir, output_dir, image_files):
-        total_files = len(image_files)
-        processed = 0
-        
-        for filename in image_files:
+    def batch_process_thread(self, input_dir, output_dir, image_files, batch_events):
+        try:
+            workers = os.cpu_count() or 1
+            # Size OpenCV's shared pool so the workers do not oversubscribe the cores
+            configure_runtime(split_threads(workers))
+            processor = BatchProcessor(self.cartoon_filter, workers=workers)
+            processor.run(input_dir, output_dir, image_files, event_sink=batch_events.put)
+        except Exception as e:
+            # Always end the event stream, so the polling stops and the user sees why
+            batch_events.put({'type': 'error', 'error': str(e)})
+    
+    def poll_batch_events(self, batch_events):
+        """Show queued batch events; reschedules itself until the batch ends"""
+        while True:
             try:
-                self.status_var.set(f"Processing {processed+1}/{total_files}: {filename}")
-                self.progress_var.set((processed / total_files) * 100)
-                
-                # Load image
-                input_path = os.path.join(input_dir, filename)
-                img = cv2.imread(input_path)
-                
-                if img is None:
-                    continue
-                    
-                # Apply cartoon effect
-                result = self.cartoon_filter.apply_cartoon_effect(img)
-                
-                # Save result
-                output_name = os.path.splitext(filename)[0] + "_cartoon.png"
-                output_path = os.path.join(output_dir, output_name)
-                cv2.imwrite(output_path, result['cartoon'])
-                
-                processed += 1
-                time.sleep(0.1)  # Small delay to update UI
-                
-            except Exception as e:
-                print(f"Error processing {filename}: {str(e)}")
-                
-        self.status_var.set(f"Batch processing complete. Processed {processed}/{total_files} images")
-        self.progress_var.set(100)
-        messagebox.showinfo("Batch Complete", f"Processed {processed}/{total_files} images")
+                event = batch_events.get_nowait()
+            except queue.Empty:
+                break
+            
+            if event['type'] == 'files':
+                self.status_var.set(f"Processed {event['files'][-1]['input']}")
+            elif event['type'] == 'progress' and event['total']:
+                self.progress_var.set(100 * event['completed'] / event['total'])
+                self.status_var.set(
+                    f"Processing {event['completed']}/{event['total']} "
+                    f"({event['throughput']:.1f} images/s, "
+                    f"{100 * event['utilization']:.0f}% busy)"
+                )
+            elif 'error' in event:
+                # An 'error' event, or the 'end' event of an aborted run
+                self.status_var.set(f"Batch processing failed: {event['error']}")
+                self.progress_var.set(0)
+                messagebox.showerror("Batch Failed", event['error'])
+                return
+            elif event['type'] == 'end':
+                message = (f"Processed {event['processed']}/{event['total']} images "
+                           f"({event['skipped']} up to date, {event['failed']} failed) "
+                           f"at {event['throughput']:.1f} images/s")
+                self.status_var.set(f"Batch processing complete. {message}")
+                self.progress_var.set(100)
+                messagebox.showinfo("Batch Complete", message)
+                return
+        
+        self.root.after(WORKER_POLL_MS, self.poll_batch_events, batch_events)
     
     def reset_parameters(self):
         # Reset the cartoon filter
@@ -578,15 +657,20 @@ def reset_parameters(self):
         
         # Reset UI elements
         self.edge_method_var.set(self.cartoon_filter.edge_detection_method)
+        self.edge_normalization_var.set(self.cartoon_filter.edge_normalization)
         self.threshold1_var.set(self.cartoon_filter.canny_threshold1)
         self.threshold2_var.set(self.cartoon_filter.canny_threshold2)
         self.edge_blur_var.set(self.cartoon_filter.edge_blur)
+        self.edge_level_var.set(self.cartoon_filter.edge_level)
+        self.edge_levels_var.set(self.cartoon_filter.edge_levels)
         self.line_size_var.set(self.cartoon_filter.line_size)
+        self.line_shape_var.set(self.cartoon_filter.line_shape)
         
         self.edge_preserve_var.set(self.cartoon_filter.edge_preserve)
         self.bilateral_d_var.set(self.cartoon_filter.bilateral_d)
         self.bilateral_sigma_color_var.set(self.cartoon_filter.bilateral_sigma_color)
         self.bilateral_sigma_space_var.set(self.cartoon_filter.bilateral_sigma_space)
+        self.smoothing_level_var.set(self.cartoon_filter.smoothing_level)
         
         self.quant_method_var.set(self.cartoon_filter.quantization_method)
         self.num_colors_var.set(self.cartoon_filter.num_colors)
@@ -596,6 +680,11 @@ def reset_parameters(self):
         if self.original_image is not None:
             self.update_preview()
     
+    def on_close(self):
+        """Stop the render process and close the window"""
+        self.renderer.close()
+        self.root.destroy()
+    
     def on_window_resize(self, event=None):
         # Update image display when window is resized
         if self.original_image is not None and self.cartoon_result is not None:
@@ -612,15 +701,20 @@ def apply_preset(self, event=None):
             if success:
                 # Update UI values to match the preset
                 self.edge_method_var.set(self.cartoon_filter.edge_detection_method)
+                self.edge_normalization_var.set(self.cartoon_filter.edge_normalization)
                 self.threshold1_var.set(self.cartoon_filter.canny_threshold1)
                 self.threshold2_var.set(self.cartoon_filter.canny_threshold2)
                 self.edge_blur_var.set(self.cartoon_filter.edge_blur)
+                self.edge_level_var.set(self.cartoon_filter.edge_level)
+                self.edge_levels_var.set(self.cartoon_filter.edge_levels)
                 self.line_size_var.set(self.cartoon_filter.line_size)
+                self.line_shape_var.set(self.cartoon_filter.line_shape)
                 
                 self.edge_preserve_var.set(self.cartoon_filter.edge_preserve)
                 self.bilateral_d_var.set(self.cartoon_filter.bilateral_d)
                 self.bilateral_sigma_color_var.set(self.cartoon_filter.bilateral_sigma_color)
                 self.bilateral_sigma_space_var.set(self.cartoon_filter.bilateral_sigma_space)
+                self.smoothing_level_var.set(self.cartoon_filter.smoothing_level)
                 
                 self.quant_method_var.set(self.cartoon_filter.quantization_method)
                 self.num_colors_var.set(self.cartoon_filter.num_colors)
@@ -653,6 +747,55 @@ def save_current_preset(self):
             else:
                 messagebox.showerror("Error", f"Could not save preset: {preset_name}")
 
+    def auto_tune_preset(self):
+        """Search parameters for the loaded image and save them as a preset"""
+        from tkinter import simpledialog
+        
+        if self.original_image is None:
+            messagebox.showinfo("Info", "Please load an image first")
+            return
+        
+        preset_name = simpledialog.askstring("Auto Tune", "Enter a name for the tuned preset:")
+        if not preset_name:
+            return
+        
+        self.update_parameters()
+        self.status_var.set("Auto tuning parameters...")
+        
+        # The tuning thread only queues its outcome; the Tk main loop shows it
+        tune_events = queue.Queue()
+        
+        def tune():
+            try:
+                auto_tune(self.original_image, self.preset_loader, preset_name,
+                          base_filter=self.cartoon_filter)
+            except Exception as e:
+                tune_events.put({'type': 'error', 'error': str(e)})
+                return
+            tune_events.put({'type': 'end', 'preset': preset_name})
+        
+        threading.Thread(target=tune, daemon=True).start()
+        self.root.after(WORKER_POLL_MS, self.poll_auto_tune, tune_events)
+    
+    def poll_auto_tune(self, tune_events):
+        """Wait for the auto-tune thread's outcome; reschedules itself until it arrives"""
+        try:
+            event = tune_events.get_nowait()
+        except queue.Empty:
+            self.root.after(WORKER_POLL_MS, self.poll_auto_tune, tune_events)
+            return
+        
+        if event['type'] == 'error':
+            self.status_var.set(f"Auto tune failed: {event['error']}")
+        else:
+            self.on_auto_tune_done(event['preset'])
+    
+    def on_auto_tune_done(self, preset_name):
+        """Select and apply a freshly tuned preset"""
+        self.preset_combo["values"] = self.preset_loader.get_preset_names()
+        self.preset_var.set(preset_name)
+        self.apply_preset()
+
 # Main application entry point
 if __name__ == "__main__":
     root = tk.Tk()
@@ -0,0 +1,158 @@
+import itertools
+import os
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import numpy as np
+from cartoon_filter import CartoonFilter
+from preset_loader import create_preset_from_filter
+
+# Candidate values searched by default
+EDGE_SEARCH_SPACE = {
+    "canny_threshold1": [50, 80, 110, 140],
+    "canny_threshold2": [150, 200, 250],
+    "edge_blur": [3, 5, 7],
+}
+COLOR_SEARCH_SPACE = {
+    "bilateral_sigma_color": [50, 75, 100, 150],
+    "num_colors": [4, 6, 8, 12, 16],
+}
+
+
+def make_proxy(img, max_side=192):
+    """
+    Downsample an image so its longest side is at most max_side
+
+    Args:
+        img (numpy.ndarray): Source image
+        max_side (int): Longest side of the proxy in pixels
+
+    Returns:
+        numpy.ndarray: Proxy image (the input itself if already small enough)
+    """
+    height, width = img.shape[:2]
+    scale = max_side / float(max(height, width))
+    if scale >= 1.0:
+        return img
+    size = (max(1, int(width * scale)), max(1, int(height * scale)))
+    return cv2.resize(img, size, interpolation=cv2.INTER_AREA)
+
+
+def expand_grid(search_space):
+    """
+    Expand a search space into a list of parameter dicts
+
+    Args:
+        search_space (dict): Mapping of parameter name to candidate values
+
+    Returns:
+        list: One dict per combination of values
+    """
+    keys = sorted(search_space)
+    return [dict(zip(keys, values))
+            for values in itertools.product(*(search_space[k] for k in keys))]
+
+
+def edge_density(edges):
+    """Fraction of pixels marked as edges"""
+    return float(np.count_nonzero(edges)) / edges.size
+
+
+def palette_error(filtered, quantized):
+    """Mean absolute color error introduced by quantization, in 0-1"""
+    return float(cv2.absdiff(filtered, quantized).mean()) / 255.0
+
+
+class AutoTuner:
+    """
+    Search filter parameters on a small proxy image.
+
+    Edge parameters only affect the outlines and color parameters only affect
+    the fill, so the two are searched independently: edge candidates are
+    scored by how close their edge density is to `target_edge_density`, and
+    color candidates by palette error plus a small cost per color. Each
+    bilateral setting is computed once and shared by every palette size.
+    Candidates are evaluated on a thread pool; they are FilterParams passed
+    explicitly to a single shared filter.
+    """
+
+    def __init__(self, base_filter=None, proxy_size=192, target_edge_density=0.04,
+                 color_penalty=0.002, max_workers=None):
+        self.base_filter = base_filter or CartoonFilter()
+        self.base_params = self.base_filter.get_params()
+        self.proxy_size = proxy_size
+        self.target_edge_density = target_edge_density
+        self.color_penalty = color_penalty
+        self.max_workers = max_workers or os.cpu_count() or 1
+
+    def score_edges(self, proxy, params):
+        """Score an edge candidate, lower is better"""
+        # Canny requires the low threshold to be below the high one
+        if params.get("canny_threshold1", 0) >= params.get("canny_threshold2", 255):
+            return float("inf")
+        edges = self.base_filter.detect_raw_edges(proxy, self.base_params.replace(**params))
+        return abs(edge_density(edges) - self.target_edge_density)
+
+    def score_colors(self, filtered, params):
+        """Score a color candidate on an already smoothed proxy, lower is better"""
+        candidate = self.base_params.replace(**params)
+        quantized = self.base_filter.quantize_colors(filtered, candidate)
+        return palette_error(filtered, quantized) + self.color_penalty * params["num_colors"]
+
+    def smooth(self, proxy, sigma_color):
+        """Bilateral-filter the proxy for one sigma setting"""
+        params = {"bilateral_sigma_color": sigma_color, "bilateral_sigma_space": sigma_color}
+        return self.base_filter.apply_bilateral_filter(proxy, self.base_params.replace(**params))
+
+    def tune(self, img, edge_space=None, color_space=None):
+        """
+        Find the best parameters for an image
+
+        Args:
+            img (numpy.ndarray): Image to tune for (BGR)
+            edge_space (dict): Edge search space, EDGE_SEARCH_SPACE if None
+            color_space (dict): Color search space, COLOR_SEARCH_SPACE if None
+
+        Returns:
+            tuple: (preset dict, scores dict with 'edges' and 'colors')
+        """
+        proxy = make_proxy(img, self.proxy_size)
+        edge_candidates = expand_grid(edge_space or EDGE_SEARCH_SPACE)
+        color_candidates = expand_grid(color_space or COLOR_SEARCH_SPACE)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            edge_scores = list(pool.map(lambda p: self.score_edges(proxy, p), edge_candidates))
+
+            sigmas = sorted({p["bilateral_sigma_color"] for p in color_candidates})
+            smoothed = dict(zip(sigmas, pool.map(lambda s: self.smooth(proxy, s), sigmas)))
+            color_scores = list(pool.map(
+                lambda p: self.score_colors(smoothed[p["bilateral_sigma_color"]], p),
+                color_candidates
+            ))
+
+        best_edges = edge_candidates[int(np.argmin(edge_scores))]
+        best_colors = dict(color_candidates[int(np.argmin(color_scores))])
+        best_colors["bilateral_sigma_space"] = best_colors["bilateral_sigma_color"]
+
+        tuned = self.base_params.replace(**dict(best_edges, **best_colors))
+        scores = {"edges": min(edge_scores), "colors": min(color_scores)}
+        return create_preset_from_filter(tuned), scores
+
+
+def auto_tune(img, preset_loader=None, preset_name=None, base_filter=None, **kwargs):
+    """
+    Tune parameters for an image and optionally save them as a preset
+
+    Args:
+        img (numpy.ndarray): Image to tune for (BGR)
+        preset_loader (PresetLoader): Loader used to save the result
+        preset_name (str): Name of the preset to save, not saved if None
+        base_filter (CartoonFilter): Filter providing the untuned settings
+        **kwargs: Extra AutoTuner options
+
+    Returns:
+        dict: Tuned preset configuration
+    """
+    preset, _ = AutoTuner(base_filter, **kwargs).tune(img)
+    if preset_loader is not None and preset_name:
+        preset_loader.save_preset(preset_name, preset)
+    return preset
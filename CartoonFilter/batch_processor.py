@@ -0,0 +1,554 @@
+import os
+import json
+import time
+import hashlib
+import queue
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+import cv2
+import numpy as np
+from image_writer import ImageWriter
+from runtime import pin_thread, restore_affinity
+from memory_budget import RenderScheduler
+from dedup import DedupIndex, adapt_output, aspect_ratio, color_signature, dhash, informative
+from events import BatchEvents, DEFAULT_EVENT_INTERVAL
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff')
+MANIFEST_NAME = ".cartoon_manifest.jsonl"
+
+
+def scan_images(input_dir, recursive=True):
+    """
+    List image files below a folder using os.scandir
+
+    Hidden entries (such as the batch manifest) are skipped. File types come
+    from the directory entries, so no per-file stat call is needed.
+
+    Args:
+        input_dir (str): Folder to scan
+        recursive (bool): Descend into subfolders
+
+    Returns:
+        list: Sorted image paths relative to input_dir
+    """
+    found = []
+    stack = [""]
+    while stack:
+        rel_dir = stack.pop()
+        try:
+            with os.scandir(os.path.join(input_dir, rel_dir)) as it:
+                for entry in it:
+                    if entry.name.startswith('.'):
+                        continue
+                    rel_path = os.path.join(rel_dir, entry.name) if rel_dir else entry.name
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            if recursive:
+                                stack.append(rel_path)
+                        elif entry.is_file() and entry.name.lower().endswith(IMAGE_EXTENSIONS):
+                            found.append(rel_path)
+                    except OSError:
+                        continue
+        except OSError:
+            continue
+    return sorted(found)
+
+
+def decode_image(path):
+    """
+    Read and decode an image file
+
+    The file is read into memory first and decoded with cv2.imdecode, which
+    also works for non-ASCII paths on every platform.
+
+    Returns:
+        numpy.ndarray: Decoded BGR image
+    """
+    data = np.fromfile(path, dtype=np.uint8)
+    img = cv2.imdecode(data, cv2.IMREAD_COLOR)
+    if img is None:
+        raise ValueError("Could not load the image")
+    return img
+
+
+class PrefetchingDecoder:
+    """
+    Read and decode files ahead of the compute stage.
+
+    Files are decoded on a small thread pool while at most `max_prefetch`
+    decoded images are held in memory. Iterating yields (item, image, error)
+    tuples in input order, so slow storage overlaps with rendering instead
+    of stalling it.
+    """
+
+    def __init__(self, items, path_getter, max_workers=4, max_prefetch=8):
+        self.items = items
+        self.path_getter = path_getter
+        self.max_workers = max_workers
+        self.max_prefetch = max(1, max_prefetch)
+
+    def __iter__(self):
+        window = deque()
+        items = iter(self.items)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            for item in items:
+                window.append((item, pool.submit(decode_image, self.path_getter(item))))
+                if len(window) >= self.max_prefetch:
+                    yield self._result(*window.popleft())
+            while window:
+                yield self._result(*window.popleft())
+
+    def _result(self, item, future):
+        try:
+            return item, future.result(), None
+        except Exception as e:
+            return item, None, e
+
+
+def compute_params_hash(params, extra=None):
+    """
+    Compute a stable hash of the filter parameters
+
+    Args:
+        params (FilterParams): Parameters to hash
+        extra (dict): Additional settings that affect the output, such as encoding
+
+    Returns:
+        str: Hex digest identifying the parameter set
+    """
+    values = params.as_dict()
+    if extra:
+        values.update(extra)
+    encoded = json.dumps(values, sort_keys=True).encode("utf-8")
+    return hashlib.sha1(encoded).hexdigest()
+
+
+class BatchManifest:
+    """
+    Journaled record of batch results.
+
+    Every processed file appends one JSON line that is flushed to disk
+    immediately, so a crash loses at most the entry being written. When the
+    journal is loaded the last entry for each input wins.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        """Replay the journal into memory"""
+        self.entries = {}
+        if not os.path.exists(self.path):
+            return
+
+        with open(self.path, 'r') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # A torn final line from an interrupted run
+                    continue
+                if 'input' in entry:
+                    self.entries[entry['input']] = entry
+
+    def get(self, rel_path):
+        """Get the latest entry for an input file"""
+        return self.entries.get(rel_path)
+
+    def needs_processing(self, rel_path, mtime, size, params_hash, output_path=None):
+        """
+        Check whether an input has to be (re)processed
+
+        Args:
+            rel_path (str): Input path relative to the input folder
+            mtime (float): Modification time of the input
+            size (int): Size of the input in bytes
+            params_hash (str): Hash of the current filter parameters
+            output_path (str): Expected output path, checked against the entry if given
+
+        Returns:
+            bool: True if the file is new, changed, failed or its output is missing
+        """
+        entry = self.entries.get(rel_path)
+        if entry is None or entry.get('status') != 'done':
+            return True
+        if entry.get('mtime') != mtime or entry.get('size') != size:
+            return True
+        if entry.get('params_hash') != params_hash:
+            return True
+        if output_path is not None and entry.get('output') != output_path:
+            return True
+        return not os.path.exists(entry.get('output', ''))
+
+    def record(self, rel_path, **fields):
+        """Append an entry to the journal and sync it to disk"""
+        entry = {'input': rel_path}
+        entry.update(fields)
+
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+
+        with self.lock:
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(entry, sort_keys=True) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            self.entries[rel_path] = entry
+        return entry
+
+    def compact(self):
+        """Rewrite the journal keeping only the latest entry per input"""
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+
+        tmp_path = self.path + ".tmp"
+        with self.lock:
+            with open(tmp_path, 'w') as f:
+                for rel_path in sorted(self.entries):
+                    f.write(json.dumps(self.entries[rel_path], sort_keys=True) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+
+
+class BatchProcessor:
+    """
+    Headless batch engine that applies a CartoonFilter to a folder of images.
+
+    In incremental mode a manifest in the output folder records the input
+    mtime and size, the parameter hash, the output path and the status of
+    every file, so re-runs only process new, changed or failed inputs.
+
+    Inputs are decoded by a PrefetchingDecoder and handed to the compute
+    workers through a bounded queue. Results are encoded and written by an
+    ImageWriter on its own thread pool, so compute threads never wait on
+    compression or disk.
+
+    The filter parameters are snapshotted as FilterParams when the processor
+    is created, so later changes to the filter (for example from the GUI)
+    do not affect a running batch.
+
+    If cpu_sets is given (see runtime.core_slices), compute worker i is
+    pinned to cpu_sets[i] while the batch runs. This only keeps the renders
+    on those CPUs when OpenCV runs with one thread (see runtime.pin_thread). With a memory_budget in
+    bytes, renders go through a RenderScheduler that delays or tiles them
+    so their estimated peak memory stays within the budget; with
+    approximate_tiles it may tile settings whose tiles differ slightly from
+    a full render.
+
+    With dedup_distance set, the perceptual hash of every input is looked up
+    among the inputs already rendered with the same settings; an input whose
+    hash is at most that many bits away reuses their output, resized if
+    needed, instead of being rendered again.
+    """
+
+    def __init__(self, cartoon_filter, output_suffix="_cartoon", writer=None,
+                 workers=1, io_workers=4, prefetch=8, cpu_sets=None, memory_budget=None,
+                 dedup_distance=None, approximate_tiles=False):
+        self.cartoon_filter = cartoon_filter
+        self.params = cartoon_filter.get_params()
+        self.output_suffix = output_suffix
+        self.writer = writer or ImageWriter()
+        self.workers = max(1, workers)
+        self.io_workers = max(1, io_workers)
+        self.prefetch = max(1, prefetch)
+        self.cpu_sets = cpu_sets
+        self.scheduler = (RenderScheduler(cartoon_filter, memory_budget,
+                                          approximate_tiles=approximate_tiles)
+                          if memory_budget else None)
+        self.dedup_distance = dedup_distance
+
+    def list_images(self, input_dir, recursive=False):
+        """List image files in the input folder"""
+        return scan_images(input_dir, recursive=recursive)
+
+    def get_output_path(self, output_dir, rel_path):
+        """Get the output path for an input file"""
+        output_name = os.path.splitext(rel_path)[0] + self.output_suffix + self.writer.extension
+        return os.path.join(output_dir, output_name)
+
+    def get_params_hash(self):
+        """Hash of every setting that affects the written output"""
+        return compute_params_hash(self.params, {
+            'output_format': self.writer.output_format,
+            'quality': self.writer.quality,
+            'png_compression': self.writer.png_compression,
+            'indexed': self.writer.indexed,
+        })
+
+    def render(self, img):
+        """Cartoonize a decoded image, within the memory budget if one is set"""
+        if self.scheduler is not None:
+            return self.scheduler.render(img, self.params)
+        return self.cartoon_filter.apply_cartoon_effect(img, self.params)
+
+    def render_and_write(self, img, output_path):
+        """
+        Cartoonize a decoded image and write the result synchronously
+
+        Args:
+            img (numpy.ndarray): Decoded BGR image
+            output_path (str): Path where the cartoon is written
+
+        Returns:
+            bool: True if the output was written
+        """
+        result = self.render(img)
+        self.writer.write(result['cartoon'], output_path)
+        return True
+
+    def process_file(self, input_path, output_path):
+        """
+        Process a single image file
+
+        Args:
+            input_path (str): Path of the image to cartoonize
+            output_path (str): Path where the cartoon is written
+
+        Returns:
+            bool: True if the output was written
+        """
+        return self.render_and_write(decode_image(input_path), output_path)
+
+    def check_entry(self, manifest, input_dir, output_dir, rel_path, params_hash,
+                    incremental=True):
+        """
+        Stat an input file and decide whether it has to be processed
+
+        Returns:
+            tuple: ('pending', stat), ('skipped', stat) or ('failed', None)
+        """
+        try:
+            stat = os.stat(os.path.join(input_dir, rel_path))
+        except OSError as e:
+            manifest.record(rel_path, status='failed', error=str(e), params_hash=params_hash,
+                            output=self.get_output_path(output_dir, rel_path))
+            return 'failed', None
+
+        output_path = self.get_output_path(output_dir, rel_path)
+        if incremental and not manifest.needs_processing(
+                rel_path, stat.st_mtime, stat.st_size, params_hash, output_path):
+            return 'skipped', stat
+        return 'pending', stat
+
+    def create_dedup_index(self, manifest, params_hash, input_dir=None):
+        """Index the rendered inputs of a manifest, or None when dedup is off"""
+        if self.dedup_distance is None:
+            return None
+        return DedupIndex.from_manifest(manifest, params_hash, self.dedup_distance,
+                                        input_dir=input_dir)
+
+    def finish_entry(self, manifest, output_dir, rel_path, stat, params_hash, img=None,
+                     input_dir=None, error=None, dedup_index=None):
+        """
+        Render one input and queue it on the writer
+
+        Either a decoded image or the input folder to load it from must be
+        given. The manifest entry is recorded once the file has been written.
+        With a dedup_index, near-duplicates of rendered inputs reuse their
+        output, and new renders are added to the index.
+
+        Returns:
+            concurrent.futures.Future: Resolves to 'processed' or 'failed'
+        """
+        output_path = self.get_output_path(output_dir, rel_path)
+        outcome = Future()
+        start = time.time()
+        dedup_fields = {}
+
+        def record_failure(e):
+            manifest.record(rel_path, status='failed', error=str(e), mtime=stat.st_mtime,
+                            size=stat.st_size, params_hash=params_hash, output=output_path)
+            outcome.set_result('failed')
+
+        def on_written(write_future):
+            error = write_future.exception()
+            if error is not None:
+                record_failure(error)
+                return
+            manifest.record(rel_path, status='done', mtime=stat.st_mtime,
+                            size=stat.st_size, params_hash=params_hash,
+                            output=output_path, seconds=round(time.time() - start, 4),
+                            **dedup_fields)
+            outcome.set_result('processed')
+
+        try:
+            if error is not None:
+                raise error
+            if img is None:
+                img = decode_image(os.path.join(input_dir, rel_path))
+            cartoon = None
+            if dedup_index is not None:
+                phash = dhash(img)
+                dedup_fields['phash'] = format(phash, '016x')
+                dedup_fields['csig'] = color_signature(img)
+                dedup_fields['aspect'] = aspect_ratio(img.shape)
+                match = dedup_index.find(phash, dedup_fields['csig'], dedup_fields['aspect'],
+                                         exclude=rel_path)
+                # A match from this run may still be on its way to disk
+                pending = match.get('written') if match is not None else None
+                if pending is not None and pending.exception() is not None:
+                    match = None
+                if match is not None and os.path.exists(match['output']):
+                    cartoon = adapt_output(decode_image(match['output']), img.shape)
+                    dedup_fields['duplicate_of'] = match['input']
+            rendered = cartoon is None
+            if rendered:
+                cartoon = self.render(img)['cartoon']
+            written = self.writer.submit(cartoon, output_path)
+            # Only real renders are indexed, so reused outputs are never resized
+            # twice; flat images are never matched, so they are not indexed
+            if dedup_index is not None and rendered and informative(phash):
+                dedup_index.add(phash, {'input': rel_path, 'output': output_path,
+                                        'csig': dedup_fields['csig'],
+                                        'aspect': dedup_fields['aspect'],
+                                        'written': written})
+            written.add_done_callback(on_written)
+        except Exception as e:
+            record_failure(e)
+        return outcome
+
+    def process_entry(self, manifest, input_dir, output_dir, rel_path, params_hash,
+                      incremental=True, dedup_index=None):
+        """
+        Process one input file and record the outcome in the manifest
+
+        Returns:
+            str: 'processed', 'skipped' or 'failed'
+        """
+        outcome, stat = self.check_entry(manifest, input_dir, output_dir, rel_path,
+                                         params_hash, incremental)
+        if outcome != 'pending':
+            return outcome
+        return self.finish_entry(manifest, output_dir, rel_path, stat, params_hash,
+                                 input_dir=input_dir, dedup_index=dedup_index).result()
+
+    def run(self, input_dir, output_dir, image_files=None, incremental=True,
+            progress_callback=None, stop_event=None, recursive=False,
+            manifest_name=MANIFEST_NAME, event_sink=None, event_interval=DEFAULT_EVENT_INTERVAL):
+        """
+        Process a folder of images
+
+        Args:
+            input_dir (str): Folder containing the input images
+            output_dir (str): Folder where cartoons and the manifest are written
+            image_files (list): Input files relative to input_dir, all images if None
+            incremental (bool): Skip files the manifest marks as up to date
+            progress_callback (callable): Called as (index, total, filename)
+            stop_event (threading.Event): Set to stop after the files in flight
+            recursive (bool): Include images in subfolders when listing the input
+            manifest_name (str): Manifest file in the output folder; runs over
+                disjoint file sets in parallel must each use their own
+            event_sink (callable): Called with structured events (see
+                events.BatchEvents) from a separate thread, e.g. a JsonLinesSink
+            event_interval (float): Seconds between progress events
+
+        Returns:
+            dict: Counts of processed, skipped and failed files
+        """
+        if image_files is None:
+            image_files = self.list_images(input_dir, recursive=recursive)
+
+        manifest = BatchManifest(os.path.join(output_dir, manifest_name))
+        params_hash = self.get_params_hash()
+        dedup_index = self.create_dedup_index(manifest, params_hash, input_dir)
+        summary = {'total': len(image_files), 'processed': 0, 'skipped': 0, 'failed': 0}
+        lock = threading.Lock()
+        completed = [0]
+        work_queue = queue.Queue(maxsize=self.prefetch)
+
+        events = None
+        if event_sink is not None:
+            events = BatchEvents(event_sink, len(image_files), self.workers, event_interval,
+                                 gauges=lambda: {'queue_depth': work_queue.qsize(),
+                                                 'writer_pending': self.writer.pending})
+            events.start()
+
+        try:
+            def report(rel_path, outcome, seconds=None):
+                with lock:
+                    summary[outcome] += 1
+                    index = completed[0]
+                    completed[0] += 1
+                if events is not None:
+                    events.file_done(rel_path, outcome, seconds)
+                if progress_callback:
+                    progress_callback(index, summary['total'], rel_path)
+
+            # Stat every file first so unchanged inputs are never read
+            pending = []
+            for rel_path in image_files:
+                outcome, stat = self.check_entry(manifest, input_dir, output_dir, rel_path,
+                                                 params_hash, incremental)
+                if outcome == 'pending':
+                    pending.append((rel_path, stat))
+                else:
+                    report(rel_path, outcome)
+
+            def produce():
+                decoder = PrefetchingDecoder(pending, lambda item: os.path.join(input_dir, item[0]),
+                                             max_workers=self.io_workers,
+                                             max_prefetch=self.prefetch)
+                try:
+                    for item in decoder:
+                        if stop_event is not None and stop_event.is_set():
+                            break
+                        work_queue.put(item)
+                finally:
+                    for _ in range(self.workers):
+                        work_queue.put(None)
+
+            def consume(index=0):
+                previous = pin_thread(self.cpu_sets[index % len(self.cpu_sets)]) if self.cpu_sets else None
+                try:
+                    while True:
+                        item = work_queue.get()
+                        if item is None:
+                            break
+                        (rel_path, stat), img, error = item
+                        if stop_event is not None and stop_event.is_set():
+                            continue
+                        start = time.perf_counter()
+                        if events is not None:
+                            events.render_started(index)
+                        outcome = self.finish_entry(manifest, output_dir, rel_path, stat,
+                                                    params_hash, img=img, error=error,
+                                                    dedup_index=dedup_index)
+                        if events is not None:
+                            events.render_finished(index)
+                        outcome.add_done_callback(
+                            lambda future, rel_path=rel_path, start=start: report(
+                                rel_path, future.result(), time.perf_counter() - start))
+                finally:
+                    restore_affinity(previous)
+
+            producer = threading.Thread(target=produce, daemon=True)
+            producer.start()
+            consumers = [threading.Thread(target=consume, args=(index,), daemon=True)
+                         for index in range(1, self.workers)]
+            for consumer in consumers:
+                consumer.start()
+            consume()
+            for consumer in consumers:
+                consumer.join()
+            producer.join()
+            self.writer.shutdown()
+
+            manifest.compact()
+        except Exception as e:
+            if events is not None:
+                events.close(error=str(e))
+            raise
+        if events is not None:
+            events.close()
+        return summary
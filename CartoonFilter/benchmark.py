@@ -0,0 +1,344 @@
+#!/usr/bin/env python3
+"""
+End-to-end throughput regression harness
+
+Generates a synthetic image corpus and processes it through the batch
+engine, the command line tool and the job queue workers at several
+concurrency levels. Every run happens in its own child process, so its
+peak memory can be measured, and reports images per second, per-image
+latency percentiles and peak RSS. Results are compared with a baseline
+file; run with --update to store the current results as the baseline.
+
+    python benchmark.py --count 48 --size 1280x960 --concurrency 1,2,4
+    python benchmark.py --update
+"""
+import os
+import sys
+import glob
+import json
+import math
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+import cv2
+import numpy as np
+from batch_processor import BatchProcessor
+from cartoon_filter import CartoonFilter
+from preset_loader import PresetLoader, atomic_write_json
+from runtime import configure_runtime, split_threads
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+BASELINE_FILE = os.path.join(BASE_DIR, "benchmark_baseline.json")
+PATHS = ("batch", "cli", "queue")
+# Relative change of a metric that counts as a regression
+DEFAULT_TOLERANCE = 0.10
+
+
+def generate_corpus(folder, count, size=(640, 480), seed=0):
+    """
+    Write a deterministic set of synthetic photos
+
+    Images are smooth random color fields with a few shapes, so every
+    stage of the filter has edges and gradients to work on. An existing
+    corpus with the same settings is reused.
+
+    Args:
+        folder (str): Output folder
+        count (int): Number of images
+        size (tuple): Image (width, height)
+        seed (int): Random seed
+
+    Returns:
+        list: Image file names
+    """
+    spec = {'count': count, 'size': list(size), 'seed': seed}
+    spec_path = os.path.join(folder, ".corpus.json")
+    names = [f"bench_{index:05d}.jpg" for index in range(count)]
+    try:
+        with open(spec_path, 'r') as f:
+            if json.load(f) == spec and all(os.path.exists(os.path.join(folder, name))
+                                            for name in names):
+                return names
+    except (OSError, ValueError):
+        pass
+
+    os.makedirs(folder, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    width, height = size
+    for name in names:
+        field = rng.integers(0, 256, (max(2, height // 32), max(2, width // 32), 3), dtype=np.uint8)
+        img = cv2.resize(field, (width, height), interpolation=cv2.INTER_CUBIC)
+        for _ in range(6):
+            color = tuple(int(c) for c in rng.integers(0, 256, 3))
+            center = (int(rng.integers(0, width)), int(rng.integers(0, height)))
+            if rng.random() < 0.5:
+                cv2.circle(img, center, int(rng.integers(height // 16, height // 4)), color, -1)
+            else:
+                corner = (center[0] + int(rng.integers(width // 16, width // 3)),
+                          center[1] + int(rng.integers(height // 16, height // 3)))
+                cv2.rectangle(img, center, corner, color, -1)
+        cv2.imwrite(os.path.join(folder, name), img, [cv2.IMWRITE_JPEG_QUALITY, 90])
+
+    atomic_write_json(spec_path, spec)
+    return names
+
+
+def manifest_latencies(output_dir):
+    """
+    Per-image latencies recorded in the manifests of an output folder
+
+    The batch engine records the time from the start of each render until
+    its output is written.
+
+    Returns:
+        tuple: (list of seconds of finished images, number of failed images)
+    """
+    latest = {}
+    for path in glob.glob(os.path.join(output_dir, ".cartoon_manifest*.jsonl")):
+        with open(path, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                latest[entry.get('input')] = entry
+    seconds = [entry['seconds'] for entry in latest.values()
+               if entry.get('status') == 'done' and 'seconds' in entry]
+    failed = sum(1 for entry in latest.values() if entry.get('status') == 'failed')
+    return seconds, failed
+
+
+def run_measured(commands):
+    """
+    Run commands as concurrent child processes and measure them
+
+    Returns:
+        dict: Wall 'seconds' until all exited, largest 'peak_rss' in bytes
+            of any child, and the last output line of the first command
+    """
+    start = time.perf_counter()
+    outputs, processes = [], []
+    try:
+        for command in commands:
+            output = tempfile.TemporaryFile('w+')
+            outputs.append(output)
+            processes.append(subprocess.Popen(command, cwd=BASE_DIR, stdout=output,
+                                              stderr=subprocess.STDOUT, text=True))
+
+        peak_rss = 0
+        for process in processes:
+            # wait4 gives the resource usage of this child alone
+            _, status, usage = os.wait4(process.pid, 0)
+            process.returncode = os.waitstatus_to_exitcode(status)
+            peak_rss = max(peak_rss, usage.ru_maxrss * 1024)
+        seconds = time.perf_counter() - start
+
+        for process, output, command in zip(processes, outputs, commands):
+            if process.returncode != 0:
+                output.seek(0)
+                raise RuntimeError(f"{' '.join(command)} exited with {process.returncode}:\n"
+                                   f"{output.read()[-2000:]}")
+        outputs[0].seek(0)
+        lines = outputs[0].read().strip().splitlines()
+        return {'seconds': seconds, 'peak_rss': peak_rss, 'last_line': lines[-1] if lines else ""}
+    finally:
+        for output in outputs:
+            output.close()
+
+
+def run_scenario(path, concurrency, corpus_dir, count, preset=None):
+    """
+    Process the corpus once through one path
+
+    Args:
+        path (str): "batch" (engine in a child process, timed inside it),
+            "cli" (cli.py, including interpreter start-up) or "queue"
+            (job_queue.py submit followed by `concurrency` worker processes)
+        concurrency (int): Compute workers, or worker processes for the queue
+        corpus_dir (str): Corpus folder
+        count (int): Number of images in the corpus
+        preset (str): Preset to apply
+
+    Returns:
+        dict: Throughput, latency percentiles in milliseconds and peak RSS
+    """
+    python = sys.executable
+    preset_args = ["-p", preset] if preset else []
+    output_dir = tempfile.mkdtemp(prefix=f"cartoon_bench_{path}_")
+    try:
+        if path == "batch":
+            measured = run_measured([[python, "benchmark.py", "--run-batch", corpus_dir, output_dir,
+                                      "--concurrency", str(concurrency)] + preset_args])
+            # Time the batch run only, without interpreter start-up and imports
+            measured['seconds'] = float(measured['last_line'])
+        elif path == "cli":
+            measured = run_measured([[python, "cli.py", "-i", corpus_dir, "-o", output_dir,
+                                      "--workers", str(concurrency), "--full"] + preset_args])
+        elif path == "queue":
+            queue_path = os.path.join(output_dir, ".jobs.db")
+            unit_size = max(1, math.ceil(count / (2 * concurrency)))
+            start = time.perf_counter()
+            submit = run_measured([[python, "job_queue.py", "submit", "-i", corpus_dir,
+                                    "-o", output_dir, "--queue", queue_path,
+                                    "--unit-size", str(unit_size)] + preset_args])
+            work = run_measured([[python, "job_queue.py", "work", "--queue", queue_path,
+                                  "--workers", "1", "--worker-id", f"bench-{index}"]
+                                 for index in range(concurrency)])
+            measured = {'seconds': time.perf_counter() - start,
+                        'peak_rss': max(submit['peak_rss'], work['peak_rss'])}
+        else:
+            raise ValueError(f"Unknown path '{path}'")
+
+        latencies, failed = manifest_latencies(output_dir)
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+    if latencies:
+        p50, p95, p99 = (1000.0 * value for value in np.percentile(latencies, [50, 95, 99]))
+    else:
+        p50 = p95 = p99 = float('nan')
+    return {
+        'path': path,
+        'concurrency': concurrency,
+        'images': len(latencies),
+        'failed': failed,
+        'seconds': round(measured['seconds'], 3),
+        'ips': round(len(latencies) / measured['seconds'], 3),
+        'p50_ms': round(p50, 1),
+        'p95_ms': round(p95, 1),
+        'p99_ms': round(p99, 1),
+        'peak_rss_mb': round(measured['peak_rss'] / (1024 * 1024), 1),
+    }
+
+
+def compare(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """
+    Compare results with a baseline
+
+    Throughput may not drop, and p95 latency and peak RSS may not grow, by
+    more than the tolerance.
+
+    Returns:
+        list: Descriptions of the regressions
+    """
+    previous = {(entry['path'], entry['concurrency']): entry
+                for entry in baseline.get('results', [])}
+    regressions = []
+    for result in results:
+        base = previous.get((result['path'], result['concurrency']))
+        if base is None:
+            continue
+        name = f"{result['path']} x{result['concurrency']}"
+        if result['ips'] < base['ips'] * (1 - tolerance):
+            regressions.append(f"{name}: {result['ips']:.2f} images/s, baseline {base['ips']:.2f}")
+        for metric in ('p95_ms', 'peak_rss_mb'):
+            if result[metric] > base[metric] * (1 + tolerance):
+                regressions.append(f"{name}: {metric} {result[metric]}, baseline {base[metric]}")
+    return regressions
+
+
+def run_batch_child(input_dir, output_dir, concurrency, preset):
+    """Run the batch engine and print its wall time (child process of run_scenario)"""
+    cartoon_filter = CartoonFilter()
+    if preset and not PresetLoader().apply_preset(cartoon_filter, preset):
+        print(f"Error: unknown preset '{preset}'")
+        return 1
+    configure_runtime(split_threads(concurrency))
+    processor = BatchProcessor(cartoon_filter, workers=concurrency)
+    start = time.perf_counter()
+    summary = processor.run(input_dir, output_dir, incremental=False)
+    seconds = time.perf_counter() - start
+    print(seconds)
+    return 1 if summary['failed'] else 0
+
+
+def main(argv=None):
+    """Command line entry point"""
+    parser = argparse.ArgumentParser(description="Measure end-to-end throughput and compare it with a baseline")
+    parser.add_argument("--count", type=int, default=24, help="Images in the synthetic corpus")
+    parser.add_argument("--size", default="640x480", help="Corpus image size as WIDTHxHEIGHT")
+    parser.add_argument("--concurrency", default="1,2,4",
+                        help="Comma-separated compute workers (worker processes for the queue)")
+    parser.add_argument("--paths", default=",".join(PATHS),
+                        help=f"Comma-separated paths to measure ({', '.join(PATHS)})")
+    parser.add_argument("-p", "--preset", default=None, help="Name of the preset to apply")
+    parser.add_argument("--corpus", default=None,
+                        help="Corpus folder (default: a reused folder in the temp directory)")
+    parser.add_argument("--baseline", default=BASELINE_FILE, help="Baseline results file")
+    parser.add_argument("--update", action="store_true",
+                        help="Store the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                        help="Relative change that counts as a regression")
+    parser.add_argument("--run-batch", nargs=2, metavar=("INPUT", "OUTPUT"),
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    try:
+        concurrency_levels = [int(value) for value in args.concurrency.split(",")]
+        width, height = (int(value) for value in args.size.lower().split("x"))
+    except ValueError as e:
+        print(f"Error: {e}")
+        return 1
+
+    if args.run_batch:
+        return run_batch_child(args.run_batch[0], args.run_batch[1], concurrency_levels[0],
+                               args.preset)
+
+    paths = [path.strip() for path in args.paths.split(",")]
+    unknown = sorted(set(paths) - set(PATHS))
+    if unknown:
+        print(f"Error: unknown paths {', '.join(unknown)}")
+        return 1
+
+    corpus = {'count': args.count, 'size': [width, height], 'preset': args.preset}
+    corpus_dir = args.corpus or os.path.join(tempfile.gettempdir(),
+                                             f"cartoon_bench_corpus_{args.count}_{width}x{height}")
+    generate_corpus(corpus_dir, args.count, (width, height))
+
+    results = []
+    print(f"{'path':<6} {'workers':>7} {'images/s':>9} {'p50 ms':>8} {'p95 ms':>8} "
+          f"{'p99 ms':>8} {'RSS MB':>8}")
+    for path in paths:
+        for concurrency in concurrency_levels:
+            try:
+                result = run_scenario(path, concurrency, corpus_dir, args.count, args.preset)
+            except RuntimeError as e:
+                print(f"Error: {e}")
+                return 1
+            results.append(result)
+            print(f"{path:<6} {concurrency:>7} {result['ips']:>9.2f} {result['p50_ms']:>8.1f} "
+                  f"{result['p95_ms']:>8.1f} {result['p99_ms']:>8.1f} {result['peak_rss_mb']:>8.1f}"
+                  + (f"  ({result['failed']} failed)" if result['failed'] else ""))
+
+    if args.update:
+        atomic_write_json(args.baseline, {
+            'opencv': cv2.__version__,
+            'cpus': os.cpu_count(),
+            'corpus': corpus,
+            'results': results,
+        })
+        print(f"Stored baseline in {args.baseline}")
+        return 0
+
+    try:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+    except (OSError, ValueError):
+        print(f"No baseline in {args.baseline}; run with --update to store one")
+        return 0
+
+    if baseline.get('corpus') != corpus or baseline.get('cpus') != os.cpu_count():
+        print("Warning: the baseline was measured with a different corpus or CPU count")
+    regressions = compare(results, baseline, args.tolerance)
+    for regression in regressions:
+        print(f"REGRESSION: {regression}")
+    if regressions:
+        return 1
+    print("No regressions against the baseline")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,21 +1,54 @@
+import time
 import cv2
 import numpy as np
 from skimage import filters
 from PIL import Image, ImageTk
+from filter_params import FilterParams
+from pyramid import ImagePyramid, upsample
+from quantizers import (ASSIGN_CHUNK_PIXELS, FIT_MAX_PIXELS, KMEANS_SAMPLE_PIXELS,
+                        assign_palette, assign_working_bytes, fit_kmeans_palette,
+                        kmeans_working_bytes, quantize_histogram, streaming_kmeans)
+
+# OpenCV thread count used for reproducible output
+DETERMINISTIC_THREADS = 1
+
+def sobel_max_response(ksize):
+    """
+    Largest absolute response of a first-order Sobel kernel on 8-bit input
+    """
+    kx, ky = cv2.getDerivKernels(1, 0, ksize)
+    return 255.0 * float(kx[kx > 0].sum()) * float(ky.sum())
+
+def use_deterministic_threads(num_threads=DETERMINISTIC_THREADS):
+    """
+    Pin OpenCV to a fixed thread count
+
+    Together with a fixed seed this makes the output identical from run to
+    run and from machine to machine, whatever the number of cores.
+    """
+    cv2.setNumThreads(num_threads)
 
 class CartoonFilter:
     """
     A class that provides various methods to transform images into cartoon-like renditions.
+
+    The attributes below hold the settings used when a stage is called
+    without explicit FilterParams. Stages never modify the filter, so a
+    single instance is safe to share between threads as long as each call
+    passes its own parameters.
     """
     
     def __init__(self):
         """Initialize with default parameters"""
         # Edge detection parameters
-        self.edge_detection_method = "canny"  # Options: canny, sobel, laplacian
+        self.edge_detection_method = "canny"  # Options: canny, sobel, sobel_fast, laplacian
         self.canny_threshold1 = 100
         self.canny_threshold2 = 200
         self.sobel_kernel_size = 3
+        self.edge_normalization = "minmax"  # Options: minmax, fixed
         self.edge_blur = 5
+        self.edge_level = 0  # Pyramid level of the finest edges (0 = full resolution)
+        self.edge_levels = 1  # Number of pyramid levels whose edges are merged
         
         # Bilateral filter parameters
         self.bilateral_d = 9
@@ -23,137 +56,344 @@ def __init__(self):
         self.bilateral_sigma_space = 75
         
         # Color quantization parameters
-        self.quantization_method = "kmeans"  # Options: kmeans, uniform
+        self.quantization_method = "kmeans"  # Options: kmeans, kmeans_fast, kmeans_lab, median_cut, octree, uniform
         self.num_colors = 8
+        self.seed = None  # Fixed k-means seed for reproducible output, random if None
         
         # Extra parameters
         self.line_size = 7
+        self.line_shape = "square"  # Options: square, round
         self.blur_strength = 7
+        self.smoothing_level = 0  # Pyramid level the smoothing runs at
         self.edge_preserve = True
         self.saturation_factor = 1.5
         
-    def detect_edges(self, img):
+    def get_params(self):
+        """
+        Snapshot the current attributes as validated FilterParams
+
+        Raises:
+            ValueError: If an attribute holds an invalid value
+        """
+        return FilterParams.from_filter(self)
+
+    def set_params(self, params):
+        """Copy FilterParams onto the filter attributes"""
+        for name, value in params.as_dict().items():
+            setattr(self, name, value)
+
+    def resolve_params(self, params):
+        """Use the given parameters, or snapshot the attributes if None"""
+        return params if params is not None else self.get_params()
+
+    def detect_edges(self, img, params=None, pyramid=None):
         """
         Detect edges in the image using selected method
         """
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        
+        params = self.resolve_params(params)
+        return self.thicken_edges(self.detect_raw_edges(img, params, pyramid), params)
+
+    def detect_raw_edges(self, img, params=None, pyramid=None):
+        """
+        Detect one-pixel edges before line thickening
+
+        With edge_level > 0 or edge_levels > 1, edges are detected on
+        `edge_levels` consecutive levels of the image pyramid starting at
+        `edge_level`, scaled back up and merged. Edges from coarse levels
+        come out bold and only follow large structures, and a level costs a
+        quarter of the one above it.
+
+        Args:
+            img (numpy.ndarray): Input image (BGR)
+            params (FilterParams): Parameters to use
+            pyramid (ImagePyramid): Cached pyramid of img, built if needed
+        """
+        params = self.resolve_params(params)
+        if params.edge_level == 0 and params.edge_levels == 1:
+            return self.detect_gray_edges(cv2.cvtColor(img, cv2.COLOR_BGR2GRAY), params)
+
+        pyramid = pyramid if pyramid is not None else ImagePyramid(img)
+        merged = None
+        for level in range(params.edge_level, params.edge_level + params.edge_levels):
+            level = pyramid.clamp(level)
+            edges = self.detect_gray_edges(pyramid.gray(level), params)
+            edges = upsample(edges, level, img.shape, cv2.INTER_NEAREST)
+            merged = edges if merged is None else cv2.bitwise_or(merged, edges)
+        return merged
+
+    def detect_gray_edges(self, gray, params=None):
+        """
+        Detect one-pixel edges in a grayscale image with the selected method
+        """
+        params = self.resolve_params(params)
         # Apply gaussian blur to reduce noise
-        if self.edge_blur > 0:
-            gray = cv2.GaussianBlur(gray, (self.edge_blur, self.edge_blur), 0)
+        if params.edge_blur > 0:
+            gray = cv2.GaussianBlur(gray, (params.edge_blur, params.edge_blur), 0)
             
-        if self.edge_detection_method == "canny":
-            edges = cv2.Canny(gray, self.canny_threshold1, self.canny_threshold2)
-        elif self.edge_detection_method == "sobel":
-            sobelx = cv2.Sobel(gray, cv2.CV_64F, 1, 0, ksize=self.sobel_kernel_size)
-            sobely = cv2.Sobel(gray, cv2.CV_64F, 0, 1, ksize=self.sobel_kernel_size)
+        if params.edge_detection_method == "canny":
+            edges = cv2.Canny(gray, params.canny_threshold1, params.canny_threshold2)
+        elif params.edge_detection_method == "sobel":
+            sobelx = cv2.Sobel(gray, cv2.CV_64F, 1, 0, ksize=params.sobel_kernel_size)
+            sobely = cv2.Sobel(gray, cv2.CV_64F, 0, 1, ksize=params.sobel_kernel_size)
             edges = cv2.magnitude(sobelx, sobely)
-            # Normalize to 0-255
-            edges = cv2.normalize(edges, None, 0, 255, cv2.NORM_MINMAX, cv2.CV_8U)
+            if params.edge_normalization == "fixed":
+                # Scale by the strongest possible response instead of the image maximum
+                edges = cv2.convertScaleAbs(edges, alpha=255.0 / sobel_max_response(params.sobel_kernel_size))
+            else:
+                # Normalize to 0-255
+                edges = cv2.normalize(edges, None, 0, 255, cv2.NORM_MINMAX, cv2.CV_8U)
             # Apply threshold
-            _, edges = cv2.threshold(edges, self.canny_threshold1, 255, cv2.THRESH_BINARY)
-        elif self.edge_detection_method == "laplacian":
-            edges = cv2.Laplacian(gray, cv2.CV_64F)
+            _, edges = cv2.threshold(edges, params.canny_threshold1, 255, cv2.THRESH_BINARY)
+        elif params.edge_detection_method == "sobel_fast":
+            edges = self.sobel_edges_fast(gray, params)
+            _, edges = cv2.threshold(edges, params.canny_threshold1, 255, cv2.THRESH_BINARY)
+        elif params.edge_detection_method == "laplacian":
+            # The 3x3 Laplacian of an 8-bit image always fits in 16 bits, so this
+            # matches the float result exactly at a fraction of the cost
+            edges = cv2.Laplacian(gray, cv2.CV_16S)
             edges = cv2.convertScaleAbs(edges)
-            _, edges = cv2.threshold(edges, self.canny_threshold1, 255, cv2.THRESH_BINARY)
-        
-        # Dilate edges for thicker lines if needed
-        if self.line_size > 1:
-            kernel = np.ones((self.line_size, self.line_size), np.uint8)
-            edges = cv2.dilate(edges, kernel, iterations=1)
+            _, edges = cv2.threshold(edges, params.canny_threshold1, 255, cv2.THRESH_BINARY)
         
         return edges
 
-    def apply_bilateral_filter(self, img):
+    def thicken_edges(self, edges, params=None):
+        """
+        Thicken edge lines to `line_size` using a square or round pen
+
+        A round pen marks every pixel within (line_size - 1) / 2 of an edge,
+        found with one distance transform whose cost does not depend on the
+        pen size. Its strokes are centred on the edge, so an even size draws
+        the odd width below it. A square pen is a dilation with a rectangular element,
+        which OpenCV applies as a row pass and a column pass.
+        """
+        params = self.resolve_params(params)
+        if params.line_size <= 1:
+            return edges
+        
+        if params.line_shape == "round":
+            dist = cv2.distanceTransform(cv2.bitwise_not(edges), cv2.DIST_L2, 5)
+            _, edges = cv2.threshold(dist, (params.line_size - 1) / 2.0, 255, cv2.THRESH_BINARY_INV)
+            return edges.astype(np.uint8)
+        
+        kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (params.line_size, params.line_size))
+        return cv2.dilate(edges, kernel, iterations=1)
+
+    def rethicken_edges(self, result, params=None):
+        """
+        Redraw the outlines of a previous result with the current line settings
+
+        Only the dilation and the final composite are recomputed, so changing
+        `line_size` or `line_shape` does not rerun the other stages.
+
+        Args:
+            result (dict): Output of apply_cartoon_effect
+
+        Returns:
+            dict: New result with the same keys
+        """
+        params = self.resolve_params(params)
+        edges = self.thicken_edges(result['raw_edges'], params)
+        updated = dict(result)
+        updated['edges'] = edges
+        updated['cartoon'] = self.combine_edges(result['colors'], edges)
+        return updated
+
+    def combine_edges(self, colors, edges):
+        """
+        Draw black outlines over the color image
+        """
+        edges_inv = cv2.bitwise_not(edges)
+        edges_inv = cv2.cvtColor(edges_inv, cv2.COLOR_GRAY2BGR)
+        return cv2.bitwise_and(colors, edges_inv)
+
+    def sobel_edges_fast(self, gray, params=None):
+        """
+        Integer-only Sobel gradient magnitude
+
+        Gradients are computed in CV_16S and combined with the L1 norm
+        |gx| + |gy| instead of the float Euclidean magnitude. With "fixed"
+        normalization the result is scaled by the strongest possible response,
+        which skips the global min/max pass and keeps tiles and video frames
+        consistent with each other.
+        """
+        params = self.resolve_params(params)
+        max_response = sobel_max_response(params.sobel_kernel_size)
+        # Keep |gx| + |gy| inside the int16 range for large kernels
+        scale = min(1.0, 16383.0 / max_response)
+
+        grad_x = cv2.Sobel(gray, cv2.CV_16S, 1, 0, ksize=params.sobel_kernel_size, scale=scale)
+        grad_y = cv2.Sobel(gray, cv2.CV_16S, 0, 1, ksize=params.sobel_kernel_size, scale=scale)
+        magnitude = cv2.add(cv2.absdiff(grad_x, 0), cv2.absdiff(grad_y, 0))
+
+        if params.edge_normalization == "fixed":
+            alpha = 255.0 / (max_response * scale)
+        else:
+            _, max_val, _, _ = cv2.minMaxLoc(magnitude)
+            alpha = 255.0 / max_val if max_val > 0 else 0.0
+        return cv2.convertScaleAbs(magnitude, alpha=alpha)
+
+    def apply_bilateral_filter(self, img, params=None, pyramid=None):
         """
         Apply bilateral filter for edge-preserving smoothing
+
+        With smoothing_level > 0 the filter runs on that pyramid level, with
+        its spatial extent scaled to match, and the result is scaled back up.
+        Each level cuts the cost about four times and gives a softer look.
+
+        Args:
+            img (numpy.ndarray): Input image (BGR)
+            params (FilterParams): Parameters to use
+            pyramid (ImagePyramid): Cached pyramid of img, built if needed
+        """
+        params = self.resolve_params(params)
+        if params.smoothing_level == 0:
+            return self.smooth(img, params)
+
+        pyramid = pyramid if pyramid is not None else ImagePyramid(img)
+        level = pyramid.clamp(params.smoothing_level)
+        filtered = self.smooth(pyramid.level(level), params, scale=0.5 ** level)
+        return upsample(filtered, level, img.shape)
+
+    def smooth(self, img, params=None, scale=1.0):
+        """
+        Smooth an image, with kernel sizes multiplied by scale
         """
-        if self.edge_preserve:
+        params = self.resolve_params(params)
+        if params.edge_preserve:
+            diameter = max(1, int(round(params.bilateral_d * scale)))
             # Apply multiple times for stronger effect
             filtered = img
             for _ in range(2):  # Apply twice for better smoothing
                 filtered = cv2.bilateralFilter(
                     filtered, 
-                    self.bilateral_d, 
-                    self.bilateral_sigma_color, 
-                    self.bilateral_sigma_space
+                    diameter, 
+                    params.bilateral_sigma_color, 
+                    params.bilateral_sigma_space * scale
                 )
             return filtered
         else:
             # If edge preservation is not needed, use median blur
-            return cv2.medianBlur(img, self.blur_strength)
+            ksize = max(3, int(params.blur_strength * scale) | 1)
+            return cv2.medianBlur(img, ksize)
 
-    def quantize_colors(self, img):
+    def quantize_colors(self, img, params=None, stats=None):
         """
         Reduce the number of colors in the image
+
+        Args:
+            img (numpy.ndarray): Smoothed image (BGR)
+            params (FilterParams): Parameters to use
+            stats (dict): If given, filled with the method, the time taken in
+                seconds and the estimated extra working memory in bytes
         """
-        if self.quantization_method == "kmeans":
-            # Reshape the image
-            data = img.reshape((-1, 3))
-            data = np.float32(data)
-            
-            # Define criteria and apply kmeans
-            criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 100, 0.2)
-            _, labels, centers = cv2.kmeans(
-                data, 
-                self.num_colors, 
-                None, 
-                criteria, 
-                10, 
-                cv2.KMEANS_RANDOM_CENTERS
-            )
-            
-            # Convert back to uint8 and reshape back to the original image
-            centers = np.uint8(centers)
-            result = centers[labels.flatten()]
-            result = result.reshape(img.shape)
-            return result
+        params = self.resolve_params(params)
+        start = time.perf_counter()
+        pixels = img.shape[0] * img.shape[1]
+        if params.quantization_method == "kmeans":
+            # Stream the pixels through k-means and the palette lookup in
+            # fixed-size chunks instead of converting the whole image to float32
+            palette = streaming_kmeans(img, params.num_colors, seed=params.seed)
+            result = assign_palette(img, palette)
+            working_bytes = kmeans_working_bytes(params.num_colors,
+                                                 min(pixels, KMEANS_SAMPLE_PIXELS),
+                                                 min(pixels, ASSIGN_CHUNK_PIXELS))
+
+        elif params.quantization_method == "kmeans_fast":
+            # Fit the palette on a small proxy, then map full-resolution pixels in chunks
+            palette = fit_kmeans_palette(img, params.num_colors, seed=params.seed)
+            result = assign_palette(img, palette)
+            proxy_pixels = min(pixels, FIT_MAX_PIXELS)
+            working_bytes = (proxy_pixels * (3 * 4 + 4)
+                             + assign_working_bytes(params.num_colors, min(pixels, ASSIGN_CHUNK_PIXELS)))
         
-        elif self.quantization_method == "uniform":
+        elif params.quantization_method in ("median_cut", "octree", "kmeans_lab"):
+            # Cluster the color histogram instead of the raw pixels
+            result, working_bytes = quantize_histogram(img, params.num_colors,
+                                                       params.quantization_method,
+                                                       seed=params.seed or 0)
+
+        elif params.quantization_method == "uniform":
             # Apply uniform quantization - simpler but less effective
-            div = 256 // self.num_colors
-            result = img // div * div
-            return result
+            div = 256 // params.num_colors
+            result = np.floor_divide(img, div)
+            result *= div
+            # Computed in place in the output
+            working_bytes = 0
+
+        if stats is not None:
+            stats.update({
+                'method': params.quantization_method,
+                'seconds': time.perf_counter() - start,
+                'working_bytes': working_bytes,
+            })
+        return result
 
-    def enhance_saturation(self, img):
+    def enhance_saturation(self, img, params=None):
         """
         Enhance the color saturation of the image
+
+        Scales the HSV saturation while keeping hue and value, computed
+        directly on the BGR channels: each channel moves away from the
+        pixel's maximum by the factor, capped where the minimum reaches 0.
+        Unlike OpenCV's 8-bit HSV conversion, whose vectorized and scalar
+        paths round differently, the result of a pixel never depends on the
+        width of the image it is part of, so tiles match a full render.
         """
-        # Convert to HSV
-        hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
-        # Scale the saturation channel
-        hsv[:, :, 1] = np.clip(hsv[:, :, 1] * self.saturation_factor, 0, 255).astype(np.uint8)
-        # Convert back to BGR
-        return cv2.cvtColor(hsv, cv2.COLOR_HSV2BGR)
+        params = self.resolve_params(params)
+        pixels = img.astype(np.float32)
+        value = pixels.max(axis=2, keepdims=True)
+        spread = value - pixels.min(axis=2, keepdims=True)
+        # Largest factor that keeps every channel >= 0 is value / spread
+        limit = np.divide(value, spread, out=np.full_like(spread, np.inf), where=spread > 0)
+        factor = np.minimum(np.float32(params.saturation_factor), limit, out=limit)
+        # value - (value - pixels) * factor, in place to bound the memory
+        np.subtract(value, pixels, out=pixels)
+        pixels *= factor
+        np.subtract(value, pixels, out=pixels)
+        np.rint(pixels, out=pixels)
+        return np.clip(pixels, 0, 255, out=pixels).astype(np.uint8)
 
-    def apply_cartoon_effect(self, img):
+    def apply_cartoon_effect(self, img, params=None, pyramid=None):
         """
         Apply the cartoon effect to the image
+
+        Args:
+            img (numpy.ndarray): Input image (BGR)
+            params (FilterParams): Parameters to use, the filter's current
+                attributes if None. Passing them explicitly lets one filter
+                serve concurrent requests with different settings.
+            pyramid (ImagePyramid): Pyramid of img kept by the caller, so
+                repeated renders of one image reuse its levels
         """
+        params = self.resolve_params(params)
+        # Levels are only built if a stage works below full resolution
+        pyramid = pyramid if pyramid is not None else ImagePyramid(img)
+
         # 1. Apply bilateral filter for edge-preserving smoothing
-        filtered = self.apply_bilateral_filter(img)
+        filtered = self.apply_bilateral_filter(img, params, pyramid)
         
-        # 2. Detect edges
-        edges = self.detect_edges(img)
+        # 2. Detect edges and thicken the lines
+        raw_edges = self.detect_raw_edges(img, params, pyramid)
+        edges = self.thicken_edges(raw_edges, params)
         
         # 3. Color quantization for cartoon-like appearance
-        quantized = self.quantize_colors(filtered)
+        quantize_stats = {}
+        quantized = self.quantize_colors(filtered, params, stats=quantize_stats)
         
         # 4. Enhance color saturation
-        saturated = self.enhance_saturation(quantized)
+        saturated = self.enhance_saturation(quantized, params)
         
         # 5. Merge edges with color image
-        edges_inv = cv2.bitwise_not(edges)
-        edges_inv = cv2.cvtColor(edges_inv, cv2.COLOR_GRAY2BGR)
-        
-        # Blend edges with the color image
-        result = cv2.bitwise_and(saturated, edges_inv)
+        result = self.combine_edges(saturated, edges)
         
         return {
             'cartoon': result,
             'edges': edges,
+            'raw_edges': raw_edges,
             'filtered': filtered,
-            'quantized': quantized
+            'quantized': quantized,
+            'colors': saturated,
+            'quantize_stats': quantize_stats
         }
 
     def get_cv2_image_for_tk(self, img, size=None):
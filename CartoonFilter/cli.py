@@ -0,0 +1,333 @@
+#!/usr/bin/env python3
+import os
+import sys
+import argparse
+import contextlib
+from cartoon_filter import CartoonFilter, DETERMINISTIC_THREADS
+from preset_loader import PresetLoader
+from batch_processor import BatchProcessor
+from folder_watcher import FolderWatcher
+from image_writer import ImageWriter, OUTPUT_FORMATS
+from auto_tune import auto_tune
+from fanout import render_presets
+from runtime import calibrate, configure_runtime, core_slices, split_threads
+from dedup import DEFAULT_MAX_DISTANCE
+from events import JsonLinesSink, DEFAULT_EVENT_INTERVAL
+import utils
+
+def build_parser():
+    """Build the command line argument parser"""
+    parser = argparse.ArgumentParser(
+        description="Apply the cartoon filter to an image or a folder of images"
+    )
+    parser.add_argument("-i", "--input", required=True,
+                        help="Input image, or a folder for batch processing")
+    parser.add_argument("-o", "--output", required=True,
+                        help="Output image, or the output folder for batch processing")
+    parser.add_argument("-p", "--preset", default=None,
+                        help="Name of the preset to apply")
+    parser.add_argument("--auto-tune", metavar="NAME", default=None,
+                        help="Tune parameters on the input and save them as preset NAME before processing")
+    parser.add_argument("--all-presets", action="store_true",
+                        help="Render the input image with every preset into the output folder")
+    parser.add_argument("--full", action="store_true",
+                        help="Reprocess every file instead of only new, changed or failed ones")
+    parser.add_argument("--watch", action="store_true",
+                        help="Keep running and cartoonize new files as they arrive in the input folder")
+    parser.add_argument("-r", "--recursive", action="store_true",
+                        help="Include images in subfolders of the input folder")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Number of compute worker threads")
+    parser.add_argument("--io-workers", type=int, default=4,
+                        help="Number of threads reading and decoding input files")
+    parser.add_argument("--format", dest="output_format", choices=sorted(OUTPUT_FORMATS),
+                        default="png", help="Output format for batch processing")
+    parser.add_argument("--quality", type=int, default=90,
+                        help="JPEG/WebP quality (0-100)")
+    parser.add_argument("--png-compression", type=int, default=1,
+                        help="PNG compression level (0-9)")
+    parser.add_argument("--indexed", action="store_true",
+                        help="Write palette PNGs, which are much smaller for quantized output")
+    parser.add_argument("--threads", default=None,
+                        help="Size of the OpenCV thread pool shared by all compute workers, "
+                             "or 'auto' to pick workers and threads with a quick benchmark "
+                             "(default: cores / workers)")
+    parser.add_argument("--pin", action="store_true",
+                        help="Pin each batch compute worker to its own core (only with --threads 1)")
+    parser.add_argument("--memory-budget", type=int, default=None, metavar="MB",
+                        help="Keep the estimated memory of concurrent renders under this many "
+                             "megabytes, queueing or tiling large images")
+    parser.add_argument("--approximate-tiles", action="store_true",
+                        help="Allow tiling images over the memory budget even when tiles "
+                             "differ slightly from a full render (Canny, minmax Sobel or "
+                             "fitted palettes)")
+    parser.add_argument("--dedup", type=int, nargs="?", const=DEFAULT_MAX_DISTANCE,
+                        default=None, metavar="DISTANCE",
+                        help="Reuse the output of an already rendered image for inputs whose "
+                             "perceptual hash differs by at most DISTANCE bits "
+                             f"(default: {DEFAULT_MAX_DISTANCE})")
+    parser.add_argument("--contact-sheet", metavar="PATH", default=None,
+                        help="Also write a labelled contact sheet of the batch outputs or the "
+                             "preset variants to PATH")
+    parser.add_argument("--events", metavar="PATH", default=None,
+                        help="Append batch progress and metrics events as JSON lines to PATH "
+                             "('-' for standard output; other messages then go to standard error)")
+    parser.add_argument("--event-interval", type=float, default=DEFAULT_EVENT_INTERVAL,
+                        help="Seconds between progress events")
+    parser.add_argument("--seed", type=int, default=None,
+                        help="Seed the color quantization and pin the thread count for reproducible output")
+    return parser
+
+def create_filter(preset_name=None):
+    """
+    Create a CartoonFilter, optionally configured from a preset
+
+    Returns:
+        CartoonFilter: Configured filter or None if the preset does not exist
+    """
+    cartoon_filter = CartoonFilter()
+    if preset_name:
+        if not PresetLoader().apply_preset(cartoon_filter, preset_name):
+            return None
+    return cartoon_filter
+
+def run_single(cartoon_filter, input_path, output_path):
+    """Cartoonize a single image file"""
+    img = utils.load_image(input_path)
+    if img is None:
+        print(f"Error: could not load {input_path}")
+        return 1
+
+    result = cartoon_filter.apply_cartoon_effect(img)
+    if not utils.save_image(result['cartoon'], output_path):
+        print(f"Error: could not save {output_path}")
+        return 1
+
+    print(f"Saved to: {output_path}")
+    return 0
+
+def create_writer(args):
+    """Create the output stage from the command line arguments"""
+    return ImageWriter(output_format=args.output_format, quality=args.quality,
+                       png_compression=args.png_compression, indexed=args.indexed)
+
+def configure_workers(cartoon_filter, args):
+    """
+    Set up OpenCV threading for the requested number of compute workers
+
+    Returns:
+        tuple: (number of workers, CPU sets to pin them to or None), or
+            None if the arguments are invalid
+    """
+    # A single image is rendered by one worker that gets every core
+    default_workers = (os.cpu_count() or 1) if os.path.isdir(args.input) else 1
+    workers = args.workers
+    if args.threads == "auto":
+        if args.seed is not None:
+            print("Error: --threads auto is not reproducible, pass a thread count with --seed")
+            return None
+        calibration = calibrate(cartoon_filter)
+        for split_workers, threads, rate in calibration['results']:
+            print(f"Calibration: {split_workers} workers x {threads} threads: {rate:.2f} images/s")
+        workers = workers or calibration['workers']
+        threads = calibration['threads']
+    elif args.threads is not None:
+        try:
+            threads = int(args.threads)
+        except ValueError:
+            print(f"Error: --threads must be a number or 'auto', got '{args.threads}'")
+            return None
+    elif args.seed is not None:
+        threads = DETERMINISTIC_THREADS
+    else:
+        threads = split_threads(workers or default_workers)
+
+    workers = workers or default_workers
+    configure_runtime(threads)
+    cpu_sets = None
+    if args.pin:
+        if threads > 1:
+            # Pinning a worker does not pin the OpenCV pool threads it hands work to
+            print(f"Warning: --pin only works with --threads 1, ignoring it "
+                  f"with {threads} OpenCV threads")
+        else:
+            cpu_sets = core_slices(workers, 1)
+    return workers, cpu_sets
+
+def run_batch(cartoon_filter, input_dir, output_dir, incremental=True, recursive=False,
+              workers=None, io_workers=4, writer=None, cpu_sets=None, memory_budget=None,
+              dedup_distance=None, contact_sheet=None, events=None,
+              event_interval=DEFAULT_EVENT_INTERVAL, approximate_tiles=False):
+    """Cartoonize every image in a folder"""
+    def on_progress(index, total, filename):
+        print(f"[{index+1}/{total}] {filename}")
+
+    event_sink = None
+    if events:
+        try:
+            event_sink = JsonLinesSink(events)
+        except OSError as e:
+            print(f"Error: could not open {events}: {e}")
+            return 1
+
+    processor = BatchProcessor(cartoon_filter, writer=writer,
+                               workers=workers or os.cpu_count() or 1,
+                               io_workers=io_workers, cpu_sets=cpu_sets,
+                               memory_budget=memory_budget, dedup_distance=dedup_distance,
+                               approximate_tiles=approximate_tiles)
+    try:
+        summary = processor.run(input_dir, output_dir, incremental=incremental,
+                                progress_callback=on_progress, recursive=recursive, event_sink=event_sink,
+                                event_interval=event_interval)
+    finally:
+        if event_sink is not None:
+            event_sink.close()
+
+    print(f"Processed {summary['processed']}/{summary['total']} images "
+          f"({summary['skipped']} up to date, {summary['failed']} failed)")
+    if contact_sheet:
+        outputs = [(rel_path, processor.get_output_path(output_dir, rel_path))
+                   for rel_path in processor.list_images(input_dir, recursive=recursive)]
+        outputs = [(rel_path, path) for rel_path, path in outputs if os.path.exists(path)]
+        if not utils.write_contact_sheet([path for _, path in outputs], contact_sheet,
+                                         titles=[rel_path for rel_path, _ in outputs]):
+            return 1
+        print(f"Contact sheet saved to: {contact_sheet}")
+    return 1 if summary['failed'] else 0
+
+def run_watch(cartoon_filter, input_dir, output_dir, max_workers=None, writer=None,
+              memory_budget=None, dedup_distance=None, approximate_tiles=False):
+    """Watch a folder and cartoonize new files until interrupted"""
+    def on_done(filename, outcome):
+        print(f"{outcome}: {filename}")
+
+    processor = BatchProcessor(cartoon_filter, writer=writer, memory_budget=memory_budget,
+                               dedup_distance=dedup_distance,
+                               approximate_tiles=approximate_tiles)
+    watcher = FolderWatcher(processor, input_dir, output_dir,
+                            max_workers=max_workers, progress_callback=on_done)
+    print(f"Watching {input_dir} (Ctrl+C to stop)")
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        watcher.stop()
+    return 0
+
+def run_all_presets(cartoon_filter, input_path, output_dir, writer, contact_sheet=None):
+    """Render one image with every preset, sharing identical stages"""
+    img = utils.load_image(input_path)
+    if img is None:
+        print(f"Error: could not load {input_path}")
+        return 1
+
+    try:
+        results = render_presets(cartoon_filter, img, PresetLoader())
+    except ValueError as e:
+        print(f"Error: {e}")
+        return 1
+
+    stem = os.path.splitext(os.path.basename(input_path))[0]
+    for name, result in results.items():
+        output_path = os.path.join(output_dir, f"{stem}_{name}{writer.extension}")
+        writer.write(result['cartoon'], output_path)
+        print(f"Saved to: {output_path}")
+
+    if contact_sheet:
+        names = sorted(results)
+        if not utils.write_contact_sheet([results[name]['cartoon'] for name in names],
+                                         contact_sheet, titles=names):
+            return 1
+        print(f"Contact sheet saved to: {contact_sheet}")
+    return 0
+
+def run_auto_tune(cartoon_filter, input_path, preset_name):
+    """
+    Tune the filter on an image (the first image of a folder) and save a preset
+
+    Returns:
+        bool: True if a preset was created and applied to the filter
+    """
+    if os.path.isdir(input_path):
+        images = BatchProcessor(cartoon_filter).list_images(input_path)
+        if not images:
+            print(f"Error: no images found in {input_path}")
+            return False
+        input_path = os.path.join(input_path, images[0])
+
+    img = utils.load_image(input_path)
+    if img is None:
+        print(f"Error: could not load {input_path}")
+        return False
+
+    loader = PresetLoader()
+    preset = auto_tune(img, loader, preset_name, base_filter=cartoon_filter)
+    loader.apply_preset(cartoon_filter, preset_name)
+    print(f"Saved tuned preset '{preset_name}': {preset}")
+    return True
+
+def main(argv=None):
+    """Command line entry point"""
+    args = build_parser().parse_args(argv)
+    if args.events == "-":
+        # Standard output carries only the JSON events, every other message
+        # goes to standard error
+        events = sys.stdout
+        with contextlib.redirect_stdout(sys.stderr):
+            return run_command(args, events)
+    return run_command(args, args.events)
+
+def run_command(args, events=None):
+    """
+    Run the command selected by the parsed arguments
+
+    Args:
+        args (argparse.Namespace): Parsed command line
+        events: Event target for batch runs, a path or an open stream
+    """
+    cartoon_filter = create_filter(args.preset)
+    if cartoon_filter is None:
+        print(f"Error: unknown preset '{args.preset}'")
+        return 1
+
+    if args.seed is not None:
+        try:
+            cartoon_filter.set_params(cartoon_filter.get_params().replace(seed=args.seed))
+        except ValueError as e:
+            print(f"Error: {e}")
+            return 1
+
+    runtime = configure_workers(cartoon_filter, args)
+    if runtime is None:
+        return 1
+    workers, cpu_sets = runtime
+    memory_budget = args.memory_budget * 1024 * 1024 if args.memory_budget else None
+
+    if args.auto_tune:
+        if not run_auto_tune(cartoon_filter, args.input, args.auto_tune):
+            return 1
+
+    if args.all_presets:
+        if os.path.isdir(args.input):
+            print("Error: --all-presets requires a single input image")
+            return 1
+        return run_all_presets(cartoon_filter, args.input, args.output, create_writer(args),
+                               contact_sheet=args.contact_sheet)
+    if args.watch:
+        if not os.path.isdir(args.input):
+            print("Error: --watch requires an input folder")
+            return 1
+        return run_watch(cartoon_filter, args.input, args.output, workers,
+                         writer=create_writer(args), memory_budget=memory_budget,
+                         dedup_distance=args.dedup, approximate_tiles=args.approximate_tiles)
+    if os.path.isdir(args.input):
+        return run_batch(cartoon_filter, args.input, args.output, incremental=not args.full,
+                         recursive=args.recursive, workers=workers,
+                         io_workers=args.io_workers, writer=create_writer(args),
+                         cpu_sets=cpu_sets, memory_budget=memory_budget,
+                         dedup_distance=args.dedup, contact_sheet=args.contact_sheet,
+                         events=events, event_interval=args.event_interval,
+                         approximate_tiles=args.approximate_tiles)
+    return run_single(cartoon_filter, args.input, args.output)
+
+if __name__ == "__main__":
+    sys.exit(main())
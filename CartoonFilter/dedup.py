@@ -0,0 +1,238 @@
+import os
+import threading
+import cv2
+import numpy as np
+
+# Default largest Hamming distance between hashes of near-identical images
+DEFAULT_MAX_DISTANCE = 3
+
+# Hashes with fewer set (or unset) bits than this come from flat images
+# such as solid colors or smooth gradients, which all hash alike
+MIN_HASH_BITS = 8
+
+# Side of the color thumbnail compared before an output is reused
+SIGNATURE_SIZE = 8
+
+# Largest mean and largest single difference between thumbnail values
+COLOR_TOLERANCE = 4
+COLOR_MAX_DIFFERENCE = 24
+
+# Largest relative difference between aspect ratios
+ASPECT_TOLERANCE = 0.02
+
+
+def dhash(img, hash_size=8):
+    """
+    Difference hash of an image
+
+    The image is shrunk to (hash_size + 1) x hash_size gray pixels and every
+    bit records whether a pixel is brighter than its right neighbour. Resized
+    copies, re-encodes and small changes give hashes a few bits apart.
+
+    Args:
+        img (numpy.ndarray): BGR or grayscale image
+        hash_size (int): Bits per row and number of rows
+
+    Returns:
+        int: hash_size * hash_size bit hash
+    """
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY) if img.ndim == 3 else img
+    small = cv2.resize(gray, (hash_size + 1, hash_size), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    value = 0
+    for bit in bits:
+        value = (value << 1) | int(bit)
+    return value
+
+
+def hamming(a, b):
+    """Number of differing bits between two hashes"""
+    return bin(a ^ b).count("1")
+
+
+def informative(phash, hash_bits=64):
+    """Whether a hash has enough structure to identify an image"""
+    ones = bin(phash).count("1")
+    return MIN_HASH_BITS <= ones <= hash_bits - MIN_HASH_BITS
+
+
+def color_signature(img):
+    """
+    Small color thumbnail of an image
+
+    The difference hash only sees brightness changes, so it cannot tell a
+    red image from a blue one. The thumbnail is compared before an output
+    is reused.
+
+    Returns:
+        str: SIGNATURE_SIZE x SIGNATURE_SIZE BGR thumbnail as hex
+    """
+    if img.ndim == 2:
+        img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+    size = (SIGNATURE_SIZE, SIGNATURE_SIZE)
+    return cv2.resize(img, size, interpolation=cv2.INTER_AREA).tobytes().hex()
+
+
+def aspect_ratio(shape):
+    """Width / height of an image shape"""
+    return round(shape[1] / shape[0], 4)
+
+
+def same_content(entry, signature, aspect):
+    """
+    Check the color thumbnail and aspect ratio of an indexed entry
+
+    Args:
+        entry (dict): Indexed entry with 'csig' and 'aspect'
+        signature (str): color_signature of the new input
+        aspect (float): aspect_ratio of the new input
+
+    Returns:
+        bool: True if the entry's output can stand in for the new input
+    """
+    if 'csig' not in entry or 'aspect' not in entry:
+        return False
+    if abs(entry['aspect'] - aspect) > ASPECT_TOLERANCE * aspect:
+        return False
+    a = np.frombuffer(bytes.fromhex(entry['csig']), dtype=np.uint8).astype(np.int16)
+    b = np.frombuffer(bytes.fromhex(signature), dtype=np.uint8).astype(np.int16)
+    if a.shape != b.shape:
+        return False
+    difference = np.abs(a - b)
+    return difference.mean() <= COLOR_TOLERANCE and difference.max() <= COLOR_MAX_DIFFERENCE
+
+
+class BKTree:
+    """
+    Burkhard-Keller tree of hashes under the Hamming distance
+
+    Finding every hash within a small distance of a query only visits the
+    subtrees whose edge distance can still contain a match, instead of
+    comparing against every stored hash.
+    """
+
+    def __init__(self):
+        self.root = None
+        self.size = 0
+
+    def add(self, key, value):
+        """Store a value under a hash"""
+        node = [key, value, {}]
+        self.size += 1
+        if self.root is None:
+            self.root = node
+            return
+        current = self.root
+        while True:
+            distance = hamming(key, current[0])
+            child = current[2].get(distance)
+            if child is None:
+                current[2][distance] = node
+                return
+            current = child
+
+    def search(self, key, max_distance):
+        """
+        Find the stored values within max_distance of a hash
+
+        Returns:
+            list: (distance, value) pairs, closest first
+        """
+        matches = []
+        pending = [self.root] if self.root is not None else []
+        while pending:
+            node = pending.pop()
+            distance = hamming(key, node[0])
+            if distance <= max_distance:
+                matches.append((distance, node[1]))
+            for edge, child in node[2].items():
+                if distance - max_distance <= edge <= distance + max_distance:
+                    pending.append(child)
+        matches.sort(key=lambda match: match[0])
+        return matches
+
+
+class DedupIndex:
+    """
+    Thread-safe index of already rendered inputs by perceptual hash
+
+    Values are the manifest entries of the rendered inputs, so a match
+    points at an output that can be reused. A hash match alone is not
+    enough: the color thumbnail and the aspect ratio must agree as well.
+    """
+
+    def __init__(self, max_distance=DEFAULT_MAX_DISTANCE):
+        self.max_distance = max_distance
+        self.tree = BKTree()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_manifest(cls, manifest, params_hash, max_distance=DEFAULT_MAX_DISTANCE,
+                      input_dir=None):
+        """
+        Index the inputs of a manifest that were rendered with the same settings
+
+        Entries that reused another output are left out, so outputs are
+        never resized from a resized copy. With input_dir, entries whose
+        input has changed or disappeared since it was rendered are left out
+        too, so an output is never reused for content it was not made from.
+        """
+        index = cls(max_distance)
+        for entry in manifest.entries.values():
+            if (entry.get('status') != 'done' or not entry.get('phash')
+                    or entry.get('params_hash') != params_hash
+                    or 'duplicate_of' in entry or 'csig' not in entry):
+                continue
+            phash = int(entry['phash'], 16)
+            if not informative(phash):
+                continue
+            if input_dir is not None and not _unchanged(input_dir, entry):
+                continue
+            index.add(phash, entry)
+        return index
+
+    def add(self, phash, entry):
+        """Index a rendered input"""
+        with self.lock:
+            self.tree.add(phash, entry)
+
+    def find(self, phash, signature, aspect, exclude=None):
+        """
+        Closest indexed entry within max_distance with the same colors and shape
+
+        Args:
+            phash (int): Hash of the new input
+            signature (str): color_signature of the new input
+            aspect (float): aspect_ratio of the new input
+            exclude (str): Input path to ignore, such as an earlier version
+                of the same file
+
+        Returns:
+            dict: Manifest entry, or None if there is no near-duplicate
+        """
+        if not informative(phash):
+            return None
+        with self.lock:
+            matches = self.tree.search(phash, self.max_distance)
+        for _, entry in matches:
+            if entry.get('input') != exclude and same_content(entry, signature, aspect):
+                return entry
+        return None
+
+
+def _unchanged(input_dir, entry):
+    try:
+        stat = os.stat(os.path.join(input_dir, entry['input']))
+    except OSError:
+        return False
+    return stat.st_mtime == entry.get('mtime') and stat.st_size == entry.get('size')
+
+
+def adapt_output(cartoon, shape):
+    """Resize a reused cartoon to the shape of the duplicate input"""
+    height, width = shape[:2]
+    if cartoon.shape[:2] == (height, width):
+        return cartoon
+    shrinking = width * height < cartoon.shape[0] * cartoon.shape[1]
+    interpolation = cv2.INTER_AREA if shrinking else cv2.INTER_LINEAR
+    return cv2.resize(cartoon, (width, height), interpolation=interpolation)
@@ -0,0 +1,187 @@
+import sys
+import json
+import time
+import queue
+import threading
+
+# Seconds between progress events
+DEFAULT_EVENT_INTERVAL = 0.5
+
+
+class JsonLinesSink:
+    """
+    Event sink that writes every event as one JSON line
+
+    Args:
+        target: Path of a file to append to, "-" for standard output, or an
+            open text stream
+    """
+
+    def __init__(self, target):
+        self._owned = isinstance(target, str) and target != "-"
+        if self._owned:
+            self._file = open(target, 'a')
+        else:
+            self._file = sys.stdout if target == "-" else target
+
+    def __call__(self, event):
+        self._file.write(json.dumps(event, sort_keys=True) + "\n")
+        self._file.flush()
+
+    def close(self):
+        """Close the file if the sink opened it"""
+        if self._owned:
+            self._file.close()
+
+
+class BatchEvents:
+    """
+    Structured event stream of a batch run
+
+    Workers only put small records on an unbounded queue and mark when
+    their renders start and end; a dispatcher thread turns them into events
+    and calls the sink, so a slow sink (a GUI, a log shipper) never holds up
+    rendering. Events are dicts with a 'type' and the wall-clock 'time':
+
+    - 'start': 'total' files and compute 'workers'
+    - 'files', at most every `interval` seconds: the files finished since
+      the previous 'files' event as a list of dicts with 'input', 'outcome'
+      and 'seconds' from the start of the render until the output was
+      written (None for files that were not rendered)
+    - 'progress', at most every `interval` seconds: completed, processed,
+      skipped and failed counts, 'elapsed' seconds, 'throughput' and
+      'recent_throughput' in processed images per second, the fraction of
+      time the compute workers spent rendering ('utilization', 0-1) since
+      the previous progress event, plus the values returned by `gauges`,
+      such as queue depths
+    - 'end': the final counts, throughput and overall utilization, plus an
+      'error' message if the run was aborted by an exception
+    """
+
+    def __init__(self, sink, total, workers, interval=DEFAULT_EVENT_INTERVAL, gauges=None,
+                 file_events=True):
+        self.sink = sink
+        self.total = total
+        self.workers = max(1, workers)
+        self.interval = interval
+        self.gauges = gauges
+        self.file_events = file_events
+
+        self.counts = {'completed': 0, 'processed': 0, 'skipped': 0, 'failed': 0}
+        self._records = queue.SimpleQueue()
+        self._thread = None
+        self._start = None
+        self._busy = 0.0
+        self._busy_since = {}
+        self._busy_lock = threading.Lock()
+        self._last = None
+        self._files = []
+        self._error = None
+        self._sink_failed = False
+
+    def start(self):
+        """Emit the start event and start the dispatcher"""
+        self._start = time.perf_counter()
+        self._last = (self._start, 0, 0.0)
+        self._emit({'type': 'start', 'total': self.total, 'workers': self.workers})
+        self._thread = threading.Thread(target=self._dispatch, daemon=True)
+        self._thread.start()
+
+    def file_done(self, rel_path, outcome, seconds=None):
+        """Record a finished file; safe to call from any thread"""
+        self._records.put(('file', rel_path, outcome, seconds))
+
+    def render_started(self, worker):
+        """Mark compute worker `worker` as busy"""
+        with self._busy_lock:
+            self._busy_since[worker] = time.perf_counter()
+
+    def render_finished(self, worker):
+        """Mark compute worker `worker` as idle again"""
+        with self._busy_lock:
+            since = self._busy_since.pop(worker, None)
+            if since is not None:
+                self._busy += time.perf_counter() - since
+
+    def busy_seconds(self, now):
+        """Total rendering time of all workers, including renders in progress"""
+        with self._busy_lock:
+            return self._busy + sum(now - since for since in self._busy_since.values())
+
+    def close(self, error=None):
+        """Emit the final events and stop the dispatcher; error marks an aborted run"""
+        self._error = error
+        self._records.put(None)
+        if self._thread is not None:
+            self._thread.join()
+
+    def _dispatch(self):
+        next_progress = time.perf_counter() + self.interval
+        while True:
+            try:
+                record = self._records.get(timeout=max(0.0, next_progress - time.perf_counter()))
+            except queue.Empty:
+                record = ()
+            if record is None:
+                break
+            if record:
+                self._handle(record)
+            if time.perf_counter() >= next_progress:
+                self._flush_files()
+                self._emit(self._progress())
+                next_progress = time.perf_counter() + self.interval
+
+        self._flush_files()
+        # Summarize the whole run rather than the last interval
+        self._last = (self._start, 0, 0.0)
+        end = self._progress()
+        end['type'] = 'end'
+        del end['recent_throughput']
+        if self._error is not None:
+            end['error'] = self._error
+        self._emit(end)
+
+    def _handle(self, record):
+        _, rel_path, outcome, seconds = record
+        self.counts['completed'] += 1
+        self.counts[outcome] += 1
+        if self.file_events:
+            self._files.append({'input': rel_path, 'outcome': outcome,
+                                'seconds': None if seconds is None else round(seconds, 4)})
+
+    def _flush_files(self):
+        if self._files:
+            files, self._files = self._files, []
+            self._emit({'type': 'files', 'files': files})
+
+    def _progress(self):
+        now = time.perf_counter()
+        busy = self.busy_seconds(now)
+        last_time, last_processed, last_busy = self._last
+        elapsed = now - self._start
+        window = max(now - last_time, 1e-9)
+        processed = self.counts['processed']
+        event = {
+            'type': 'progress',
+            'total': self.total,
+            'elapsed': round(elapsed, 3),
+            'throughput': round(processed / elapsed, 3) if elapsed > 0 else 0.0,
+            'recent_throughput': round((processed - last_processed) / window, 3),
+            'utilization': round(min(1.0, (busy - last_busy) / (window * self.workers)), 3),
+        }
+        event.update(self.counts)
+        if self.gauges is not None:
+            event.update(self.gauges())
+        self._last = (now, processed, busy)
+        return event
+
+    def _emit(self, event):
+        if self._sink_failed:
+            return
+        event['time'] = round(time.time(), 3)
+        try:
+            self.sink(event)
+        except Exception as e:
+            # A broken consumer must not stop the batch
+            print(f"Event sink failed, no more events will be sent: {e}", file=sys.stderr)
+            self._sink_failed = True
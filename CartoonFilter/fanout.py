@@ -0,0 +1,130 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pyramid import ImagePyramid
+
+# Parameters each stage depends on, on top of the stages it consumes
+SMOOTHING_PARAMS = ("edge_preserve", "bilateral_d", "bilateral_sigma_color",
+                    "bilateral_sigma_space", "blur_strength", "smoothing_level")
+EDGE_PARAMS = ("edge_detection_method", "canny_threshold1", "canny_threshold2",
+               "sobel_kernel_size", "edge_normalization", "edge_blur", "edge_level",
+               "edge_levels")
+LINE_PARAMS = ("line_size", "line_shape")
+QUANTIZE_PARAMS = ("quantization_method", "num_colors", "seed")
+SATURATION_PARAMS = ("saturation_factor",)
+
+
+def stage_keys(params):
+    """
+    Compute the cache key of every stage for a parameter set
+
+    Two parameter sets share a stage result exactly when their keys for that
+    stage are equal.
+
+    Returns:
+        dict: Stage name to hashable key
+    """
+    filtered = params.subset(SMOOTHING_PARAMS)
+    raw_edges = params.subset(EDGE_PARAMS)
+    edges = (raw_edges, params.subset(LINE_PARAMS))
+    quantized = (filtered, params.subset(QUANTIZE_PARAMS))
+    colors = (quantized, params.subset(SATURATION_PARAMS))
+    return {
+        'filtered': filtered,
+        'raw_edges': raw_edges,
+        'edges': edges,
+        'quantized': quantized,
+        'colors': colors,
+        'cartoon': (colors, edges),
+    }
+
+
+def render_variants(cartoon_filter, img, variants, max_workers=None):
+    """
+    Render one image with many parameter sets, sharing identical stages
+
+    Variants are grouped by the parameters each stage depends on, every
+    distinct stage is computed once, and work only branches where the
+    parameters differ. Every distinct stage result at the same depth is
+    submitted before any is waited for, so smoothing runs alongside edge
+    detection and quantization alongside line thickening. All of them
+    share one pyramid of the input image.
+
+    Args:
+        cartoon_filter (CartoonFilter): Filter used to run the stages
+        img (numpy.ndarray): Input image (BGR)
+        variants (dict): Variant name to FilterParams
+        max_workers (int): Threads shared by the stages of a depth
+
+    Returns:
+        dict: Variant name to a result dict like apply_cartoon_effect returns
+    """
+    max_workers = max_workers or os.cpu_count() or 1
+    keys = {name: stage_keys(params) for name, params in variants.items()}
+    cache = {stage: {} for stage in ('filtered', 'raw_edges', 'edges', 'quantized',
+                                     'colors', 'cartoon')}
+
+    def run_depth(pool, stages):
+        # Submit every distinct key of the independent stages before waiting,
+        # one representative parameter set per key
+        futures = []
+        for stage, compute in stages:
+            pending = {}
+            for name, params in variants.items():
+                pending.setdefault(keys[name][stage], params)
+            futures.extend((stage, key, pool.submit(compute, key, params))
+                           for key, params in pending.items())
+        for stage, key, future in futures:
+            cache[stage][key] = future.result()
+
+    pyramid = ImagePyramid(img)
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        # Stages that only read the input image
+        run_depth(pool, [
+            ('filtered', lambda key, p: cartoon_filter.apply_bilateral_filter(img, p, pyramid)),
+            ('raw_edges', lambda key, p: cartoon_filter.detect_raw_edges(img, p, pyramid)),
+        ])
+
+        # Stages that branch from the shared results
+        run_depth(pool, [
+            ('edges', lambda key, p: cartoon_filter.thicken_edges(cache['raw_edges'][key[0]], p)),
+            ('quantized',
+             lambda key, p: cartoon_filter.quantize_colors(cache['filtered'][key[0]], p)),
+        ])
+        run_depth(pool, [
+            ('colors',
+             lambda key, p: cartoon_filter.enhance_saturation(cache['quantized'][key[0]], p)),
+        ])
+        run_depth(pool, [
+            ('cartoon', lambda key, p: cartoon_filter.combine_edges(cache['colors'][key[0]],
+                                                                    cache['edges'][key[1]])),
+        ])
+
+    return {
+        name: {stage: cache[stage][key] for stage, key in stage_keys_of.items()}
+        for name, stage_keys_of in keys.items()
+    }
+
+
+def render_presets(cartoon_filter, img, preset_loader, names=None, max_workers=None):
+    """
+    Render one image with several presets in a single pass
+
+    Args:
+        cartoon_filter (CartoonFilter): Filter used to run the stages
+        img (numpy.ndarray): Input image (BGR)
+        preset_loader (PresetLoader): Source of the presets
+        names (list): Preset names, every preset if None
+        max_workers (int): Threads shared by the stages of a depth
+
+    Returns:
+        dict: Preset name to result dict
+    """
+    base = cartoon_filter.get_params()
+    names = names if names is not None else preset_loader.get_preset_names()
+    variants = {}
+    for name in names:
+        params = preset_loader.get_params(name, base=base)
+        if params is None:
+            raise ValueError(f"Unknown preset: {name}")
+        variants[name] = params
+    return render_variants(cartoon_filter, img, variants, max_workers)
@@ -0,0 +1,191 @@
+import numbers
+
+# Allowed values for the string parameters
+PARAM_CHOICES = {
+    "edge_detection_method": ("canny", "sobel", "sobel_fast", "laplacian"),
+    "edge_normalization": ("minmax", "fixed"),
+    "line_shape": ("square", "round"),
+    "quantization_method": ("kmeans", "kmeans_fast", "kmeans_lab", "median_cut", "octree",
+                            "uniform"),
+}
+
+# Default value of every parameter, matching a fresh CartoonFilter
+PARAM_DEFAULTS = {
+    "edge_detection_method": "canny",
+    "canny_threshold1": 100,
+    "canny_threshold2": 200,
+    "sobel_kernel_size": 3,
+    "edge_normalization": "minmax",
+    "edge_blur": 5,
+    "edge_level": 0,
+    "edge_levels": 1,
+    "bilateral_d": 9,
+    "bilateral_sigma_color": 75,
+    "bilateral_sigma_space": 75,
+    "quantization_method": "kmeans",
+    "num_colors": 8,
+    "seed": None,
+    "line_size": 7,
+    "line_shape": "square",
+    "blur_strength": 7,
+    "smoothing_level": 0,
+    "edge_preserve": True,
+    "saturation_factor": 1.5,
+}
+
+PARAM_NAMES = tuple(PARAM_DEFAULTS)
+
+# Coarsest pyramid level a stage may work on (1/16 of the resolution)
+MAX_PYRAMID_LEVEL = 4
+
+
+def _check_int(name, value, minimum=None, maximum=None, odd=False, allow_zero=False):
+    if isinstance(value, bool) or not isinstance(value, numbers.Integral):
+        if isinstance(value, numbers.Real) and float(value).is_integer():
+            value = int(value)
+        else:
+            raise ValueError(f"{name} must be an integer, got {value!r}")
+    value = int(value)
+    if allow_zero and value == 0:
+        return value
+    if minimum is not None and value < minimum:
+        raise ValueError(f"{name} must be at least {minimum}, got {value}")
+    if maximum is not None and value > maximum:
+        raise ValueError(f"{name} must be at most {maximum}, got {value}")
+    if odd and value % 2 == 0:
+        raise ValueError(f"{name} must be odd, got {value}")
+    return value
+
+
+def _check_float(name, value, minimum=None):
+    if isinstance(value, bool) or not isinstance(value, numbers.Real):
+        raise ValueError(f"{name} must be a number, got {value!r}")
+    value = float(value)
+    if minimum is not None and value < minimum:
+        raise ValueError(f"{name} must be at least {minimum}, got {value}")
+    return value
+
+
+def validate_params(values):
+    """
+    Validate and normalize a complete parameter dict
+
+    Args:
+        values (dict): Value for every name in PARAM_NAMES
+
+    Returns:
+        dict: Validated values with numeric types normalized
+
+    Raises:
+        ValueError: If a value is of the wrong type or out of range
+    """
+    checked = dict(values)
+
+    for name, choices in PARAM_CHOICES.items():
+        if checked[name] not in choices:
+            raise ValueError(f"{name} must be one of {', '.join(choices)}, got {checked[name]!r}")
+
+    checked["canny_threshold1"] = _check_int("canny_threshold1", checked["canny_threshold1"], 0, 255)
+    checked["canny_threshold2"] = _check_int("canny_threshold2", checked["canny_threshold2"], 0, 255)
+    checked["sobel_kernel_size"] = _check_int("sobel_kernel_size", checked["sobel_kernel_size"],
+                                              1, 7, odd=True)
+    checked["edge_blur"] = _check_int("edge_blur", checked["edge_blur"], 1, odd=True, allow_zero=True)
+    checked["edge_level"] = _check_int("edge_level", checked["edge_level"], 0, MAX_PYRAMID_LEVEL)
+    checked["edge_levels"] = _check_int("edge_levels", checked["edge_levels"], 1,
+                                        MAX_PYRAMID_LEVEL + 1)
+    checked["bilateral_d"] = _check_int("bilateral_d", checked["bilateral_d"], 1)
+    checked["bilateral_sigma_color"] = _check_float("bilateral_sigma_color",
+                                                    checked["bilateral_sigma_color"], 0)
+    checked["bilateral_sigma_space"] = _check_float("bilateral_sigma_space",
+                                                    checked["bilateral_sigma_space"], 0)
+    checked["num_colors"] = _check_int("num_colors", checked["num_colors"], 2, 256)
+    if checked["seed"] is not None:
+        checked["seed"] = _check_int("seed", checked["seed"], 0, 2**31 - 1)
+    checked["line_size"] = _check_int("line_size", checked["line_size"], 1)
+    checked["blur_strength"] = _check_int("blur_strength", checked["blur_strength"], 3, odd=True)
+    checked["smoothing_level"] = _check_int("smoothing_level", checked["smoothing_level"], 0,
+                                            MAX_PYRAMID_LEVEL)
+    checked["saturation_factor"] = _check_float("saturation_factor", checked["saturation_factor"], 0)
+    checked["edge_preserve"] = bool(checked["edge_preserve"])
+    return checked
+
+
+class FilterParams:
+    """
+    Immutable, validated set of CartoonFilter parameters
+
+    Values are checked once on construction (odd kernel sizes, value
+    ranges, known method names). Instances are hashable and compare by
+    value, so they can be shared between threads and used as cache keys.
+    Use replace() to derive a modified copy.
+    """
+    __slots__ = PARAM_NAMES + ("_key",)
+
+    def __init__(self, **values):
+        unknown = set(values) - set(PARAM_NAMES)
+        if unknown:
+            raise ValueError(f"Unknown filter parameters: {', '.join(sorted(unknown))}")
+
+        merged = dict(PARAM_DEFAULTS)
+        merged.update(values)
+        checked = validate_params(merged)
+
+        for name in PARAM_NAMES:
+            object.__setattr__(self, name, checked[name])
+        object.__setattr__(self, "_key", tuple(checked[name] for name in PARAM_NAMES))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("FilterParams is immutable, use replace() instead")
+
+    def __delattr__(self, name):
+        raise AttributeError("FilterParams is immutable")
+
+    def __eq__(self, other):
+        if not isinstance(other, FilterParams):
+            return NotImplemented
+        return self._key == other._key
+
+    def __hash__(self):
+        return hash(self._key)
+
+    def __repr__(self):
+        args = ", ".join(f"{name}={getattr(self, name)!r}" for name in PARAM_NAMES)
+        return f"FilterParams({args})"
+
+    def __reduce__(self):
+        return (_rebuild_params, (self.as_dict(),))
+
+    def as_dict(self):
+        """Get the parameters as a plain dict"""
+        return {name: getattr(self, name) for name in PARAM_NAMES}
+
+    def replace(self, **changes):
+        """Get a copy with some parameters changed"""
+        values = self.as_dict()
+        values.update(changes)
+        return FilterParams(**values)
+
+    def subset(self, names):
+        """Get a hashable key made of a subset of the parameters"""
+        return tuple(getattr(self, name) for name in names)
+
+    @classmethod
+    def from_dict(cls, data, base=None):
+        """
+        Build parameters from a preset dict
+
+        Keys that are not filter parameters are ignored. Missing keys are
+        taken from `base`, or from the defaults if no base is given.
+        """
+        values = base.as_dict() if base is not None else {}
+        values.update({k: v for k, v in data.items() if k in PARAM_DEFAULTS})
+        return cls(**values)
+
+    @classmethod
+    def from_filter(cls, cartoon_filter):
+        """Snapshot the current attributes of a CartoonFilter"""
+        return cls(**{name: getattr(cartoon_filter, name) for name in PARAM_NAMES})
+
+
+def _rebuild_params(values):
+    return FilterParams(**values)
@@ -0,0 +1,160 @@
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from batch_processor import BatchManifest, MANIFEST_NAME, IMAGE_EXTENSIONS
+
+class FolderWatcher:
+    """
+    Long-running watch mode built on the batch engine.
+
+    The input folder is polled with os.scandir, which returns the size and
+    modification time of every entry without a separate stat call. A file is
+    dispatched once it has kept the same size and mtime for `settle_time`
+    seconds (or was already that old when first seen), so partially written
+    uploads are never read. Work runs on a persistent thread pool that keeps
+    the filter and presets loaded between files. A file that failed is only
+    retried once its size or mtime changes, for example when it is uploaded
+    again.
+    """
+
+    def __init__(self, processor, input_dir, output_dir, poll_interval=0.1,
+                 settle_time=0.3, max_workers=None, progress_callback=None):
+        self.processor = processor
+        self.input_dir = input_dir
+        self.output_dir = output_dir
+        self.poll_interval = poll_interval
+        self.settle_time = settle_time
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.progress_callback = progress_callback
+
+        self.manifest = BatchManifest(os.path.join(output_dir, MANIFEST_NAME))
+        self.params_hash = processor.get_params_hash()
+        self.dedup_index = processor.create_dedup_index(self.manifest, self.params_hash,
+                                                       input_dir)
+        self.stop_event = threading.Event()
+
+        self._executor = None
+        self._pending = {}
+        self._in_flight = set()
+        self._lock = threading.Lock()
+
+    def scan(self):
+        """
+        Take a snapshot of the image files in the input folder
+
+        Returns:
+            dict: Mapping of file name to (mtime, size)
+        """
+        snapshot = {}
+        try:
+            with os.scandir(self.input_dir) as it:
+                for entry in it:
+                    if not entry.name.lower().endswith(IMAGE_EXTENSIONS):
+                        continue
+                    try:
+                        if not entry.is_file():
+                            continue
+                        stat = entry.stat()
+                    except OSError:
+                        continue
+                    snapshot[entry.name] = (stat.st_mtime, stat.st_size)
+        except OSError:
+            pass
+        return snapshot
+
+    def poll(self):
+        """
+        Poll the input folder once and dispatch files whose writes have finished
+
+        Returns:
+            list: Names of the files dispatched in this poll
+        """
+        now = time.time()
+        dispatched = []
+
+        for name, signature in self.scan().items():
+            with self._lock:
+                if name in self._in_flight:
+                    continue
+
+            mtime, size = signature
+            output_path = self.processor.get_output_path(self.output_dir, name)
+            if not self.manifest.needs_processing(name, mtime, size, self.params_hash,
+                                                  output_path):
+                self._pending.pop(name, None)
+                continue
+            if self.failed_unchanged(name, mtime, size):
+                self._pending.pop(name, None)
+                continue
+
+            # Restart the settle timer whenever the file is still changing
+            previous = self._pending.get(name)
+            if previous is None or previous[0] != signature:
+                self._pending[name] = (signature, now)
+                if now - mtime < self.settle_time:
+                    continue
+            elif now - previous[1] < self.settle_time:
+                continue
+
+            del self._pending[name]
+            self.dispatch(name)
+            dispatched.append(name)
+
+        return dispatched
+
+    def failed_unchanged(self, name, mtime, size):
+        """Whether the last attempt at this version of a file failed"""
+        entry = self.manifest.get(name)
+        return (entry is not None and entry.get('status') == 'failed'
+                and entry.get('mtime') == mtime and entry.get('size') == size
+                and entry.get('params_hash') == self.params_hash)
+
+    def dispatch(self, name):
+        """Submit a settled file to the worker pool"""
+        with self._lock:
+            self._in_flight.add(name)
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        self._executor.submit(self._process, name)
+
+    def _process(self, name):
+        try:
+            outcome = self.processor.process_entry(
+                self.manifest, self.input_dir, self.output_dir, name, self.params_hash,
+                dedup_index=self.dedup_index
+            )
+            if self.progress_callback:
+                self.progress_callback(name, outcome)
+        finally:
+            with self._lock:
+                self._in_flight.discard(name)
+
+    def run(self, timeout=None):
+        """
+        Watch the folder until stop() is called or the timeout expires
+
+        Args:
+            timeout (float): Seconds to watch for, forever if None
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        try:
+            while not self.stop_event.is_set():
+                if deadline is not None and time.time() >= deadline:
+                    break
+                self.poll()
+                self.stop_event.wait(self.poll_interval)
+        finally:
+            self.shutdown()
+
+    def stop(self):
+        """Ask the watch loop to exit"""
+        self.stop_event.set()
+
+    def shutdown(self):
+        """Wait for in-flight files and compact the manifest"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        self.processor.writer.shutdown()
+        self.manifest.compact()
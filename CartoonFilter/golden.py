@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+"""
+Golden-output regression check
+
+Renders the sample images in images/ with every preset (and the default
+preset with every quantization method) in deterministic mode and compares
+hashes of the results with golden.json. Run with --update after an
+intended change to the output.
+"""
+import os
+import sys
+import json
+import hashlib
+import argparse
+import cv2
+from cartoon_filter import CartoonFilter, use_deterministic_threads
+from filter_params import PARAM_CHOICES
+from preset_loader import PresetLoader, atomic_write_json
+from batch_processor import IMAGE_EXTENSIONS
+from fanout import render_variants
+from auto_tune import make_proxy
+import utils
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+GOLDEN_FILE = os.path.join(BASE_DIR, "golden.json")
+SAMPLE_DIR = os.path.join(BASE_DIR, "images")
+GOLDEN_SEED = 0
+# Samples are downscaled to this longest side to keep the check quick
+GOLDEN_MAX_SIDE = 320
+
+def list_samples(sample_dir=SAMPLE_DIR):
+    """
+    List the sample images, leaving out renders stored next to them
+
+    Renders of a sample are named <sample>_<style>, e.g. shapes_comic.jpg.
+    """
+    files = sorted(name for name in os.listdir(sample_dir)
+                   if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS)
+    stems = {os.path.splitext(name)[0] for name in files}
+    samples = []
+    for name in files:
+        stem = os.path.splitext(name)[0]
+        source = stem.rsplit("_", 1)[0]
+        if source == stem or source not in stems:
+            samples.append(name)
+    return samples
+
+def golden_variants(preset_loader, seed=GOLDEN_SEED):
+    """Parameter sets covered by the golden outputs"""
+    base = CartoonFilter().get_params().replace(seed=seed)
+    variants = {name: preset_loader.get_params(name, base=base).replace(seed=seed)
+                for name in preset_loader.get_preset_names()}
+    default = variants.get("default", base)
+    for method in PARAM_CHOICES["quantization_method"]:
+        variants[f"default:{method}"] = default.replace(quantization_method=method)
+    return variants
+
+def hash_image(img):
+    """Hash of an image's shape and pixels"""
+    digest = hashlib.sha1(repr(img.shape).encode())
+    digest.update(img.tobytes())
+    return digest.hexdigest()
+
+def compute_hashes(sample_dir=SAMPLE_DIR, seed=GOLDEN_SEED, max_side=GOLDEN_MAX_SIDE):
+    """
+    Render every sample with every golden variant
+
+    Args:
+        sample_dir (str): Folder with the sample images
+        seed (int): Quantization seed
+        max_side (int): Longest side the samples are downscaled to, 0 for full size
+
+    Returns:
+        dict: "<image>:<variant>" to output hash
+    """
+    use_deterministic_threads()
+    cartoon_filter = CartoonFilter()
+    variants = golden_variants(PresetLoader(), seed)
+
+    hashes = {}
+    for name in list_samples(sample_dir):
+        img = utils.load_image(os.path.join(sample_dir, name))
+        if img is None:
+            print(f"Error: could not load {name}")
+            continue
+        if max_side:
+            img = make_proxy(img, max_side)
+        results = render_variants(cartoon_filter, img, variants, max_workers=1)
+        for variant, result in results.items():
+            hashes[f"{name}:{variant}"] = hash_image(result['cartoon'])
+        print(f"Rendered {name}")
+    return hashes
+
+def main(argv=None):
+    """Command line entry point"""
+    parser = argparse.ArgumentParser(description="Check renders of the sample images against golden hashes")
+    parser.add_argument("--update", action="store_true",
+                        help="Store the current outputs as the new golden hashes")
+    parser.add_argument("--golden", default=GOLDEN_FILE, help="Golden hash file")
+    parser.add_argument("--max-side", type=int, default=None,
+                        help=f"Downscale samples to this longest side, 0 for full size "
+                             f"(default: as stored, or {GOLDEN_MAX_SIDE})")
+    args = parser.parse_args(argv)
+
+    golden = {}
+    if not args.update:
+        try:
+            with open(args.golden, 'r') as f:
+                golden = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Error: could not read {args.golden}: {e}")
+            return 1
+
+    max_side = args.max_side
+    if max_side is None:
+        max_side = golden.get("max_side", GOLDEN_MAX_SIDE)
+    hashes = compute_hashes(max_side=max_side)
+
+    if args.update:
+        atomic_write_json(args.golden, {
+            "opencv": cv2.__version__,
+            "seed": GOLDEN_SEED,
+            "max_side": max_side,
+            "outputs": hashes,
+        })
+        print(f"Stored {len(hashes)} golden outputs in {args.golden}")
+        return 0
+
+    if golden.get("opencv") != cv2.__version__:
+        print(f"Warning: golden outputs were made with OpenCV {golden.get('opencv')}, "
+              f"running {cv2.__version__}")
+
+    expected = golden.get("outputs", {})
+    mismatched = sorted(k for k in expected if k in hashes and hashes[k] != expected[k])
+    missing = sorted(set(expected) - set(hashes))
+    new = sorted(set(hashes) - set(expected))
+
+    for key in mismatched:
+        print(f"CHANGED: {key}")
+    for key in missing:
+        print(f"MISSING: {key}")
+    for key in new:
+        print(f"NEW: {key}")
+
+    print(f"{len(expected) - len(mismatched) - len(missing)}/{len(expected)} outputs match")
+    return 1 if mismatched or missing else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,258 @@
+import io
+import os
+import zlib
+import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import numpy as np
+from PIL import Image
+
+OUTPUT_FORMATS = {
+    'png': '.png',
+    'jpeg': '.jpg',
+    'webp': '.webp',
+}
+
+
+def to_indexed_image(img):
+    """
+    Convert a BGR image to a palette ("P" mode) PIL image
+
+    Cartoon output only contains the quantized colors plus black edges, so
+    when the image has at most 256 distinct colors the palette is exact.
+    Otherwise PIL's adaptive quantizer picks 256 colors.
+
+    Args:
+        img (numpy.ndarray): BGR image
+
+    Returns:
+        PIL.Image: Image in "P" mode
+    """
+    rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+    packed = ((rgb[:, :, 0].astype(np.uint32) << 16)
+              | (rgb[:, :, 1].astype(np.uint32) << 8)
+              | rgb[:, :, 2])
+    colors, indices = np.unique(packed.ravel(), return_inverse=True)
+
+    if len(colors) > 256:
+        return Image.fromarray(rgb).quantize(colors=256)
+
+    palette = np.stack([(colors >> 16) & 255, (colors >> 8) & 255, colors & 255], axis=1)
+    indexed = Image.fromarray(indices.reshape(packed.shape).astype(np.uint8), mode="P")
+    indexed.putpalette(palette.astype(np.uint8).ravel().tolist())
+    return indexed
+
+
+class ImageWriter:
+    """
+    Output stage that encodes and writes images on its own thread pool.
+
+    Supports PNG, JPEG and WebP with quality and compression settings, plus
+    indexed-palette PNG for quantized output. Files are written to a
+    temporary name and renamed, so readers never see a partial file. At most
+    `max_pending` images wait for encoding, which bounds memory when the
+    compute stage is faster than the disk.
+    """
+
+    def __init__(self, output_format="png", quality=90, png_compression=1, indexed=False,
+                 max_workers=2, max_pending=8):
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError(f"Unsupported output format: {output_format}")
+
+        self.output_format = output_format
+        self.quality = quality
+        self.png_compression = png_compression
+        self.indexed = indexed and output_format == "png"
+        self.max_workers = max(1, max_workers)
+
+        self._slots = threading.BoundedSemaphore(max(1, max_pending))
+        self._executor = None
+        self._lock = threading.Lock()
+        self._pending = 0
+
+    @property
+    def pending(self):
+        """Number of submitted images that have not been written yet"""
+        return self._pending
+
+    @property
+    def extension(self):
+        """File extension of the output format"""
+        return OUTPUT_FORMATS[self.output_format]
+
+    def encode(self, img):
+        """
+        Encode an image in the configured format
+
+        Returns:
+            bytes: Encoded file contents
+        """
+        if self.indexed:
+            buffer = io.BytesIO()
+            to_indexed_image(img).save(buffer, format="PNG",
+                                       compress_level=self.png_compression)
+            return buffer.getvalue()
+
+        if self.output_format == "jpeg":
+            params = [cv2.IMWRITE_JPEG_QUALITY, int(self.quality)]
+        elif self.output_format == "webp":
+            params = [cv2.IMWRITE_WEBP_QUALITY, int(self.quality)]
+        else:
+            params = [cv2.IMWRITE_PNG_COMPRESSION, int(self.png_compression)]
+
+        ok, encoded = cv2.imencode(self.extension, img, params)
+        if not ok:
+            raise IOError(f"Could not encode image as {self.output_format}")
+        return encoded.tobytes()
+
+    def write(self, img, path):
+        """
+        Encode and write an image synchronously
+
+        Returns:
+            str: Path of the written file
+        """
+        data = self.encode(img)
+
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+
+        tmp_path = path + ".part"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        return path
+
+    def submit(self, img, path):
+        """
+        Queue an image for encoding on the writer pool
+
+        Blocks while `max_pending` images are already queued.
+
+        Returns:
+            concurrent.futures.Future: Resolves to the written path
+        """
+        self._slots.acquire()
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+            executor = self._executor
+
+        with self._lock:
+            self._pending += 1
+        try:
+            future = executor.submit(self.write, img, path)
+        except Exception:
+            self._written()
+            raise
+        future.add_done_callback(lambda _: self._written())
+        return future
+
+    def _written(self):
+        with self._lock:
+            self._pending -= 1
+        self._slots.release()
+
+    def shutdown(self):
+        """Wait for queued writes and stop the pool"""
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+
+class PNGStreamWriter:
+    """
+    Write an RGB PNG a band of rows at a time
+
+    Rows are filtered, deflated and written as IDAT chunks as they arrive,
+    so images far larger than memory (such as contact sheets with thousands
+    of thumbnails) can be written while holding only one band of rows. The
+    file is written next to its final path and renamed into place when all
+    rows have been written. Use as a context manager, or call close().
+    """
+
+    # Compressed bytes per IDAT chunk
+    CHUNK_BYTES = 1 << 18
+
+    def __init__(self, path, width, height, compression=6):
+        self.path = path
+        self.width = width
+        self.height = height
+        self.rows_written = 0
+        self._compressor = zlib.compressobj(compression)
+        self._pending = []
+        self._pending_bytes = 0
+
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        self._tmp_path = path + ".part"
+        self._file = open(self._tmp_path, 'wb')
+        self._file.write(b"\x89PNG\r\n\x1a\n")
+        # 8 bits per channel, RGB, default compression and filtering, no interlace
+        self._write_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+
+    def write_rows(self, rows):
+        """
+        Append rows to the image
+
+        Args:
+            rows (numpy.ndarray): BGR rows of shape (n, width, 3)
+        """
+        if rows.shape[1:] != (self.width, 3):
+            raise ValueError(f"Expected rows of shape (n, {self.width}, 3), got {rows.shape}")
+        if self.rows_written + len(rows) > self.height:
+            raise ValueError(f"More than {self.height} rows written")
+
+        rgb = np.ascontiguousarray(rows[:, :, ::-1]).reshape(len(rows), -1)
+        # Sub filter: every byte minus the same channel of the pixel to its left
+        filtered = np.empty((len(rows), rgb.shape[1] + 1), np.uint8)
+        filtered[:, 0] = 1
+        filtered[:, 1:4] = rgb[:, :3]
+        np.subtract(rgb[:, 3:], rgb[:, :-3], out=filtered[:, 4:])
+
+        self._buffer(self._compressor.compress(filtered.tobytes()))
+        self.rows_written += len(rows)
+
+    def close(self):
+        """Finish the file and move it into place"""
+        if self.rows_written != self.height:
+            self.abort()
+            raise ValueError(f"Only {self.rows_written} of {self.height} rows were written")
+        self._buffer(self._compressor.flush(), force=True)
+        self._write_chunk(b"IEND", b"")
+        self._file.close()
+        os.replace(self._tmp_path, self.path)
+
+    def abort(self):
+        """Discard the partially written file"""
+        self._file.close()
+        if os.path.exists(self._tmp_path):
+            os.remove(self._tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def _buffer(self, data, force=False):
+        if data:
+            self._pending.append(data)
+            self._pending_bytes += len(data)
+        if self._pending_bytes >= self.CHUNK_BYTES or (force and self._pending):
+            self._write_chunk(b"IDAT", b"".join(self._pending))
+            self._pending = []
+            self._pending_bytes = 0
+
+    def _write_chunk(self, chunk_type, data):
+        self._file.write(struct.pack(">I", len(data)))
+        self._file.write(chunk_type)
+        self._file.write(data)
+        self._file.write(struct.pack(">I", zlib.crc32(chunk_type + data) & 0xFFFFFFFF))
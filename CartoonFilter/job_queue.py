@@ -0,0 +1,609 @@
+#!/usr/bin/env python3
+"""
+Sharded batch processing over a shared job queue
+
+An input tree is partitioned into work units that are put on a queue.
+Any number of headless workers, on one machine or many machines sharing
+the input and output storage, claim units with a time-limited lease,
+process them with the batch engine and mark them done. A unit whose
+worker dies is handed out again when its lease expires.
+
+Outputs are written atomically and every unit keeps its own manifest in
+the output folder, so processing a unit twice only redoes the files that
+are not finished yet. Submitting checks every manifest in the output
+folder and only queues files that are new, changed or not finished, so
+resubmitting a tree never re-renders files just because the unit
+boundaries moved.
+
+    python job_queue.py submit -i input -o output --queue jobs.db
+    python job_queue.py work --queue jobs.db
+    python job_queue.py status --queue jobs.db
+"""
+import os
+import sys
+import glob
+import json
+import time
+import uuid
+import socket
+import sqlite3
+import hashlib
+import argparse
+import threading
+from batch_processor import (BatchManifest, BatchProcessor, MANIFEST_NAME, scan_images,
+                             compute_params_hash)
+from cartoon_filter import CartoonFilter, DETERMINISTIC_THREADS
+from filter_params import FilterParams
+from image_writer import ImageWriter, OUTPUT_FORMATS
+from preset_loader import PresetLoader, atomic_write_json
+from runtime import calibrate, configure_runtime, split_threads
+
+DEFAULT_UNIT_SIZE = 32
+DEFAULT_LEASE_SECONDS = 300
+DEFAULT_MAX_ATTEMPTS = 3
+
+def partition(files, unit_size=DEFAULT_UNIT_SIZE):
+    """Split a sorted file list into consecutive work units"""
+    unit_size = max(1, unit_size)
+    return [files[i:i + unit_size] for i in range(0, len(files), unit_size)]
+
+def unit_id(payload):
+    """Stable id of a work unit, the same whenever the same work is submitted"""
+    encoded = json.dumps(payload, sort_keys=True).encode("utf-8")
+    return hashlib.sha1(encoded).hexdigest()[:16]
+
+def default_worker_id():
+    """Worker id made of the host name and the process id"""
+    return f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+
+class Job:
+    """
+    A claimed work unit
+
+    `token` is backend specific state identifying the current lease.
+    """
+    def __init__(self, job_id, payload, worker_id, attempts, token=None):
+        self.id = job_id
+        self.payload = payload
+        self.worker_id = worker_id
+        self.attempts = attempts
+        self.token = token
+
+class JobQueue:
+    """
+    Interface of a job queue backend
+
+    Every method must be safe to call from several processes and machines
+    at once. Methods taking a Job return False if the lease was lost, i.e.
+    it expired and the unit was handed to another worker.
+    """
+    def put(self, job_id, payload):
+        """Add a job, returns False if a job with this id already exists"""
+        raise NotImplementedError
+
+    def claim(self, worker_id, lease_seconds=DEFAULT_LEASE_SECONDS):
+        """Lease the next available job, returns a Job or None"""
+        raise NotImplementedError
+
+    def renew(self, job, lease_seconds=DEFAULT_LEASE_SECONDS):
+        """Extend the lease of a claimed job"""
+        raise NotImplementedError
+
+    def complete(self, job, result=None):
+        """Mark a claimed job as done"""
+        raise NotImplementedError
+
+    def fail(self, job, error):
+        """Give a claimed job back for a retry, or fail it after max_attempts"""
+        raise NotImplementedError
+
+    def counts(self):
+        """Number of jobs per state: pending, claimed, done, failed"""
+        raise NotImplementedError
+
+class SQLiteJobQueue(JobQueue):
+    """
+    Job queue in a SQLite database
+
+    Claims run in an IMMEDIATE transaction, so only one worker can take a
+    given job. SQLite locking needs a local disk or a network file system
+    with working POSIX locks; use FileJobQueue on other shared storage.
+    """
+    def __init__(self, path, max_attempts=DEFAULT_MAX_ATTEMPTS):
+        self.path = path
+        self.max_attempts = max_attempts
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                " id TEXT PRIMARY KEY,"
+                " payload TEXT NOT NULL,"
+                " state TEXT NOT NULL DEFAULT 'pending',"
+                " owner TEXT,"
+                " lease_until REAL,"
+                " attempts INTEGER NOT NULL DEFAULT 0,"
+                " result TEXT,"
+                " created REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, created)")
+
+    def _connect(self):
+        # One connection per thread, SQLite connections are not thread safe
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return _Transaction(conn)
+
+    def put(self, job_id, payload):
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO jobs (id, payload, created) VALUES (?, ?, ?)",
+                (job_id, json.dumps(payload), time.time())
+            )
+            return cursor.rowcount == 1
+
+    def claim(self, worker_id, lease_seconds=DEFAULT_LEASE_SECONDS):
+        now = time.time()
+        with self._connect() as conn:
+            # Expired leases go back to pending, or to failed once out of attempts
+            conn.execute(
+                "UPDATE jobs SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END,"
+                " owner = NULL, result = CASE WHEN attempts >= ? THEN ? ELSE result END"
+                " WHERE state = 'claimed' AND lease_until < ?",
+                (self.max_attempts, self.max_attempts, json.dumps({'error': "lease expired"}), now)
+            )
+            row = conn.execute(
+                "SELECT id, payload, attempts FROM jobs WHERE state = 'pending'"
+                " ORDER BY created, id LIMIT 1"
+            ).fetchone()
+            if row is None:
+                return None
+            job_id, payload, attempts = row
+            conn.execute(
+                "UPDATE jobs SET state = 'claimed', owner = ?, lease_until = ?, attempts = ?"
+                " WHERE id = ?",
+                (worker_id, now + lease_seconds, attempts + 1, job_id)
+            )
+        return Job(job_id, json.loads(payload), worker_id, attempts + 1)
+
+    def _update_owned(self, job, sql, args):
+        with self._connect() as conn:
+            cursor = conn.execute(
+                sql + " WHERE id = ? AND state = 'claimed' AND owner = ?",
+                tuple(args) + (job.id, job.worker_id)
+            )
+            return cursor.rowcount == 1
+
+    def renew(self, job, lease_seconds=DEFAULT_LEASE_SECONDS):
+        return self._update_owned(job, "UPDATE jobs SET lease_until = ?",
+                                  (time.time() + lease_seconds,))
+
+    def complete(self, job, result=None):
+        return self._update_owned(job, "UPDATE jobs SET state = 'done', owner = NULL, result = ?",
+                                  (json.dumps(result),))
+
+    def fail(self, job, error):
+        state = 'failed' if job.attempts >= self.max_attempts else 'pending'
+        return self._update_owned(job, "UPDATE jobs SET state = ?, owner = NULL, result = ?",
+                                  (state, json.dumps({'error': str(error)})))
+
+    def counts(self):
+        counts = {'pending': 0, 'claimed': 0, 'done': 0, 'failed': 0}
+        with self._connect() as conn:
+            for state, count in conn.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state"):
+                counts[state] = count
+        return counts
+
+class _Transaction:
+    """Run a block in an IMMEDIATE transaction on an autocommit connection"""
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute("BEGIN IMMEDIATE")
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        self.conn.execute("COMMIT" if exc_type is None else "ROLLBACK")
+        return False
+
+class FileJobQueue(JobQueue):
+    """
+    Job queue kept as files in a folder on shared storage
+
+    Every job is a JSON file that moves between the pending, claimed, done
+    and failed subfolders with atomic renames, so exactly one worker wins
+    each claim without any locking. The lease lives in the file name
+    (<id>~<attempts>~<worker>~<expiry ms>.json); renewing renames the file
+    and fails if another worker took the job over in the meantime.
+    """
+    STATES = ('pending', 'claimed', 'done', 'failed')
+
+    def __init__(self, path, max_attempts=DEFAULT_MAX_ATTEMPTS):
+        self.path = path
+        self.max_attempts = max_attempts
+        for state in self.STATES:
+            os.makedirs(os.path.join(path, state), exist_ok=True)
+
+    def _dir(self, state):
+        return os.path.join(self.path, state)
+
+    def _exists(self, job_id):
+        for state in self.STATES:
+            for name in os.listdir(self._dir(state)):
+                if name.split("~", 1)[0].split(".", 1)[0] == job_id:
+                    return True
+        return False
+
+    def put(self, job_id, payload):
+        if self._exists(job_id):
+            return False
+        atomic_write_json(os.path.join(self._dir('pending'), f"{job_id}~0.json"), payload)
+        return True
+
+    def _requeue_expired(self):
+        now_ms = int(time.time() * 1000)
+        for name in os.listdir(self._dir('claimed')):
+            parts = name[:-len(".json")].split("~")
+            if len(parts) != 4 or int(parts[3]) >= now_ms:
+                continue
+            job_id, attempts = parts[0], int(parts[1])
+            if attempts >= self.max_attempts:
+                target = os.path.join(self._dir('failed'), f"{job_id}.json")
+            else:
+                target = os.path.join(self._dir('pending'), f"{job_id}~{attempts}.json")
+            try:
+                os.rename(os.path.join(self._dir('claimed'), name), target)
+            except FileNotFoundError:
+                pass  # Another worker requeued or renewed it first
+
+    def _claimed_path(self, job_id, attempts, worker_id, lease_seconds):
+        expiry_ms = int((time.time() + lease_seconds) * 1000)
+        worker = worker_id.replace("~", "-").replace(os.sep, "-")
+        return os.path.join(self._dir('claimed'), f"{job_id}~{attempts}~{worker}~{expiry_ms}.json")
+
+    def claim(self, worker_id, lease_seconds=DEFAULT_LEASE_SECONDS):
+        self._requeue_expired()
+        for name in sorted(os.listdir(self._dir('pending'))):
+            if not name.endswith(".json") or "~" not in name:
+                continue
+            job_id, attempts = name[:-len(".json")].split("~")
+            attempts = int(attempts) + 1
+            claimed = self._claimed_path(job_id, attempts, worker_id, lease_seconds)
+            try:
+                os.rename(os.path.join(self._dir('pending'), name), claimed)
+            except FileNotFoundError:
+                continue  # Another worker claimed it first
+            with open(claimed, 'r') as f:
+                payload = json.load(f)
+            return Job(job_id, payload, worker_id, attempts, token=claimed)
+        return None
+
+    def renew(self, job, lease_seconds=DEFAULT_LEASE_SECONDS):
+        renewed = self._claimed_path(job.id, job.attempts, job.worker_id, lease_seconds)
+        try:
+            os.rename(job.token, renewed)
+        except FileNotFoundError:
+            return False
+        job.token = renewed
+        return True
+
+    def _finish(self, job, state, record):
+        target = os.path.join(self._dir(state), f"{job.id}.json")
+        try:
+            os.rename(job.token, target)
+        except FileNotFoundError:
+            return False
+        atomic_write_json(target, dict(job.payload, **record))
+        return True
+
+    def complete(self, job, result=None):
+        return self._finish(job, 'done', {'result': result})
+
+    def fail(self, job, error):
+        if job.attempts >= self.max_attempts:
+            return self._finish(job, 'failed', {'error': str(error)})
+        target = os.path.join(self._dir('pending'), f"{job.id}~{job.attempts}.json")
+        try:
+            os.rename(job.token, target)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def counts(self):
+        return {state: sum(1 for name in os.listdir(self._dir(state)) if name.endswith(".json"))
+                for state in self.STATES}
+
+def open_queue(path, max_attempts=DEFAULT_MAX_ATTEMPTS):
+    """Open a SQLite queue for .db/.sqlite paths and a folder queue otherwise"""
+    if path.endswith((".db", ".sqlite", ".sqlite3")):
+        return SQLiteJobQueue(path, max_attempts)
+    return FileJobQueue(path, max_attempts)
+
+def writer_settings(writer):
+    """Settings needed to recreate an ImageWriter on another node"""
+    return {
+        'output_format': writer.output_format,
+        'quality': writer.quality,
+        'png_compression': writer.png_compression,
+        'indexed': writer.indexed,
+    }
+
+def output_manifests(output_dir):
+    """Load the folder manifest and every unit manifest of an output folder"""
+    stem = os.path.splitext(MANIFEST_NAME)[0]
+    paths = sorted(glob.glob(os.path.join(glob.escape(output_dir), stem + "*.jsonl")))
+    return [BatchManifest(path) for path in paths]
+
+def pending_files(input_dir, output_dir, files, params_hash, writer):
+    """
+    Files that no manifest of the output folder records as up to date
+
+    Returns:
+        list: (rel_path, mtime, size) of every file that needs rendering
+    """
+    processor = BatchProcessor(CartoonFilter(), writer=writer)
+    manifests = output_manifests(output_dir)
+    pending = []
+    for rel_path in files:
+        try:
+            stat = os.stat(os.path.join(input_dir, rel_path))
+        except OSError:
+            continue
+        output_path = processor.get_output_path(output_dir, rel_path)
+        if all(manifest.needs_processing(rel_path, stat.st_mtime, stat.st_size,
+                                         params_hash, output_path)
+               for manifest in manifests):
+            pending.append((rel_path, stat.st_mtime, stat.st_size))
+    return pending
+
+def submit_jobs(job_queue, input_dir, output_dir, params, writer=None,
+                unit_size=DEFAULT_UNIT_SIZE, recursive=True):
+    """
+    Partition an input tree into work units and put them on a queue
+
+    Units carry the absolute folders, the parameters and the output
+    settings, so every node renders them identically. Only files without
+    an up-to-date output are partitioned, and a unit's id covers the
+    modification time and size of its files: submitting the same work
+    again adds no duplicate units, while changed files are queued again.
+
+    Args:
+        job_queue (JobQueue): Queue to submit to
+        input_dir (str): Input folder on storage shared by all workers
+        output_dir (str): Output folder on storage shared by all workers
+        params (FilterParams): Filter parameters
+        writer (ImageWriter): Output settings, PNG defaults if None
+        unit_size (int): Images per work unit
+        recursive (bool): Include images in subfolders
+
+    Returns:
+        tuple: (units submitted, units already queued)
+    """
+    writer = writer or ImageWriter()
+    input_dir = os.path.abspath(input_dir)
+    output_dir = os.path.abspath(output_dir)
+    settings = writer_settings(writer)
+    params_hash = compute_params_hash(params, settings)
+
+    pending = pending_files(input_dir, output_dir, scan_images(input_dir, recursive=recursive),
+                            params_hash, writer)
+    added = existing = 0
+    for unit in partition(pending, unit_size):
+        files = [rel_path for rel_path, _, _ in unit]
+        payload = {
+            'input_dir': input_dir,
+            'output_dir': output_dir,
+            'files': files,
+            'params': params.as_dict(),
+            'writer': settings,
+        }
+        job_id = unit_id({'files': [list(state) for state in unit], 'output_dir': output_dir,
+                          'params_hash': params_hash})
+        payload['manifest'] = f".cartoon_manifest.{job_id}.jsonl"
+        if job_queue.put(job_id, payload):
+            added += 1
+        else:
+            existing += 1
+    return added, existing
+
+class _LeaseKeeper:
+    """Renew a job's lease in the background while it is processed"""
+    def __init__(self, job_queue, job, lease_seconds):
+        self.job_queue = job_queue
+        self.job = job
+        self.lease_seconds = lease_seconds
+        self.lost = threading.Event()
+        self._done = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._done.wait(self.lease_seconds / 3.0):
+            if not self.job_queue.renew(self.job, self.lease_seconds):
+                self.lost.set()
+                return
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._done.set()
+        self._thread.join()
+        return False
+
+def process_job(job, workers=1, io_workers=4, stop_event=None, threads=None):
+    """
+    Render one work unit with the batch engine
+
+    Args:
+        threads (int): OpenCV threads for this process, cores / workers if
+            None; seeded units always use DETERMINISTIC_THREADS
+
+    Returns:
+        dict: Batch summary of the unit
+    """
+    payload = job.payload
+    params = FilterParams.from_dict(payload['params'])
+    # Seeded units pin the thread count so every node renders them identically
+    configure_runtime(DETERMINISTIC_THREADS if params.seed is not None
+                      else threads or split_threads(workers))
+    cartoon_filter = CartoonFilter()
+    cartoon_filter.set_params(params)
+    processor = BatchProcessor(cartoon_filter, writer=ImageWriter(**payload['writer']),
+                               workers=workers, io_workers=io_workers)
+    return processor.run(payload['input_dir'], payload['output_dir'],
+                         image_files=payload['files'], stop_event=stop_event,
+                         manifest_name=payload['manifest'])
+
+def run_worker(job_queue, worker_id=None, lease_seconds=DEFAULT_LEASE_SECONDS,
+               workers=1, io_workers=4, wait=False, poll_interval=2.0,
+               stop_event=None, progress_callback=None, threads=None):
+    """
+    Claim and process work units until the queue is drained
+
+    Args:
+        job_queue (JobQueue): Queue to take units from
+        worker_id (str): Name of this worker, host and pid based if None
+        lease_seconds (float): Lease length, renewed while a unit runs
+        workers (int): Compute threads per unit
+        io_workers (int): Decoder threads per unit
+        threads (int): OpenCV threads of this process, cores / workers if None
+        wait (bool): Keep polling for new units instead of exiting when idle
+        poll_interval (float): Seconds between polls when waiting
+        stop_event (threading.Event): Set to stop after the current unit
+        progress_callback (callable): Called as (job, summary or None, error or None)
+
+    Returns:
+        dict: Number of units completed and failed by this worker
+    """
+    worker_id = worker_id or default_worker_id()
+    totals = {'completed': 0, 'failed': 0}
+
+    while stop_event is None or not stop_event.is_set():
+        job = job_queue.claim(worker_id, lease_seconds)
+        if job is None:
+            if not wait:
+                break
+            time.sleep(poll_interval)
+            continue
+
+        with _LeaseKeeper(job_queue, job, lease_seconds) as keeper:
+            try:
+                summary = process_job(job, workers, io_workers, stop_event=keeper.lost,
+                                      threads=threads)
+                error = None
+            except Exception as e:
+                summary, error = None, e
+
+        if keeper.lost.is_set():
+            # Another worker owns the unit now, it will finish the remaining files
+            error = error or RuntimeError("lease lost")
+        elif error is None:
+            job_queue.complete(job, summary)
+            totals['completed'] += 1
+        else:
+            job_queue.fail(job, error)
+            totals['failed'] += 1
+
+        if progress_callback:
+            progress_callback(job, summary, error)
+
+    return totals
+
+def main(argv=None):
+    """Command line entry point"""
+    parser = argparse.ArgumentParser(description="Distributed batch cartoonization over a job queue")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    submit = subparsers.add_parser("submit", help="Partition an input tree into work units")
+    submit.add_argument("-i", "--input", required=True, help="Input folder on shared storage")
+    submit.add_argument("-o", "--output", required=True, help="Output folder on shared storage")
+    submit.add_argument("-p", "--preset", default=None, help="Name of the preset to apply")
+    submit.add_argument("--unit-size", type=int, default=DEFAULT_UNIT_SIZE,
+                        help="Images per work unit")
+    submit.add_argument("--format", dest="output_format", choices=sorted(OUTPUT_FORMATS),
+                        default="png", help="Output format")
+    submit.add_argument("--quality", type=int, default=90, help="JPEG/WebP quality (0-100)")
+    submit.add_argument("--png-compression", type=int, default=1, help="PNG compression level (0-9)")
+    submit.add_argument("--indexed", action="store_true", help="Write palette PNGs")
+    submit.add_argument("--seed", type=int, default=None,
+                        help="Seed the color quantization for reproducible output")
+
+    work = subparsers.add_parser("work", help="Run a headless worker")
+    work.add_argument("--worker-id", default=None, help="Name of this worker")
+    work.add_argument("--lease", type=float, default=DEFAULT_LEASE_SECONDS,
+                      help="Lease length in seconds")
+    work.add_argument("--workers", type=int, default=None, help="Compute threads per unit")
+    work.add_argument("--io-workers", type=int, default=4, help="Decoder threads per unit")
+    work.add_argument("--threads", default=None,
+                      help="OpenCV threads of this worker process, or 'auto' to benchmark "
+                           "the workers/threads splits (default: cores / workers)")
+    work.add_argument("--wait", action="store_true", help="Keep waiting for new units")
+
+    subparsers.add_parser("status", help="Show the number of units per state")
+
+    for subparser in subparsers.choices.values():
+        subparser.add_argument("--queue", required=True,
+                               help="Queue: a .db/.sqlite file or a folder on shared storage")
+        subparser.add_argument("--max-attempts", type=int, default=DEFAULT_MAX_ATTEMPTS,
+                               help="Attempts before a unit is marked failed")
+
+    args = parser.parse_args(argv)
+    job_queue = open_queue(args.queue, args.max_attempts)
+
+    if args.command == "submit":
+        cartoon_filter = CartoonFilter()
+        if args.preset and not PresetLoader().apply_preset(cartoon_filter, args.preset):
+            print(f"Error: unknown preset '{args.preset}'")
+            return 1
+        try:
+            params = cartoon_filter.get_params()
+            if args.seed is not None:
+                params = params.replace(seed=args.seed)
+            writer = ImageWriter(output_format=args.output_format, quality=args.quality,
+                                 png_compression=args.png_compression, indexed=args.indexed)
+        except ValueError as e:
+            print(f"Error: {e}")
+            return 1
+        added, existing = submit_jobs(job_queue, args.input, args.output, params, writer,
+                                      unit_size=args.unit_size)
+        print(f"Submitted {added} units ({existing} already queued)")
+        return 0
+
+    if args.command == "work":
+        def on_job(job, summary, error):
+            if error is not None:
+                print(f"Unit {job.id} failed: {error}")
+            else:
+                print(f"Unit {job.id}: {summary['processed']} processed, "
+                      f"{summary['skipped']} up to date, {summary['failed']} failed")
+
+        workers, threads = args.workers, None
+        if args.threads == "auto":
+            calibration = calibrate(CartoonFilter())
+            workers = workers or calibration['workers']
+            threads = calibration['threads']
+            print(f"Calibration: {workers} workers x {threads} threads")
+        elif args.threads is not None:
+            try:
+                threads = int(args.threads)
+            except ValueError:
+                print(f"Error: --threads must be a number or 'auto', got '{args.threads}'")
+                return 1
+
+        totals = run_worker(job_queue, args.worker_id, args.lease,
+                            workers=workers or os.cpu_count() or 1,
+                            io_workers=args.io_workers, wait=args.wait,
+                            progress_callback=on_job, threads=threads)
+        print(f"Worker done: {totals['completed']} units completed, {totals['failed']} failed")
+        return 1 if totals['failed'] else 0
+
+    counts = job_queue.counts()
+    print(", ".join(f"{state}: {count}" for state, count in counts.items()))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
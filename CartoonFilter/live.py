@@ -0,0 +1,490 @@
+#!/usr/bin/env python3
+"""
+Live cartoon filter for a camera, video file or synthetic frame source
+
+Capture, filtering and display run concurrently. The capture thread hands
+frames to the filter thread through a one-frame slot, so frames that
+arrive while a filter pass is running replace each other and are counted
+as dropped instead of queueing up. The filter thread renders a reduced
+proxy of each frame and upscales it into the back half of a double
+buffer, which is swapped with the front half the display shows.
+
+    python live.py --source 0
+    python live.py --source synthetic --no-display --duration 10
+"""
+import sys
+import time
+import argparse
+import threading
+from collections import deque
+from contextlib import contextmanager
+import cv2
+import numpy as np
+from cartoon_filter import CartoonFilter
+from preset_loader import PresetLoader
+from regions import fit_palette, render_window
+import utils
+
+# Width frames are filtered at; larger frames are downscaled first
+DEFAULT_PROXY_WIDTH = 320
+
+# Frames between palette refits; in between the last palette is reused,
+# which is faster and keeps colors from flickering
+DEFAULT_PALETTE_INTERVAL = 30
+
+WINDOW_NAME = "Cartoon Filter Live"
+
+
+class SyntheticSource:
+    """
+    Frame source that draws moving shapes over a gradient
+
+    Mimics cv2.VideoCapture so the live pipeline can be run and measured
+    without a camera. Frames are delivered at the given rate.
+    """
+
+    def __init__(self, width=640, height=480, fps=30.0, frames=None):
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.frames = frames
+        self.index = 0
+        self._next_time = None
+
+        x = np.linspace(0, 255, width, dtype=np.float32)
+        y = np.linspace(0, 255, height, dtype=np.float32)[:, None]
+        self._background = np.dstack([
+            np.broadcast_to(x, (height, width)),
+            np.broadcast_to(y, (height, width)),
+            np.full((height, width), 160, np.float32),
+        ]).astype(np.uint8)
+
+    def isOpened(self):
+        return True
+
+    def read(self):
+        """
+        Wait for the next frame time and draw the frame
+
+        Returns:
+            tuple: (True, frame), or (False, None) after the last frame
+        """
+        if self.frames is not None and self.index >= self.frames:
+            return False, None
+
+        now = time.perf_counter()
+        if self._next_time is None:
+            self._next_time = now
+        elif now < self._next_time:
+            time.sleep(self._next_time - now)
+        self._next_time += 1.0 / self.fps
+
+        t = self.index / self.fps
+        frame = self._background.copy()
+        cx = int(self.width * (0.5 + 0.35 * np.cos(t)))
+        cy = int(self.height * (0.5 + 0.3 * np.sin(1.3 * t)))
+        cv2.circle(frame, (cx, cy), self.height // 6, (40, 60, 220), -1)
+        x0 = int((self.width - self.width // 4) * (0.5 + 0.5 * np.sin(0.7 * t)))
+        cv2.rectangle(frame, (x0, self.height // 8), (x0 + self.width // 4, self.height // 3),
+                      (220, 200, 40), -1)
+        self.index += 1
+        return True, frame
+
+    def release(self):
+        pass
+
+
+def open_source(spec, width=640, height=480, fps=30.0, frames=None):
+    """
+    Open a frame source
+
+    Args:
+        spec (str): "synthetic", a camera index such as "0", or a video path
+        width (int): Width of synthetic frames
+        height (int): Height of synthetic frames
+        fps (float): Frame rate of synthetic frames
+        frames (int): Number of synthetic frames, unlimited if None
+
+    Returns:
+        Source with read() and release(), or None if it could not be opened
+    """
+    if spec == "synthetic":
+        return SyntheticSource(width, height, fps, frames)
+    capture = cv2.VideoCapture(int(spec) if spec.isdigit() else spec)
+    if not capture.isOpened():
+        print(f"Error: could not open video source {spec}")
+        return None
+    return capture
+
+
+class LatestFrame:
+    """
+    One-item slot between two threads that keeps only the newest item
+
+    Putting an item while the previous one has not been taken yet replaces
+    it and counts it as dropped, so a slow consumer always gets the most
+    recent frame.
+    """
+
+    def __init__(self):
+        self.dropped = 0
+        self.closed = False
+        self._item = None
+        self._condition = threading.Condition()
+
+    def put(self, item):
+        """Store an item, replacing any item that was not taken yet"""
+        with self._condition:
+            if self._item is not None:
+                self.dropped += 1
+            self._item = item
+            self._condition.notify()
+
+    def get(self, timeout=None):
+        """
+        Take the newest item, waiting for one to arrive
+
+        Returns:
+            The item, or None once the slot is closed and empty or on timeout
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: self._item is not None or self.closed, timeout)
+            item, self._item = self._item, None
+            return item
+
+    def close(self):
+        """Wake up the consumer once the producer has finished"""
+        with self._condition:
+            self.closed = True
+            self._condition.notify_all()
+
+
+class DoubleBuffer:
+    """
+    Front and back frame buffers shared by a renderer and a display
+
+    The renderer writes into the back buffer without locking and then
+    swaps it to the front. The display reads the front buffer while
+    holding the lock, so it never sees a frame that is half written and
+    no frame is copied between the two threads.
+    """
+
+    def __init__(self):
+        self.sequence = 0
+        self._buffers = [None, None]
+        self._front = 0
+        self._info = None
+        self._condition = threading.Condition()
+
+    def back(self, shape):
+        """Back buffer with the given shape, reallocated only when it changes"""
+        index = 1 - self._front
+        if self._buffers[index] is None or self._buffers[index].shape != shape:
+            self._buffers[index] = np.empty(shape, np.uint8)
+        return self._buffers[index]
+
+    def swap(self, info=None):
+        """Make the back buffer the front buffer"""
+        with self._condition:
+            self._front = 1 - self._front
+            self._info = info
+            self.sequence += 1
+            self._condition.notify_all()
+
+    @contextmanager
+    def front(self, after=0, timeout=None):
+        """
+        Hold the front buffer once a frame newer than `after` is available
+
+        Yields:
+            tuple: (frame, sequence, info), with frame None on timeout
+        """
+        with self._condition:
+            if self._condition.wait_for(lambda: self.sequence > after, timeout):
+                yield self._buffers[self._front], self.sequence, self._info
+            else:
+                yield None, self.sequence, None
+
+
+class LiveStats:
+    """
+    Rolling frame rates and per-stage latencies
+
+    Only the last `window` samples of each series are kept, so the numbers
+    follow the current load.
+    """
+
+    def __init__(self, window=60):
+        self.window = window
+        self.counts = {}
+        self._latencies = {}
+        self._ticks = {}
+        self._lock = threading.Lock()
+
+    def record(self, stage, seconds):
+        """Add a latency sample for a stage"""
+        with self._lock:
+            self._latencies.setdefault(stage, deque(maxlen=self.window)).append(seconds)
+
+    def tick(self, counter):
+        """Count one frame passing a point of the pipeline"""
+        now = time.perf_counter()
+        with self._lock:
+            self.counts[counter] = self.counts.get(counter, 0) + 1
+            self._ticks.setdefault(counter, deque(maxlen=self.window)).append(now)
+
+    def snapshot(self):
+        """
+        Current statistics
+
+        Returns:
+            dict: 'fps' and 'latency_ms' (mean over the window) per name,
+                and the total 'counts'
+        """
+        with self._lock:
+            fps = {}
+            for name, ticks in self._ticks.items():
+                elapsed = ticks[-1] - ticks[0]
+                fps[name] = (len(ticks) - 1) / elapsed if elapsed > 0 else 0.0
+            latency = {stage: 1000.0 * sum(samples) / len(samples)
+                       for stage, samples in self._latencies.items()}
+            return {'fps': fps, 'latency_ms': latency, 'counts': dict(self.counts)}
+
+
+class LivePipeline:
+    """
+    Concurrent capture, filtering and display of a frame source
+
+    Capture and filtering run on their own threads; the display loop runs
+    on the calling thread (OpenCV windows must be driven from one thread).
+    Frames are filtered at proxy_width and upscaled back to the source size.
+    The color palette is refitted every palette_interval frames and reused
+    in between.
+
+    Parameters are snapshotted at creation; set_params swaps them for the
+    next frame, so a UI can tune the filter while it runs.
+    """
+
+    def __init__(self, cartoon_filter, source, params=None, proxy_width=DEFAULT_PROXY_WIDTH,
+                 palette_interval=DEFAULT_PALETTE_INTERVAL):
+        self.cartoon_filter = cartoon_filter
+        self.source = source
+        self.params = cartoon_filter.resolve_params(params)
+        self.proxy_width = proxy_width
+        self.palette_interval = max(1, palette_interval)
+
+        self.frames = LatestFrame()
+        self.buffers = DoubleBuffer()
+        self.stats = LiveStats()
+        self.stop_event = threading.Event()
+        self._palette = None
+        self._palette_age = 0
+        self._threads = []
+
+    def set_params(self, params):
+        """Use new parameters from the next frame on"""
+        self.params = params
+        self._palette = None
+
+    def start(self):
+        """Start the capture and filter threads"""
+        self._threads = [threading.Thread(target=self._capture, daemon=True),
+                         threading.Thread(target=self._filter, daemon=True)]
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        """Stop the threads and wait for them to exit"""
+        self.stop_event.set()
+        self.frames.close()
+        for thread in self._threads:
+            thread.join()
+
+    @property
+    def running(self):
+        """True while the filter thread may still produce frames"""
+        return any(thread.is_alive() for thread in self._threads)
+
+    def _capture(self):
+        try:
+            while not self.stop_event.is_set():
+                start = time.perf_counter()
+                ok, frame = self.source.read()
+                if not ok:
+                    break
+                captured_at = time.perf_counter()
+                self.stats.record('capture', captured_at - start)
+                self.stats.tick('captured')
+                self.frames.put((frame, captured_at))
+        finally:
+            self.frames.close()
+
+    def _filter(self):
+        while not self.stop_event.is_set():
+            item = self.frames.get()
+            if item is None:
+                break
+            frame, captured_at = item
+            self.render_frame(frame, captured_at)
+
+    def render_frame(self, frame, captured_at=None):
+        """Filter one frame into the back buffer and swap it to the front"""
+        params = self.params
+        height, width = frame.shape[:2]
+
+        start = time.perf_counter()
+        if width > self.proxy_width:
+            proxy = utils.resize_keep_aspect_ratio(frame, target_width=self.proxy_width)
+        else:
+            proxy = frame
+        scaled = time.perf_counter()
+
+        if self._palette is None or self._palette_age >= self.palette_interval:
+            self._palette = fit_palette(self.cartoon_filter, proxy, params)
+            self._palette_age = 0
+        self._palette_age += 1
+        cartoon = render_window(self.cartoon_filter, proxy, params, self._palette)['cartoon']
+        filtered = time.perf_counter()
+
+        back = self.buffers.back(frame.shape)
+        if cartoon.shape == frame.shape:
+            np.copyto(back, cartoon)
+        else:
+            cv2.resize(cartoon, (width, height), dst=back, interpolation=cv2.INTER_LINEAR)
+        self.buffers.swap(captured_at if captured_at is not None else start)
+        done = time.perf_counter()
+
+        self.stats.record('proxy', scaled - start)
+        self.stats.record('filter', filtered - scaled)
+        self.stats.record('upscale', done - filtered)
+        self.stats.tick('filtered')
+
+    def overlay(self, frame, stats):
+        """Draw frame rates and latencies onto a copy of a frame"""
+        fps = stats['fps']
+        latency = stats['latency_ms']
+        lines = [
+            f"fps {fps.get('displayed', 0):.1f} shown / {fps.get('filtered', 0):.1f} filtered"
+            f" / {fps.get('captured', 0):.1f} captured, {self.frames.dropped} dropped",
+            "ms " + " ".join(f"{stage} {latency[stage]:.1f}"
+                             for stage in ('capture', 'filter', 'upscale', 'end_to_end')
+                             if stage in latency),
+        ]
+        for i, line in enumerate(lines):
+            frame = utils.add_text_overlay(frame, line, position=(10, 20 + 20 * i),
+                                           font_scale=0.5, thickness=1)
+        return frame
+
+    def run(self, show=True, duration=None, on_frame=None, report_interval=1.0):
+        """
+        Run the pipeline, displaying frames on the calling thread
+
+        Args:
+            show (bool): Show the frames in an OpenCV window (q or Esc quits)
+            duration (float): Seconds to run for, until the source ends if None
+            on_frame (callable): Called as (frame, stats) for every displayed
+                frame; the frame is only valid during the call
+            report_interval (float): Seconds between statistics printed when
+                show is False, never if None
+
+        Returns:
+            dict: Final statistics, see LiveStats.snapshot, with 'dropped'
+        """
+        self.start()
+        deadline = None if duration is None else time.perf_counter() + duration
+        last_sequence = 0
+        last_report = time.perf_counter()
+        try:
+            while self.running or self.buffers.sequence > last_sequence:
+                if deadline is not None and time.perf_counter() >= deadline:
+                    break
+                with self.buffers.front(last_sequence, timeout=0.05) as (frame, sequence,
+                                                                        captured_at):
+                    if frame is None:
+                        continue
+                    start = time.perf_counter()
+                    last_sequence = sequence
+                    self.stats.tick('displayed')
+                    stats = self.stats.snapshot()
+                    if show:
+                        cv2.imshow(WINDOW_NAME, self.overlay(frame, stats))
+                    if on_frame is not None:
+                        on_frame(frame, stats)
+                    now = time.perf_counter()
+                self.stats.record('display', now - start)
+                self.stats.record('end_to_end', now - captured_at)
+
+                if show:
+                    if cv2.waitKey(1) & 0xFF in (ord('q'), 27):
+                        break
+                elif report_interval is not None and now - last_report >= report_interval:
+                    last_report = now
+                    print(format_stats(self.stats.snapshot(), self.frames.dropped))
+        finally:
+            self.stop()
+            self.source.release()
+            if show:
+                cv2.destroyWindow(WINDOW_NAME)
+
+        stats = self.stats.snapshot()
+        stats['dropped'] = self.frames.dropped
+        return stats
+
+
+def format_stats(stats, dropped):
+    """One-line summary of a LiveStats snapshot"""
+    fps = stats['fps']
+    latency = stats['latency_ms']
+    rates = ", ".join(f"{name} {fps[name]:.1f}" for name in ('captured', 'filtered', 'displayed')
+                      if name in fps)
+    stages = ", ".join(f"{stage} {value:.1f}" for stage, value in latency.items())
+    return f"fps: {rates}; dropped {dropped}; ms: {stages}"
+
+
+def main(argv=None):
+    """Command line entry point"""
+    parser = argparse.ArgumentParser(description="Apply the cartoon filter to live video")
+    parser.add_argument("--source", default="0",
+                        help="Camera index, video file, or 'synthetic' for generated frames")
+    parser.add_argument("-p", "--preset", default=None, help="Name of the preset to apply")
+    parser.add_argument("--proxy-width", type=int, default=DEFAULT_PROXY_WIDTH,
+                        help="Width frames are filtered at")
+    parser.add_argument("--palette-interval", type=int, default=DEFAULT_PALETTE_INTERVAL,
+                        help="Frames between color palette refits")
+    parser.add_argument("--duration", type=float, default=None,
+                        help="Seconds to run for (default: until the source ends or q is pressed)")
+    parser.add_argument("--no-display", action="store_true",
+                        help="Do not open a window; print statistics every second instead")
+    parser.add_argument("--size", default="640x480",
+                        help="Frame size of the synthetic source as WIDTHxHEIGHT")
+    parser.add_argument("--fps", type=float, default=30.0, help="Frame rate of the synthetic source")
+    args = parser.parse_args(argv)
+
+    cartoon_filter = CartoonFilter()
+    if args.preset and not PresetLoader().apply_preset(cartoon_filter, args.preset):
+        print(f"Error: unknown preset '{args.preset}'")
+        return 1
+    try:
+        width, height = (int(value) for value in args.size.lower().split("x"))
+        params = cartoon_filter.get_params()
+    except ValueError as e:
+        print(f"Error: {e}")
+        return 1
+
+    source = open_source(args.source, width, height, args.fps)
+    if source is None:
+        return 1
+
+    pipeline = LivePipeline(cartoon_filter, source, params, proxy_width=args.proxy_width,
+                            palette_interval=args.palette_interval)
+    try:
+        stats = pipeline.run(show=not args.no_display, duration=args.duration)
+    except KeyboardInterrupt:
+        pipeline.stop()
+        return 0
+    print(format_stats(stats, stats['dropped']))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,236 @@
+import threading
+from quantizers import (ASSIGN_CHUNK_PIXELS, FIT_MAX_PIXELS, KMEANS_SAMPLE_PIXELS,
+                        assign_working_bytes, kmeans_working_bytes)
+from regions import render_tiled, stage_halo, tiling_differences
+
+# Extra room for OpenCV's internal buffers, which Python cannot observe
+SAFETY_FACTOR = 1.15
+
+# Tile sides tried, largest first, when a render has to be tiled
+TILE_SIZES = (2048, 1024, 512, 256)
+
+# Temporary bytes per pixel of the edge detectors, including grayscale and blur
+_EDGE_BYTES = {"canny": 8, "sobel": 28, "sobel_fast": 12, "laplacian": 5}
+
+# Temporary bytes per pixel of the histogram quantizers (sorting and indices)
+_HISTOGRAM_BYTES = 37
+
+
+def _quantize_bytes(pixels, params):
+    method = params.quantization_method
+    if method == "kmeans":
+        return kmeans_working_bytes(params.num_colors, min(pixels, KMEANS_SAMPLE_PIXELS),
+                                    min(pixels, ASSIGN_CHUNK_PIXELS))
+    if method == "kmeans_fast":
+        return (min(pixels, FIT_MAX_PIXELS) * 16
+                + assign_working_bytes(params.num_colors, min(pixels, ASSIGN_CHUNK_PIXELS)))
+    if method in ("median_cut", "octree"):
+        return _HISTOGRAM_BYTES * pixels
+    if method == "kmeans_lab":
+        # Plus the LAB copy and its binned histogram
+        return (_HISTOGRAM_BYTES + 6) * pixels
+    return 0
+
+
+def estimate_render_bytes(shape, params):
+    """
+    Predict the peak memory of apply_cartoon_effect
+
+    The stages run one after another; each keeps its output for the result
+    and needs some temporary memory while it runs. The peak is the largest
+    sum of retained outputs and the running stage's temporaries, measured
+    against tracemalloc for every method and padded for OpenCV internals.
+    The input image itself is not included.
+
+    Args:
+        shape (tuple): Image shape
+        params (FilterParams): Parameters of the render
+
+    Returns:
+        int: Estimated peak bytes
+    """
+    pixels = shape[0] * shape[1]
+    if params.line_shape == "round" and params.line_size > 1:
+        line_bytes = 9  # Float32 distance transform and threshold
+    else:
+        line_bytes = 1
+
+    quantize_bytes = _quantize_bytes(pixels, params) / float(max(pixels, 1))
+
+    # Pyramid levels stay cached until the render ends: coarser color levels
+    # add up to a third of the image, and gray levels to 4/3 of one channel
+    color_levels = 1.0 if params.smoothing_level else 0.0
+    multi_scale = params.edge_level > 0 or params.edge_levels > 1
+    gray_levels = 4 / 3.0 if multi_scale else 0.0
+    edge_bytes = _EDGE_BYTES[params.edge_detection_method]
+    if multi_scale:
+        # Upsampled edges of a level and the merged edges
+        edge_bytes += 2
+
+    # (bytes retained before the stage, temporary bytes during the stage) per pixel
+    stages = [
+        (0, 3 + color_levels),                             # Smoothing
+        (3 + color_levels, edge_bytes + gray_levels),      # Edge detection
+        (4, line_bytes),                                   # Line thickening
+        (5, quantize_bytes),                               # Quantization
+        (8, 28),                                           # Saturation, in float32
+        (11, 4),                                           # Composite
+        (14, 0),                                           # Result
+    ]
+    pyramid_bytes = color_levels + gray_levels
+    peak = max(retained + temporary + (pyramid_bytes if index > 1 else 0)
+               for index, (retained, temporary) in enumerate(stages))
+    return int(peak * pixels * SAFETY_FACTOR)
+
+
+def estimate_tiled_bytes(shape, params, tile_size):
+    """
+    Predict the peak memory of render_tiled
+
+    Only the cartoon is kept at full size; every other intermediate exists
+    for one tile and its halo at a time, next to the palette fitted on a
+    small proxy.
+    """
+    halo = stage_halo(params)
+    window = (min(shape[0], tile_size + 2 * halo), min(shape[1], tile_size + 2 * halo))
+    palette_fit = estimate_render_bytes((1, min(shape[0] * shape[1], FIT_MAX_PIXELS)), params)
+    return int(3 * shape[0] * shape[1] + estimate_render_bytes(window, params) + palette_fit)
+
+
+class MemoryBudget:
+    """
+    Counting semaphore measured in bytes
+
+    Renders reserve their estimated peak before they start and return it
+    when they finish, so the reservations never exceed the budget.
+    """
+
+    def __init__(self, budget_bytes):
+        self.budget_bytes = int(budget_bytes)
+        self.in_use = 0
+        self.peak = 0
+        self._condition = threading.Condition()
+
+    def try_acquire(self, nbytes):
+        """Reserve memory if it is available right now"""
+        with self._condition:
+            if self.in_use + nbytes > self.budget_bytes:
+                return False
+            self._reserve(nbytes)
+            return True
+
+    def acquire(self, nbytes, timeout=None):
+        """
+        Reserve memory, waiting until enough has been released
+
+        Returns:
+            bool: False if the timeout expired first
+        """
+        if nbytes > self.budget_bytes:
+            raise MemoryError(f"{nbytes} bytes can never fit in a budget of {self.budget_bytes}")
+        with self._condition:
+            if not self._condition.wait_for(lambda: self.in_use + nbytes <= self.budget_bytes,
+                                            timeout):
+                return False
+            self._reserve(nbytes)
+            return True
+
+    def release(self, nbytes):
+        """Return a reservation"""
+        with self._condition:
+            self.in_use -= nbytes
+            self._condition.notify_all()
+
+    def _reserve(self, nbytes):
+        self.in_use += nbytes
+        self.peak = max(self.peak, self.in_use)
+
+
+class RenderScheduler:
+    """
+    Admission control for concurrent renders under a memory budget
+
+    Each render's peak memory is estimated from the image shape and the
+    parameters. A render that fits the free budget starts right away, one
+    that fits the budget but not the free part waits for other renders to
+    finish. One larger than the whole budget is switched to tiled rendering
+    with the largest tile that fits, but only when tiles match a full render
+    exactly (see regions.tiling_differences). Otherwise it reserves the
+    whole budget and renders at full size while nothing else runs, unless
+    approximate_tiles allows tiling anyway. Both cases print a warning.
+    """
+
+    def __init__(self, cartoon_filter, budget_bytes, tile_sizes=TILE_SIZES,
+                 approximate_tiles=False):
+        self.cartoon_filter = cartoon_filter
+        self.budget = MemoryBudget(budget_bytes)
+        self.tile_sizes = tile_sizes
+        self.approximate_tiles = approximate_tiles
+        self.stats = {'admitted': 0, 'queued': 0, 'tiled': 0, 'exclusive': 0}
+        self._stats_lock = threading.Lock()
+        self._warned = set()
+
+    def plan(self, shape, params):
+        """
+        Decide how to render an image
+
+        Returns:
+            tuple: ('full', bytes, None), ('tiled', bytes, tile size) or
+            ('exclusive', whole budget, None) for a full render over budget
+
+        Raises:
+            MemoryError: If not even the smallest tiles fit the budget
+        """
+        full = estimate_render_bytes(shape, params)
+        if full <= self.budget.budget_bytes:
+            return 'full', full, None
+        differences = tiling_differences(params)
+        if differences and not self.approximate_tiles:
+            self._warn(f"Rendering a {shape[1]}x{shape[0]} image at full size alone, beyond "
+                       f"the memory budget, because tiling would change the output: "
+                       f"{'; '.join(differences)}")
+            return 'exclusive', self.budget.budget_bytes, None
+        if differences:
+            self._warn(f"Tiled output differs from a full render: {'; '.join(differences)}")
+        for tile_size in self.tile_sizes:
+            tiled = estimate_tiled_bytes(shape, params, tile_size)
+            if tiled <= self.budget.budget_bytes:
+                return 'tiled', tiled, tile_size
+        raise MemoryError(f"Rendering a {shape[1]}x{shape[0]} image needs more than the "
+                          f"memory budget of {self.budget.budget_bytes} bytes")
+
+    def render(self, img, params=None):
+        """
+        Render an image once the budget allows it
+
+        Returns:
+            dict: Result of apply_cartoon_effect, or of render_tiled when tiled
+        """
+        params = self.cartoon_filter.resolve_params(params)
+        mode, nbytes, tile_size = self.plan(img.shape, params)
+
+        if self.budget.try_acquire(nbytes):
+            self._count('admitted')
+        else:
+            self._count('queued')
+            self.budget.acquire(nbytes)
+        try:
+            if mode == 'tiled':
+                self._count('tiled')
+                return render_tiled(self.cartoon_filter, img, params, tile_size)
+            if mode == 'exclusive':
+                self._count('exclusive')
+            return self.cartoon_filter.apply_cartoon_effect(img, params)
+        finally:
+            self.budget.release(nbytes)
+
+    def _warn(self, message):
+        with self._stats_lock:
+            if message in self._warned:
+                return
+            self._warned.add(message)
+        print(f"Warning: {message}")
+
+    def _count(self, name):
+        with self._stats_lock:
+            self.stats[name] += 1
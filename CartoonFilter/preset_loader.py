@@ -1,111 +1,365 @@
 import os
 import json
+import tempfile
+import threading
 from cartoon_filter import CartoonFilter
+from filter_params import FilterParams
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    try:
+        import msvcrt
+    except ImportError:
+        msvcrt = None
+
+DEFAULT_PRESETS = {
+    "default": {
+        "edge_detection_method": "canny",
+        "edge_normalization": "minmax",
+        "canny_threshold1": 100,
+        "canny_threshold2": 200,
+        "edge_blur": 5,
+        "line_size": 7,
+        "line_shape": "square",
+        "edge_preserve": True,
+        "bilateral_d": 9,
+        "bilateral_sigma_color": 75,
+        "bilateral_sigma_space": 75,
+        "quantization_method": "kmeans",
+        "num_colors": 8,
+        "saturation_factor": 1.5
+    }
+}
+
+class FileLock:
+    """
+    Advisory inter-process lock held on a sidecar ".lock" file
+
+    Only writers lock. Files are replaced atomically, so readers always see
+    either the old or the new version and never need the lock.
+    """
+    def __init__(self, path):
+        self.lock_path = path + ".lock"
+        self._file = None
+
+    def __enter__(self):
+        directory = os.path.dirname(self.lock_path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        self._file = open(self.lock_path, 'a+')
+        if fcntl is not None:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+        elif msvcrt is not None:
+            self._file.seek(0)
+            msvcrt.locking(self._file.fileno(), msvcrt.LK_LOCK, 1)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if fcntl is not None:
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+            elif msvcrt is not None:
+                self._file.seek(0)
+                msvcrt.locking(self._file.fileno(), msvcrt.LK_UNLCK, 1)
+        finally:
+            self._file.close()
+            self._file = None
+        return False
+
+def atomic_write_json(path, data):
+    """Write JSON to a temporary file in the same folder and rename it into place"""
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-", suffix=".json")
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f, indent=4)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def _file_signature(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+class PresetStore:
+    """
+    Indexed, concurrency-safe view of the preset library
+
+    Presets live in presets.json and, optionally, as one JSON file per preset
+    in a presets folder. Files are only re-read when their mtime or size
+    changes, per-preset files are parsed on first use, and every write takes
+    an exclusive file lock and replaces the file atomically. One store is
+    shared by all PresetLoader instances for the same paths.
+    """
+    def __init__(self, preset_file, preset_dir=None):
+        self.preset_file = preset_file
+        self.preset_dir = preset_dir
+        self.loaded = False
+        self._lock = threading.RLock()
+        self._file_presets = {}
+        self._file_signature = None
+        self._dir_signature = None
+        self._dir_index = {}
+        self._dir_cache = {}
+
+    def refresh(self):
+        """Reload whatever changed on disk since the last access"""
+        with self._lock:
+            signature = _file_signature(self.preset_file)
+            if signature is None:
+                if self._file_signature is not None or not self._file_presets:
+                    self._file_presets = json.loads(json.dumps(DEFAULT_PRESETS))
+                    self.loaded = False
+            elif signature != self._file_signature:
+                self._load_file()
+            self._file_signature = signature
+
+            if self.preset_dir:
+                dir_signature = _file_signature(self.preset_dir)
+                if dir_signature != self._dir_signature:
+                    self._index_dir()
+                    self._dir_signature = dir_signature
+
+    def _load_file(self):
+        try:
+            with open(self.preset_file, 'r') as f:
+                data = json.load(f)
+            if 'presets' in data:
+                self._file_presets = data['presets']
+                self.loaded = True
+                return
+        except Exception as e:
+            print(f"Error loading presets: {e}")
+
+        # Fall back to the default presets if the file has an error
+        self._file_presets = json.loads(json.dumps(DEFAULT_PRESETS))
+        self.loaded = False
+
+    def _index_dir(self):
+        index = {}
+        if os.path.isdir(self.preset_dir):
+            for entry in os.scandir(self.preset_dir):
+                if entry.name.endswith(".json") and not entry.name.startswith('.'):
+                    index[entry.name[:-len(".json")]] = entry.path
+        self._dir_index = index
+        self._dir_cache = {k: v for k, v in self._dir_cache.items() if k in index}
+
+    def _load_dir_preset(self, name):
+        path = self._dir_index[name]
+        signature = _file_signature(path)
+        cached = self._dir_cache.get(name)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+        try:
+            with open(path, 'r') as f:
+                preset = json.load(f)
+        except Exception as e:
+            print(f"Error loading preset {name}: {e}")
+            return None
+        self._dir_cache[name] = (signature, preset)
+        return preset
+
+    def names(self):
+        """Names of all presets, presets.json first"""
+        with self._lock:
+            self.refresh()
+            names = list(self._file_presets)
+            names.extend(sorted(n for n in self._dir_index if n not in self._file_presets))
+            return names
+
+    def get(self, name):
+        """Get a preset, loading per-preset files on demand"""
+        with self._lock:
+            self.refresh()
+            if name in self._dir_index:
+                return self._load_dir_preset(name)
+            return self._file_presets.get(name)
+
+    def save(self, name, config, per_file=False):
+        """
+        Save a preset
+
+        Presets that already have their own file (or when per_file is set)
+        are written to the presets folder, all others to presets.json.
+        """
+        with self._lock:
+            self.refresh()
+            if self.preset_dir and (per_file or name in self._dir_index):
+                path = self._preset_path(name)
+                with FileLock(os.path.join(self.preset_dir, ".presets")):
+                    atomic_write_json(path, config)
+                self._dir_index[name] = path
+                self._dir_cache[name] = (_file_signature(path), config)
+                return
+
+            with FileLock(self.preset_file):
+                # Merge with changes other processes made since our last read
+                self._file_signature = None
+                self.refresh()
+                presets = dict(self._file_presets)
+                presets[name] = config
+                atomic_write_json(self.preset_file, {'presets': presets})
+                self._file_presets = presets
+                self._file_signature = _file_signature(self.preset_file)
+                self.loaded = True
+
+    def delete(self, name):
+        """
+        Delete a preset
+
+        Returns:
+            bool: True if the preset existed
+        """
+        with self._lock:
+            self.refresh()
+            if name in self._dir_index:
+                path = self._dir_index.pop(name)
+                self._dir_cache.pop(name, None)
+                with FileLock(os.path.join(self.preset_dir, ".presets")):
+                    if os.path.exists(path):
+                        os.remove(path)
+                return True
+
+            if name not in self._file_presets:
+                return False
+
+            with FileLock(self.preset_file):
+                self._file_signature = None
+                self.refresh()
+                presets = dict(self._file_presets)
+                presets.pop(name, None)
+                atomic_write_json(self.preset_file, {'presets': presets})
+                self._file_presets = presets
+                self._file_signature = _file_signature(self.preset_file)
+            return True
+
+    def _preset_path(self, name):
+        if not name or os.path.basename(name) != name or name.startswith('.'):
+            raise ValueError(f"Invalid preset name for a preset file: {name!r}")
+        return os.path.join(self.preset_dir, name + ".json")
+
+_STORES = {}
+_STORES_LOCK = threading.Lock()
+
+def get_preset_store(preset_file, preset_dir=None):
+    """Get the store shared by every loader using the same files"""
+    key = (os.path.abspath(preset_file), os.path.abspath(preset_dir) if preset_dir else None)
+    with _STORES_LOCK:
+        if key not in _STORES:
+            _STORES[key] = PresetStore(*key)
+        return _STORES[key]
 
 class PresetLoader:
     """
     Utility class to load and apply preset configurations
     """
-    def __init__(self):
-        self.presets = {}
-        self.preset_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "presets.json")
+    def __init__(self, preset_file=None, preset_dir=None):
+        base_dir = os.path.dirname(os.path.abspath(__file__))
+        self.preset_file = preset_file or os.path.join(base_dir, "presets.json")
+        self.preset_dir = preset_dir or os.path.join(base_dir, "presets")
+        self.store = get_preset_store(self.preset_file, self.preset_dir)
         self.load_presets()
-    
+
+    @property
+    def presets(self):
+        """All presets as a dict of name to configuration"""
+        return {name: self.store.get(name) for name in self.store.names()}
+
     def load_presets(self):
-        """Load presets from the presets.json file"""
-        try:
-            if os.path.exists(self.preset_file):
-                with open(self.preset_file, 'r') as f:
-                    data = json.load(f)
-                    if 'presets' in data:
-                        self.presets = data['presets']
-                        return True
-        except Exception as e:
-            print(f"Error loading presets: {e}")
-        
-        # Load default presets if file doesn't exist or has an error
-        self.presets = {
-            "default": {
-                "edge_detection_method": "canny",
-                "canny_threshold1": 100,
-                "canny_threshold2": 200,
-                "edge_blur": 5,
-                "line_size": 7,
-                "edge_preserve": True,
-                "bilateral_d": 9,
-                "bilateral_sigma_color": 75,
-                "bilateral_sigma_space": 75,
-                "quantization_method": "kmeans",
-                "num_colors": 8,
-                "saturation_factor": 1.5
-            }
-        }
-        return False
-    
-    def save_preset(self, name, config):
+        """Load presets, re-reading only the files that changed"""
+        self.store.refresh()
+        return self.store.loaded
+
+    def save_preset(self, name, config, per_file=False):
         """Save a new preset configuration"""
-        self.presets[name] = config
-        
         try:
-            with open(self.preset_file, 'w') as f:
-                json.dump({'presets': self.presets}, f, indent=4)
+            self.store.save(name, config, per_file=per_file)
             return True
         except Exception as e:
             print(f"Error saving preset: {e}")
             return False
-    
+
     def get_preset_names(self):
         """Get list of available preset names"""
-        return list(self.presets.keys())
-    
+        return self.store.names()
+
     def get_preset(self, name):
         """Get a specific preset configuration"""
-        if name in self.presets:
-            return self.presets[name]
-        return None
-    
+        return self.store.get(name)
+
+    def get_params(self, name, base=None):
+        """
+        Get a preset as validated FilterParams
+
+        Args:
+            name (str): Preset name
+            base (FilterParams): Values for settings the preset does not define
+
+        Returns:
+            FilterParams: Parameters, or None if the preset does not exist
+
+        Raises:
+            ValueError: If the preset contains invalid values
+        """
+        preset = self.store.get(name)
+        if preset is None:
+            return None
+        return FilterParams.from_dict(preset, base=base)
+
     def apply_preset(self, cartoon_filter, name):
         """Apply a preset configuration to a CartoonFilter instance"""
-        if name not in self.presets:
+        try:
+            params = self.get_params(name, base=cartoon_filter.get_params())
+        except ValueError as e:
+            print(f"Error applying preset {name}: {e}")
+            return False
+        if params is None:
             return False
-        
-        preset = self.presets[name]
-        
-        for key, value in preset.items():
-            if hasattr(cartoon_filter, key):
-                setattr(cartoon_filter, key, value)
-        
+
+        cartoon_filter.set_params(params)
         return True
-    
+
     def delete_preset(self, name):
         """Delete a preset configuration"""
-        if name in self.presets:
-            del self.presets[name]
-            
-            try:
-                with open(self.preset_file, 'w') as f:
-                    json.dump({'presets': self.presets}, f, indent=4)
-                return True
-            except Exception as e:
-                print(f"Error saving presets after deletion: {e}")
-        
-        return False
+        try:
+            return self.store.delete(name)
+        except Exception as e:
+            print(f"Error saving presets after deletion: {e}")
+            return False
 
 def create_preset_from_filter(cartoon_filter):
-    """Create a preset configuration from a CartoonFilter instance"""
+    """Create a preset configuration from a CartoonFilter or FilterParams instance"""
     preset = {
         "edge_detection_method": cartoon_filter.edge_detection_method,
+        "edge_normalization": cartoon_filter.edge_normalization,
         "canny_threshold1": cartoon_filter.canny_threshold1,
         "canny_threshold2": cartoon_filter.canny_threshold2,
+        "sobel_kernel_size": cartoon_filter.sobel_kernel_size,
         "edge_blur": cartoon_filter.edge_blur,
+        "edge_level": cartoon_filter.edge_level,
+        "edge_levels": cartoon_filter.edge_levels,
         "line_size": cartoon_filter.line_size,
+        "line_shape": cartoon_filter.line_shape,
         "edge_preserve": cartoon_filter.edge_preserve,
         "bilateral_d": cartoon_filter.bilateral_d,
         "bilateral_sigma_color": cartoon_filter.bilateral_sigma_color,
         "bilateral_sigma_space": cartoon_filter.bilateral_sigma_space,
+        "blur_strength": cartoon_filter.blur_strength,
+        "smoothing_level": cartoon_filter.smoothing_level,
         "quantization_method": cartoon_filter.quantization_method,
         "num_colors": cartoon_filter.num_colors,
+        "seed": cartoon_filter.seed,
         "saturation_factor": cartoon_filter.saturation_factor
     }
-    
-    return preset 
\ No newline at end of file
+
+    return preset
\ No newline at end of file
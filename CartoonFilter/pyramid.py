@@ -0,0 +1,103 @@
+import threading
+import cv2
+import numpy as np
+
+
+def upsample(img, level, shape, interpolation=cv2.INTER_LINEAR):
+    """
+    Scale an image from a pyramid level back to full resolution
+
+    The scale factor is exactly 2**level and the result is cropped to
+    shape, so every pixel maps to the same coarse position whether the
+    level came from the whole image or from an aligned window of it.
+    """
+    if level == 0:
+        return img
+    factor = 2 ** level
+    scaled = cv2.resize(img, None, fx=factor, fy=factor, interpolation=interpolation)
+    return np.ascontiguousarray(scaled[:shape[0], :shape[1]])
+
+
+class ImagePyramid:
+    """
+    Gaussian pyramid of one image, built lazily and shared between stages
+
+    Level 0 is the image itself and every further level is cv2.pyrDown of
+    the previous one, for the color image and separately for its grayscale
+    version. Levels are only computed when first asked for and then kept,
+    so smoothing, edge detection and palette proxies working on the same
+    image never downscale it twice. Building is locked, so one pyramid can
+    be shared by concurrent renders of the same image (see
+    fanout.render_variants).
+
+    Args:
+        img (numpy.ndarray): Base image (BGR)
+    """
+
+    def __init__(self, img):
+        self._levels = [img]
+        self._grays = []
+        self._lock = threading.RLock()
+
+        height, width = img.shape[:2]
+        self.shapes = [(height, width)]
+        while height * width > 1:
+            height, width = (height + 1) // 2, (width + 1) // 2
+            self.shapes.append((height, width))
+
+    @property
+    def base(self):
+        """The full-resolution image"""
+        return self._levels[0]
+
+    @property
+    def max_level(self):
+        """Index of the coarsest level"""
+        return len(self.shapes) - 1
+
+    def clamp(self, level):
+        """The requested level, or the coarsest one if the image is too small"""
+        return max(0, min(level, self.max_level))
+
+    def level(self, level):
+        """Color image at a level (clamped to the available levels)"""
+        level = self.clamp(level)
+        with self._lock:
+            while len(self._levels) <= level:
+                self._levels.append(cv2.pyrDown(self._levels[-1]))
+            return self._levels[level]
+
+    def gray(self, level):
+        """Grayscale image at a level (clamped to the available levels)"""
+        level = self.clamp(level)
+        with self._lock:
+            if not self._grays:
+                self._grays.append(cv2.cvtColor(self.base, cv2.COLOR_BGR2GRAY))
+            while len(self._grays) <= level:
+                self._grays.append(cv2.pyrDown(self._grays[-1]))
+            return self._grays[level]
+
+    def proxy(self, max_pixels, min_pixels=1):
+        """
+        Finest level with at most max_pixels pixels
+
+        Matches quantizers.pyramid_proxy: stops early rather than going
+        below min_pixels.
+        """
+        level = 0
+        while level < self.max_level:
+            height, width = self.shapes[level]
+            if height * width <= max_pixels:
+                break
+            next_height, next_width = self.shapes[level + 1]
+            if next_height * next_width < min_pixels:
+                break
+            level += 1
+        return self.level(level)
+
+    @property
+    def nbytes(self):
+        """Memory held by the levels built so far, excluding the base image"""
+        with self._lock:
+            return (sum(level.nbytes for level in self._levels[1:])
+                    + sum(gray.nbytes for gray in self._grays))
@@ -0,0 +1,397 @@
+import cv2
+import numpy as np
+
+# Pixels processed per chunk when mapping pixels to a palette
+ASSIGN_CHUNK_PIXELS = 65536
+
+# Largest proxy that palette fitting runs on
+FIT_MAX_PIXELS = 65536
+
+# Pixels sampled to choose the starting centers of streaming k-means
+KMEANS_SAMPLE_PIXELS = 8192
+
+# Low bits dropped from each LAB channel before building the k-means histogram
+LAB_HISTOGRAM_SHIFT = 2
+
+KMEANS_CRITERIA = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 100, 0.2)
+
+
+def pyramid_proxy(img, max_pixels=FIT_MAX_PIXELS, min_pixels=1):
+    """
+    Halve an image with cv2.pyrDown until it has at most max_pixels pixels
+
+    Args:
+        img (numpy.ndarray): Source image
+        max_pixels (int): Pixel budget of the proxy
+        min_pixels (int): Stop before the proxy gets smaller than this
+
+    Returns:
+        numpy.ndarray: Downsampled copy (the input itself if already small)
+    """
+    proxy = img
+    while proxy.shape[0] * proxy.shape[1] > max_pixels:
+        height, width = proxy.shape[:2]
+        if ((height + 1) // 2) * ((width + 1) // 2) < min_pixels:
+            break
+        proxy = cv2.pyrDown(proxy)
+    return proxy
+
+
+def fit_kmeans_palette(img, num_colors, attempts=10, max_pixels=FIT_MAX_PIXELS, seed=None):
+    """
+    Fit k-means color centers on a pyramid-downsampled copy of the image
+
+    Args:
+        img (numpy.ndarray): BGR image
+        num_colors (int): Number of centers
+        attempts (int): k-means restarts
+        max_pixels (int): Pixel budget of the proxy the centers are fitted on
+        seed (int): Seed of the center initialization, random if None
+
+    Returns:
+        numpy.ndarray: Palette of shape (num_colors, 3), dtype uint8
+    """
+    proxy = pyramid_proxy(img, max_pixels, min_pixels=num_colors)
+    data = np.float32(proxy.reshape((-1, 3)))
+    if seed is not None:
+        # OpenCV's RNG is per thread, so this does not affect other threads
+        cv2.setRNGSeed(seed)
+    _, _, centers = cv2.kmeans(data, num_colors, None, KMEANS_CRITERIA, attempts,
+                               cv2.KMEANS_RANDOM_CENTERS)
+    return np.uint8(centers)
+
+
+def assign_palette(img, palette, chunk_pixels=ASSIGN_CHUNK_PIXELS, out=None, labels=None):
+    """
+    Map every pixel to its nearest palette color in fixed-size chunks
+
+    Only one chunk is converted to float32 at a time and every chunk is
+    written straight into the output, so the extra memory is bounded by the
+    chunk size instead of growing with the image.
+
+    Args:
+        img (numpy.ndarray): BGR image
+        palette (numpy.ndarray): Palette of shape (k, 3), dtype uint8, k <= 256
+        chunk_pixels (int): Pixels per chunk
+        out (numpy.ndarray): Preallocated output shaped like img, allocated if None
+        labels (numpy.ndarray): Optional uint8 array with one entry per pixel
+            that receives the palette index of every pixel
+
+    Returns:
+        numpy.ndarray: Quantized image with the same shape as img
+    """
+    if out is None:
+        out = np.empty_like(img)
+    pixels = img.reshape((-1, 3))
+    result = out.reshape((-1, 3))
+    flat_labels = labels.reshape(-1) if labels is not None else None
+
+    centers = palette.astype(np.float32)
+    # |x - c|^2 = |x|^2 - 2 x.c + |c|^2, and |x|^2 does not change the argmin
+    center_norms = (centers * centers).sum(axis=1)
+
+    for start in range(0, len(pixels), chunk_pixels):
+        chunk = pixels[start:start + chunk_pixels].astype(np.float32)
+        distances = center_norms - 2.0 * chunk.dot(centers.T)
+        chunk_labels = distances.argmin(axis=1).astype(np.uint8)
+        np.take(palette, chunk_labels, axis=0, out=result[start:start + chunk_pixels])
+        if flat_labels is not None:
+            flat_labels[start:start + chunk_pixels] = chunk_labels
+
+    return out
+
+
+def assign_working_bytes(num_colors, chunk_pixels=ASSIGN_CHUNK_PIXELS):
+    """Extra bytes used by assign_palette besides its output"""
+    # float32 chunk, two float32 distance temporaries, int64 argmin and uint8 labels
+    return chunk_pixels * (3 * 4 + 2 * num_colors * 4 + 8 + 1)
+
+
+def streaming_kmeans(img, num_colors, attempts=10, max_iter=100, epsilon=0.2,
+                     sample_pixels=KMEANS_SAMPLE_PIXELS, chunk_pixels=ASSIGN_CHUNK_PIXELS,
+                     seed=None):
+    """
+    k-means over every pixel with constant extra memory
+
+    Starting centers are the best of `attempts` k-means++ runs on a random
+    sample of pixels. Lloyd iterations then stream over the full image in
+    fixed-size chunks, accumulating per-center sums and counts, so no
+    per-pixel float32 copy or label array is ever held.
+
+    Args:
+        img (numpy.ndarray): BGR image
+        num_colors (int): Number of centers
+        attempts (int): Starting-center candidates tried on the sample
+        max_iter (int): Maximum full-image iterations
+        epsilon (float): Stop when no center moves further than this
+        sample_pixels (int): Pixels sampled to choose the starting centers
+        chunk_pixels (int): Pixels per streamed chunk
+        seed (int): Seed of the sampling and initialization, random if None
+
+    Returns:
+        numpy.ndarray: Palette of shape (k, 3), dtype uint8
+    """
+    pixels = img.reshape((-1, 3))
+    rng = np.random.default_rng(seed)
+    picks = rng.choice(len(pixels), min(len(pixels), sample_pixels), replace=False)
+    sample = pixels[picks].astype(np.float32)
+    sample_weights = np.ones(len(sample))
+
+    best, best_cost = None, None
+    for _ in range(attempts):
+        centers, labels = weighted_kmeans(sample, sample_weights, num_colors,
+                                          seed=int(rng.integers(2**31)), tol=epsilon)
+        cost = float(((sample - centers[labels]) ** 2).sum())
+        if best_cost is None or cost < best_cost:
+            best, best_cost = centers, cost
+
+    centers = best
+    num_centers = len(centers)
+    for _ in range(max_iter):
+        totals = np.zeros((num_centers, 3), dtype=np.float64)
+        counts = np.zeros(num_centers, dtype=np.float64)
+        center_norms = (centers * centers).sum(axis=1)
+        for start in range(0, len(pixels), chunk_pixels):
+            chunk = pixels[start:start + chunk_pixels].astype(np.float32)
+            labels = (center_norms - 2.0 * chunk.dot(centers.T)).argmin(axis=1)
+            counts += np.bincount(labels, minlength=num_centers)
+            for channel in range(3):
+                totals[:, channel] += np.bincount(labels, weights=chunk[:, channel],
+                                                  minlength=num_centers)
+
+        updated = centers.copy()
+        filled = counts > 0
+        updated[filled] = totals[filled] / counts[filled, None]
+        shift = np.abs(updated - centers).max()
+        centers = updated
+        if shift < epsilon:
+            break
+
+    return np.uint8(centers)
+
+
+def kmeans_working_bytes(num_colors, sample_pixels=KMEANS_SAMPLE_PIXELS,
+                         chunk_pixels=ASSIGN_CHUNK_PIXELS):
+    """Extra bytes used by streaming_kmeans plus assign_palette"""
+    # float32 sample with its distance matrix and labels, then one chunk at a time
+    sample = sample_pixels * (3 * 4 + num_colors * 4 + 8)
+    return sample + assign_working_bytes(num_colors, chunk_pixels)
+
+
+def color_histogram(img):
+    """
+    Count the distinct colors of an image
+
+    Args:
+        img (numpy.ndarray): 3-channel uint8 image
+
+    Returns:
+        tuple: (colors of shape (m, 3) uint8, pixel count per color,
+            index of every pixel's color in colors)
+    """
+    pixels = img.reshape((-1, 3))
+    keys = ((pixels[:, 0].astype(np.int32) << 16)
+            | (pixels[:, 1].astype(np.int32) << 8)
+            | pixels[:, 2])
+    unique_keys, inverse, counts = np.unique(keys, return_inverse=True, return_counts=True)
+    colors = np.empty((len(unique_keys), 3), dtype=np.uint8)
+    colors[:, 0] = unique_keys >> 16
+    colors[:, 1] = (unique_keys >> 8) & 0xFF
+    colors[:, 2] = unique_keys & 0xFF
+    return colors, counts, inverse.reshape(-1)
+
+
+def histogram_working_bytes(pixels, unique_colors):
+    """Extra bytes used to build and map back a color histogram"""
+    # int32 keys and int64 inverse per pixel, colors and counts per unique color
+    return pixels * (4 + 8) + unique_colors * (3 + 8)
+
+
+def _weighted_means(colors, counts, labels, num_groups):
+    """Count-weighted mean color of every group, as uint8"""
+    totals = np.zeros((num_groups, 3), dtype=np.float64)
+    np.add.at(totals, labels, colors.astype(np.float64) * counts[:, None])
+    weights = np.bincount(labels, weights=counts, minlength=num_groups)
+    return np.uint8(np.round(totals / np.maximum(weights, 1)[:, None]))
+
+
+def median_cut_labels(colors, counts, num_colors):
+    """
+    Group histogram colors into boxes by median cut
+
+    The box with the largest spread times pixel count is split at the
+    pixel-weighted median of its widest channel until num_colors boxes
+    exist or no box can be split.
+
+    Returns:
+        tuple: (box index per color, number of boxes)
+    """
+    boxes = [np.arange(len(colors))]
+    while len(boxes) < num_colors:
+        best, best_score, best_channel = None, 0, 0
+        for i, box in enumerate(boxes):
+            if len(box) < 2:
+                continue
+            box_colors = colors[box]
+            spread = box_colors.max(axis=0).astype(np.int32) - box_colors.min(axis=0)
+            channel = int(spread.argmax())
+            score = int(spread[channel]) * int(counts[box].sum())
+            if score > best_score:
+                best, best_score, best_channel = i, score, channel
+        if best is None:
+            break
+
+        box = boxes[best]
+        box = box[np.argsort(colors[box, best_channel], kind="stable")]
+        cumulative = np.cumsum(counts[box])
+        split = int(np.searchsorted(cumulative, cumulative[-1] / 2.0))
+        split = min(max(split, 1), len(box) - 1)
+        boxes[best:best + 1] = [box[:split], box[split:]]
+
+    labels = np.empty(len(colors), dtype=np.int64)
+    for i, box in enumerate(boxes):
+        labels[box] = i
+    return labels, len(boxes)
+
+
+def octree_labels(colors, counts, num_colors):
+    """
+    Group histogram colors into octree nodes
+
+    Starting from the root, the node holding the most pixels is replaced by
+    its children (the next bit of every channel) as long as the number of
+    leaves stays within num_colors.
+
+    Returns:
+        tuple: (leaf index per color, number of leaves)
+    """
+    def child_codes(members, level):
+        shift = 7 - level
+        bits = (colors[members] >> shift) & 1
+        return (bits[:, 0] << 2) | (bits[:, 1] << 1) | bits[:, 2]
+
+    # Leaves are (pixel count, level, member colors)
+    leaves = [(int(counts.sum()), 0, np.arange(len(colors)))]
+    blocked = set()
+    while True:
+        order = sorted((i for i in range(len(leaves)) if i not in blocked),
+                       key=lambda i: -leaves[i][0])
+        if not order:
+            break
+        index = order[0]
+        _, level, members = leaves[index]
+        if level == 8 or len(members) < 2:
+            blocked.add(index)
+            continue
+        codes = child_codes(members, level)
+        children = [members[codes == code] for code in np.unique(codes)]
+        if len(leaves) - 1 + len(children) > num_colors:
+            blocked.add(index)
+            continue
+        # Indices after the split leaf shift by one, keep the blocked set valid
+        blocked = {i if i < index else i + len(children) - 1 for i in blocked}
+        leaves[index:index + 1] = [(int(counts[c].sum()), level + 1, c) for c in children]
+
+    labels = np.empty(len(colors), dtype=np.int64)
+    for i, (_, _, members) in enumerate(leaves):
+        labels[members] = i
+    return labels, len(leaves)
+
+
+def weighted_kmeans(points, weights, num_clusters, max_iter=20, seed=0, tol=0.5):
+    """
+    k-means on weighted points with k-means++ initialization
+
+    Args:
+        points (numpy.ndarray): Points of shape (m, d)
+        weights (numpy.ndarray): Weight of every point
+        num_clusters (int): Number of clusters
+        max_iter (int): Maximum Lloyd iterations
+        seed (int): Seed of the initialization
+        tol (float): Stop when no center moves further than this
+
+    Returns:
+        tuple: (centers of shape (k, d) float32, cluster index per point)
+    """
+    points = points.astype(np.float32)
+    weights = weights.astype(np.float64)
+    num_clusters = min(num_clusters, len(points))
+    rng = np.random.default_rng(seed)
+
+    centers = np.empty((num_clusters, points.shape[1]), dtype=np.float32)
+    centers[0] = points[rng.choice(len(points), p=weights / weights.sum())]
+    closest = ((points - centers[0]) ** 2).sum(axis=1)
+    for i in range(1, num_clusters):
+        probabilities = closest * weights
+        total = probabilities.sum()
+        if total <= 0:
+            centers[i:] = centers[0]
+            break
+        centers[i] = points[rng.choice(len(points), p=probabilities / total)]
+        closest = np.minimum(closest, ((points - centers[i]) ** 2).sum(axis=1))
+
+    point_norms = (points * points).sum(axis=1)
+    for _ in range(max_iter):
+        center_norms = (centers * centers).sum(axis=1)
+        distances = point_norms[:, None] - 2.0 * points.dot(centers.T) + center_norms
+        labels = distances.argmin(axis=1)
+
+        totals = np.zeros_like(centers, dtype=np.float64)
+        np.add.at(totals, labels, points * weights[:, None])
+        cluster_weights = np.bincount(labels, weights=weights, minlength=num_clusters)
+        updated = centers.copy()
+        filled = cluster_weights > 0
+        updated[filled] = totals[filled] / cluster_weights[filled, None]
+
+        shift = np.abs(updated - centers).max()
+        centers = updated
+        if shift < tol:
+            break
+
+    center_norms = (centers * centers).sum(axis=1)
+    labels = (center_norms - 2.0 * points.dot(centers.T)).argmin(axis=1)
+    return centers, labels
+
+
+def quantize_histogram(img, num_colors, method, seed=0):
+    """
+    Quantize an image by clustering its color histogram
+
+    Every distinct color is clustered once, weighted by how many pixels
+    have it, and the pixels are mapped through the histogram, so the cost
+    depends on the number of distinct colors rather than on the image size.
+
+    Args:
+        img (numpy.ndarray): BGR image
+        num_colors (int): Maximum number of palette colors
+        method (str): "median_cut", "octree" or "kmeans_lab"
+        seed (int): Seed of the k-means initialization
+
+    Returns:
+        tuple: (quantized image, estimated extra working bytes)
+    """
+    if method == "kmeans_lab":
+        # Bin LAB colors so the histogram stays small for noisy photos, and
+        # cluster the mean color of every bin
+        lab = cv2.cvtColor(img, cv2.COLOR_BGR2LAB)
+        bins, counts, inverse = color_histogram(lab >> LAB_HISTOGRAM_SHIFT)
+        lab_pixels = lab.reshape((-1, 3))
+        colors = np.stack([np.bincount(inverse, weights=lab_pixels[:, c], minlength=len(bins))
+                           for c in range(3)], axis=1) / counts[:, None]
+        centers, labels = weighted_kmeans(colors, counts, num_colors, seed=seed)
+        lab_palette = np.uint8(np.clip(np.round(centers), 0, 255)).reshape((1, -1, 3))
+        palette = cv2.cvtColor(lab_palette, cv2.COLOR_LAB2BGR).reshape((-1, 3))
+        # LAB copy of the image and a float32 distance matrix for the bins
+        extra = img.size + len(colors) * len(centers) * 4
+    else:
+        colors, counts, inverse = color_histogram(img)
+        if method == "median_cut":
+            labels, groups = median_cut_labels(colors, counts, num_colors)
+        else:
+            labels, groups = octree_labels(colors, counts, num_colors)
+        palette = _weighted_means(colors, counts, labels, groups)
+        extra = 0
+
+    result = palette[labels][inverse].reshape(img.shape)
+    pixels = img.shape[0] * img.shape[1]
+    return result, histogram_working_bytes(pixels, len(colors)) + extra
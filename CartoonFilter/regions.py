@@ -0,0 +1,276 @@
+import cv2
+import numpy as np
+from pyramid import ImagePyramid
+from quantizers import FIT_MAX_PIXELS, assign_palette
+
+# Result images that are patched, all aligned with the input image
+PATCHED_STAGES = ('filtered', 'raw_edges', 'edges', 'quantized', 'colors', 'cartoon')
+
+
+def pyramid_reach(level, upsample=True):
+    """
+    Full-resolution distance covered by moving to a pyramid level and back
+
+    Every cv2.pyrDown applies a 5x5 kernel at its input resolution, and
+    linear upsampling reads one coarse pixel further.
+    """
+    return 2 * (2 ** level - 1) + (2 ** level if upsample and level else 0)
+
+
+def level_alignment(params):
+    """
+    Pixel multiple windows must start at so their pyramid levels line up
+    with those of the full image
+    """
+    levels = [params.smoothing_level]
+    if params.edge_level or params.edge_levels > 1:
+        levels.append(params.edge_level + params.edge_levels - 1)
+    return 2 ** max(levels)
+
+
+def stage_halo(params):
+    """
+    Distance in pixels over which an input change can affect the output
+
+    Smoothing and edge detection run side by side, so the halo is the larger
+    of the two; quantization, saturation and the composite are per pixel.
+    Stages running on a pyramid level reach 2**level times as far.
+
+    Args:
+        params (FilterParams): Filter parameters
+
+    Returns:
+        int: Halo radius in pixels
+    """
+    if params.edge_preserve:
+        # Two bilateral passes
+        smoothing = 2 * (max(1, int(round(params.bilateral_d * 0.5 ** params.smoothing_level))) // 2)
+    else:
+        smoothing = max(3, int(params.blur_strength * 0.5 ** params.smoothing_level) | 1) // 2
+    smoothing = smoothing * 2 ** params.smoothing_level + pyramid_reach(params.smoothing_level)
+
+    detector = params.edge_blur // 2
+    if params.edge_detection_method == "canny":
+        # 3x3 Sobel plus non-maximum suppression
+        detector += 2
+    elif params.edge_detection_method in ("sobel", "sobel_fast"):
+        detector += params.sobel_kernel_size // 2
+    else:
+        detector += 1
+    coarsest = params.edge_level + params.edge_levels - 1
+    # Nearest-neighbour upsampling covers a whole coarse pixel
+    edges = detector * 2 ** coarsest + pyramid_reach(coarsest, upsample=False) + 2 ** coarsest
+    # Round pens can reach one pixel further than half their size
+    edges += params.line_size // 2 + 1
+
+    return max(smoothing, edges)
+
+
+def dirty_rect(shape, rect=None, mask=None):
+    """
+    Bounding rectangle of the changed area
+
+    Args:
+        shape (tuple): Image shape
+        rect (tuple): Changed rectangle as (x, y, width, height)
+        mask (numpy.ndarray): Image-sized mask, nonzero where the input changed
+
+    Returns:
+        tuple: (x, y, width, height) clipped to the image, or None if empty
+    """
+    if mask is not None:
+        rect = cv2.boundingRect(np.ascontiguousarray(mask, dtype=np.uint8))
+    if rect is None:
+        rect = (0, 0, shape[1], shape[0])
+    x, y, width, height = rect
+    x0, y0 = max(0, x), max(0, y)
+    x1, y1 = min(shape[1], x + width), min(shape[0], y + height)
+    if x1 <= x0 or y1 <= y0:
+        return None
+    return (x0, y0, x1 - x0, y1 - y0)
+
+
+def expand_rect(rect, margin, shape, align=1):
+    """
+    Grow a rectangle by margin on every side, clipped to the image
+
+    The top-left corner is moved down to a multiple of align.
+    """
+    x, y, width, height = rect
+    x0, y0 = max(0, x - margin), max(0, y - margin)
+    x0, y0 = x0 - x0 % align, y0 - y0 % align
+    x1, y1 = min(shape[1], x + width + margin), min(shape[0], y + height + margin)
+    return (x0, y0, x1 - x0, y1 - y0)
+
+
+def result_palette(result):
+    """
+    Palette of a rendered result
+
+    Derived from the quantized image the first time and stored in the
+    result as 'palette', so later region updates reuse the same colors.
+    """
+    if result.get('palette') is None:
+        result['palette'] = np.unique(result['quantized'].reshape((-1, 3)), axis=0)
+    return result['palette']
+
+
+def render_window(cartoon_filter, window, params, palette):
+    """
+    Run every stage on an image window, quantizing with a fixed palette
+
+    Args:
+        cartoon_filter (CartoonFilter): Filter used to run the stages
+        window (numpy.ndarray): Image window including its halo (BGR)
+        params (FilterParams): Filter parameters
+        palette (numpy.ndarray): Palette to map colors to, unused for
+            uniform quantization
+
+    Returns:
+        dict: Stage images of the window, keyed like PATCHED_STAGES
+    """
+    filtered = cartoon_filter.apply_bilateral_filter(window, params)
+    raw_edges = cartoon_filter.detect_raw_edges(window, params)
+    edges = cartoon_filter.thicken_edges(raw_edges, params)
+    if params.quantization_method == "uniform":
+        # Uniform quantization is per pixel and has no fitted palette
+        quantized = cartoon_filter.quantize_colors(filtered, params)
+    else:
+        quantized = assign_palette(filtered, palette)
+    colors = cartoon_filter.enhance_saturation(quantized, params)
+    cartoon = cartoon_filter.combine_edges(colors, edges)
+    return {
+        'filtered': filtered,
+        'raw_edges': raw_edges,
+        'edges': edges,
+        'quantized': quantized,
+        'colors': colors,
+        'cartoon': cartoon,
+    }
+
+
+def fit_palette(cartoon_filter, img, params, pyramid=None):
+    """
+    Fit the palette of an image on a smoothed pyramid proxy
+
+    Args:
+        pyramid (ImagePyramid): Cached pyramid of img, built if needed
+
+    Returns:
+        numpy.ndarray: Palette colors, or None for uniform quantization
+    """
+    if params.quantization_method == "uniform":
+        return None
+    pyramid = pyramid if pyramid is not None else ImagePyramid(img)
+    proxy = cartoon_filter.apply_bilateral_filter(pyramid.proxy(FIT_MAX_PIXELS), params)
+    quantized = cartoon_filter.quantize_colors(proxy, params)
+    return np.unique(quantized.reshape((-1, 3)), axis=0)
+
+
+def tiling_differences(params):
+    """
+    Steps whose tiled result differs from a full render
+
+    Tiles match a full render exactly only with uniform quantization and
+    an edge detector that is local to each pixel's neighbourhood
+    (Laplacian, or Sobel with "fixed" normalization).
+
+    Returns:
+        list: Descriptions of the differing steps, empty if tiling is exact
+    """
+    differences = []
+    if params.edge_detection_method == "canny":
+        differences.append("Canny hysteresis is evaluated per tile")
+    elif params.edge_normalization != "fixed" and params.edge_detection_method != "laplacian":
+        differences.append("minmax Sobel normalization uses the range of each tile")
+    if params.quantization_method != "uniform":
+        differences.append(f"the {params.quantization_method} palette is fitted on a "
+                           f"downscaled copy")
+    return differences
+
+
+def render_tiled(cartoon_filter, img, params=None, tile_size=512):
+    """
+    Render an image tile by tile to bound the memory of the intermediates
+
+    The palette is fitted once on a small proxy so all tiles share it, and
+    every tile is rendered with its stage halo so there are no seams. The
+    result matches a full render exactly only for the settings for which
+    tiling_differences returns nothing; otherwise edges and colors differ
+    in places. Only the final cartoon is kept at full size.
+
+    Args:
+        cartoon_filter (CartoonFilter): Filter used to run the stages
+        img (numpy.ndarray): Input image (BGR)
+        params (FilterParams): Parameters to use
+        tile_size (int): Side of the square tiles in pixels
+
+    Returns:
+        dict: 'cartoon' and 'palette'
+    """
+    params = cartoon_filter.resolve_params(params)
+    palette = fit_palette(cartoon_filter, img, params)
+    halo = stage_halo(params)
+    align = level_alignment(params)
+    height, width = img.shape[:2]
+    cartoon = np.empty_like(img)
+
+    for y in range(0, height, tile_size):
+        for x in range(0, width, tile_size):
+            tile = dirty_rect(img.shape, (x, y, tile_size, tile_size))
+            in_x, in_y, in_w, in_h = expand_rect(tile, halo, img.shape, align)
+            window = img[in_y:in_y + in_h, in_x:in_x + in_w]
+            result = render_window(cartoon_filter, window, params, palette)['cartoon']
+            dx, dy = x - in_x, y - in_y
+            cartoon[y:y + tile[3], x:x + tile[2]] = result[dy:dy + tile[3], dx:dx + tile[2]]
+
+    return {'cartoon': cartoon, 'palette': palette}
+
+
+def render_region(cartoon_filter, img, previous, rect=None, mask=None, params=None):
+    """
+    Re-render only the part of a result affected by a local input change
+
+    The changed area is grown by the stage halo twice: once for the output
+    pixels the change can affect, and once more for the input those pixels
+    depend on. Only that window is processed, and the affected pixels are
+    patched into every stage image of `previous` in place. Colors are mapped
+    to the palette of the previous result instead of refitting it, so the
+    patch blends with the rest of the image.
+
+    Global steps cannot be reproduced exactly from a window: Canny's
+    hysteresis may connect edges across the window border, and "minmax"
+    Sobel normalization uses the window's range. Use "fixed" normalization
+    for images that are edited piece by piece.
+
+    Args:
+        cartoon_filter (CartoonFilter): Filter used to run the stages
+        img (numpy.ndarray): The full, already edited input image (BGR)
+        previous (dict): Result of apply_cartoon_effect for the image before
+            the edit, with the same parameters; updated in place
+        rect (tuple): Changed rectangle as (x, y, width, height)
+        mask (numpy.ndarray): Image-sized mask of the changed pixels, used
+            instead of rect if given
+        params (FilterParams): Parameters of the previous result
+
+    Returns:
+        tuple: (x, y, width, height) of the patched area, or None if nothing changed
+    """
+    params = cartoon_filter.resolve_params(params)
+    changed = dirty_rect(img.shape, rect, mask)
+    if changed is None:
+        return None
+
+    halo = stage_halo(params)
+    out_x, out_y, out_w, out_h = expand_rect(changed, halo, img.shape)
+    in_x, in_y, in_w, in_h = expand_rect((out_x, out_y, out_w, out_h), halo, img.shape,
+                                         level_alignment(params))
+    window = img[in_y:in_y + in_h, in_x:in_x + in_w]
+
+    stages = render_window(cartoon_filter, window, params, result_palette(previous))
+    dx, dy = out_x - in_x, out_y - in_y
+    for name in PATCHED_STAGES:
+        previous[name][out_y:out_y + out_h, out_x:out_x + out_w] = \
+            stages[name][dy:dy + out_h, dx:dx + out_w]
+
+    return (out_x, out_y, out_w, out_h)
@@ -0,0 +1,283 @@
+"""
+Preview rendering in a separate process
+
+The GUI process only handles events and drawing. A render process owns its
+own CartoonFilter and the image pyramid of the loaded image, so rendering
+never competes with the Tk main loop for the GIL, and a crash in OpenCV
+only takes down the render process, which is restarted.
+
+Images never go through a pipe: the source image and two preview slots
+live in shared memory owned by the GUI process. Only small commands
+(parameters, slot numbers) and replies travel over queues. The render
+process writes each preview into the slot the GUI is not showing, and the
+GUI picks it up with a non-blocking poll from `root.after`.
+"""
+import queue
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+from cartoon_filter import CartoonFilter
+from pyramid import ImagePyramid
+from runtime import configure_runtime
+
+# Result images copied into a preview slot, with their channel counts
+PREVIEW_IMAGES = (('cartoon', 3), ('filtered', 3), ('edges', 1))
+
+# Seconds to wait for the render process to exit before terminating it
+SHUTDOWN_TIMEOUT = 5.0
+
+
+def preview_layout(height, width):
+    """
+    Where each preview image lives inside a slot
+
+    Returns:
+        tuple: (list of (key, shape, offset), total bytes of a slot)
+    """
+    layout = []
+    offset = 0
+    for key, channels in PREVIEW_IMAGES:
+        shape = (height, width, channels) if channels > 1 else (height, width)
+        layout.append((key, shape, offset))
+        offset += height * width * channels
+    return layout, offset
+
+
+def preview_views(buffer, height, width):
+    """Arrays over the preview images stored in a slot buffer"""
+    layout, _ = preview_layout(height, width)
+    return {key: np.ndarray(shape, dtype=np.uint8, buffer=buffer, offset=offset)
+            for key, shape, offset in layout}
+
+
+def only_line_settings_changed(previous, params):
+    """Check whether only line_size/line_shape differ from the previous params"""
+    if previous is None:
+        return False
+    return params.replace(line_size=previous.line_size, line_shape=previous.line_shape) == previous
+
+
+def _close_segment(segment, unlink=False):
+    if segment is None:
+        return
+    try:
+        segment.close()
+    except BufferError:
+        # Arrays over the segment are still in use; the mapping is freed
+        # when they are
+        pass
+    if unlink:
+        try:
+            segment.unlink()
+        except FileNotFoundError:
+            pass
+
+
+def _serve(commands, results, threads):
+    """Main loop of the render process"""
+    configure_runtime(threads)
+    cartoon_filter = CartoonFilter()
+    source = None
+    slots = []
+    image = pyramid = None
+    previous = None  # (params, full result) of the last render
+
+    while True:
+        command = commands.get()
+        if command is None:
+            break
+
+        if command[0] == 'image':
+            _, source_name, shape, slot_names = command
+            image = pyramid = previous = None
+            for segment in [source] + slots:
+                _close_segment(segment)
+            source = shared_memory.SharedMemory(name=source_name)
+            slots = [shared_memory.SharedMemory(name=name) for name in slot_names]
+            image = np.ndarray(shape, dtype=np.uint8, buffer=source.buf)
+            pyramid = ImagePyramid(image)
+
+        elif command[0] == 'render':
+            _, request_id, params, slot = command
+            try:
+                if previous is not None and only_line_settings_changed(previous[0], params):
+                    # Only the outlines changed, redraw them on the cached colors
+                    result = cartoon_filter.rethicken_edges(previous[1], params)
+                else:
+                    result = cartoon_filter.apply_cartoon_effect(image, params, pyramid=pyramid)
+                previous = (params, result)
+
+                views = preview_views(slots[slot].buf, *image.shape[:2])
+                for key, view in views.items():
+                    view[...] = result[key]
+                del views
+                results.put(('frame', request_id, result['quantize_stats']))
+            except Exception as e:
+                previous = None
+                results.put(('error', request_id, str(e)))
+
+    image = pyramid = previous = None
+    for segment in [source] + slots:
+        _close_segment(segment)
+
+
+class RenderProcess:
+    """
+    Client side of the preview render process
+
+    At most one render is in flight. Parameters sent while it runs replace
+    each other, and only the newest are rendered next, so dragging a slider
+    never builds up a backlog. All methods are meant to be called from one
+    thread, normally the Tk main loop.
+
+    Args:
+        threads (int): OpenCV threads of the render process, one per core
+            if None
+    """
+
+    def __init__(self, threads=None):
+        self.threads = threads
+        self._context = multiprocessing.get_context('spawn')
+        self._process = None
+        self._commands = None
+        self._results = None
+
+        self._source = None
+        self._slots = []
+        self._shape = None
+        self._front = None  # Slot holding the last preview returned by poll
+
+        self._request = 0
+        self._in_flight = None  # (request id, slot)
+        self._pending = None  # Params waiting for the render in flight
+
+    @property
+    def busy(self):
+        """Whether a render is in flight or waiting"""
+        return self._in_flight is not None or self._pending is not None
+
+    def start(self):
+        """Start (or restart) the render process"""
+        self._commands = self._context.Queue()
+        self._results = self._context.Queue()
+        self._process = self._context.Process(
+            target=_serve, args=(self._commands, self._results, self.threads), daemon=True
+        )
+        self._process.start()
+        self._in_flight = None
+        self._pending = None
+        if self._source is not None:
+            self._send_image()
+
+    def set_image(self, img):
+        """
+        Copy a new source image into shared memory
+
+        Previews returned by poll for the previous image must no longer be
+        used after this call.
+        """
+        self._release_segments()
+        height, width = img.shape[:2]
+        self._source = shared_memory.SharedMemory(create=True, size=img.nbytes)
+        np.ndarray(img.shape, dtype=np.uint8, buffer=self._source.buf)[...] = img
+        _, slot_size = preview_layout(height, width)
+        self._slots = [shared_memory.SharedMemory(create=True, size=slot_size) for _ in range(2)]
+        self._shape = img.shape
+        self._front = None
+
+        # Replies to renders of the previous image are ignored
+        self._in_flight = None
+        self._pending = None
+        self._send_image()
+
+    def render(self, params):
+        """
+        Request a preview of the current image with params
+
+        Returns:
+            bool: False if no image has been set
+        """
+        if self._source is None:
+            return False
+        if self._in_flight is not None:
+            self._pending = params
+        else:
+            self._submit(params)
+        return True
+
+    def poll(self):
+        """
+        Collect a finished preview without blocking
+
+        The arrays of a preview point into shared memory. They stay valid
+        until the next preview after it has been returned, so keep only the
+        latest one or copy the images.
+
+        Returns:
+            dict: 'cartoon', 'filtered', 'edges' and 'quantize_stats', or
+            None if no new preview is ready
+
+        Raises:
+            RuntimeError: If the render failed or the render process died;
+                a dead process is restarted
+        """
+        while True:
+            try:
+                reply = self._results.get_nowait()
+            except queue.Empty:
+                break
+            if self._in_flight is None or reply[1] != self._in_flight[0]:
+                continue  # Reply for an image that has been replaced
+
+            slot = self._in_flight[1]
+            self._in_flight = None
+            if reply[0] == 'error':
+                self._submit_pending()
+                raise RuntimeError(reply[2])
+
+            # The next render must go to the other slot
+            self._front = slot
+            self._submit_pending()
+            preview = preview_views(self._slots[slot].buf, *self._shape[:2])
+            preview['quantize_stats'] = reply[2]
+            return preview
+
+        if self._in_flight is not None and not self._process.is_alive():
+            exitcode = self._process.exitcode
+            self.start()
+            raise RuntimeError(f"Render process exited with code {exitcode} and was restarted")
+        return None
+
+    def close(self):
+        """Stop the render process and free the shared memory"""
+        if self._process is not None:
+            if self._process.is_alive():
+                self._commands.put(None)
+                self._process.join(SHUTDOWN_TIMEOUT)
+                if self._process.is_alive():
+                    self._process.terminate()
+                    self._process.join()
+            self._process = None
+        self._release_segments()
+
+    def _submit(self, params):
+        self._request += 1
+        slot = 1 if self._front == 0 else 0
+        self._in_flight = (self._request, slot)
+        self._commands.put(('render', self._request, params, slot))
+
+    def _submit_pending(self):
+        if self._pending is not None:
+            params, self._pending = self._pending, None
+            self._submit(params)
+
+    def _send_image(self):
+        self._commands.put(('image', self._source.name, self._shape,
+                            [slot.name for slot in self._slots]))
+
+    def _release_segments(self):
+        for segment in [self._source] + self._slots:
+            _close_segment(segment, unlink=True)
+        self._source = None
+        self._slots = []
+        self._shape = None
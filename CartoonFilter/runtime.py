@@ -0,0 +1,167 @@
+import os
+import time
+import threading
+import cv2
+import numpy as np
+
+def available_cpus():
+    """
+    CPUs this process may run on
+
+    Returns:
+        list: Sorted CPU ids
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+def configure_runtime(threads=None, optimized=True):
+    """
+    Configure OpenCV for this process
+
+    The thread count is a property of the whole process: cv2.setNumThreads
+    sizes the one thread pool that every OpenCV call in the process shares,
+    whichever Python thread makes the call. It cannot be set per worker
+    thread; it only caps how many threads a single call may fan out to.
+
+    Args:
+        threads (int): Size of OpenCV's thread pool, OpenCV's default (one
+            per core) if None. Use cores / workers when several workers
+            already run in parallel, so they do not oversubscribe the CPUs.
+        optimized (bool): Use OpenCV's SIMD-optimized code paths
+
+    Returns:
+        dict: Settings now in effect
+    """
+    cv2.setUseOptimized(optimized)
+    if threads is not None:
+        cv2.setNumThreads(max(1, int(threads)))
+    return {
+        'threads': cv2.getNumThreads(),
+        'optimized': cv2.useOptimized(),
+        'cpus': available_cpus(),
+    }
+
+def split_threads(workers, cpus=None):
+    """
+    OpenCV thread pool size so that workers x threads fills the CPUs
+
+    The result is applied to the whole process (see configure_runtime).
+
+    Args:
+        workers (int): Number of parallel workers
+        cpus (int): Number of CPUs, all available CPUs if None
+    """
+    cpus = cpus or len(available_cpus())
+    return max(1, cpus // max(1, workers))
+
+def core_slices(workers, threads_per_worker=None):
+    """
+    Split the available CPUs into one disjoint set per worker
+
+    Workers beyond the number of CPUs share sets round-robin.
+
+    Returns:
+        list: One list of CPU ids per worker
+    """
+    cpus = available_cpus()
+    threads_per_worker = threads_per_worker or split_threads(workers, len(cpus))
+    slices = []
+    for index in range(workers):
+        start = (index * threads_per_worker) % len(cpus)
+        slices.append([cpus[(start + i) % len(cpus)] for i in range(threads_per_worker)])
+    return slices
+
+def pin_thread(cpus):
+    """
+    Pin the calling thread (or process, in a worker process) to some CPUs
+
+    On Linux affinity is per thread, so compute threads can be pinned
+    individually. Work an OpenCV call hands to its thread pool runs on the
+    pool's threads, which are not pinned, or which inherit the affinity of
+    the thread that started the pool. Pin only when OpenCV runs with one
+    thread, so each call stays on the calling thread. Does nothing where
+    affinity is not supported.
+
+    Returns:
+        set: Previous CPU set to pass to restore_affinity, or None
+    """
+    if not cpus or not hasattr(os, "sched_setaffinity"):
+        return None
+    previous = os.sched_getaffinity(0)
+    try:
+        os.sched_setaffinity(0, cpus)
+    except OSError as e:
+        print(f"Could not pin to CPUs {cpus}: {e}")
+        return None
+    return previous
+
+def restore_affinity(previous):
+    """Undo pin_thread"""
+    if previous is not None:
+        os.sched_setaffinity(0, previous)
+
+def candidate_splits(cpus=None):
+    """
+    (workers, threads) pairs that use every CPU exactly once
+
+    Returns:
+        list: Pairs from one multi-threaded worker to one worker per CPU
+    """
+    cpus = cpus or len(available_cpus())
+    return [(cpus // threads, threads) for threads in range(cpus, 0, -1) if cpus % threads == 0]
+
+def calibrate(cartoon_filter, img=None, params=None, size=(320, 240), rounds=2, splits=None):
+    """
+    Measure throughput of each workers/threads split with a short benchmark
+
+    Every split renders `rounds` images per worker, with the workers
+    running as threads of this process and OpenCV set to the split's
+    thread count. The OpenCV thread count is left at the best split.
+
+    Only thread workers are measured, because that is what the batch
+    engine runs: OpenCV releases the GIL inside its calls, and processes
+    would need a separate process-based engine to use the result. Queue
+    workers on one node (job_queue.py work) are the way to run processes.
+
+    Args:
+        cartoon_filter (CartoonFilter): Filter to benchmark
+        img (numpy.ndarray): Benchmark image, a synthetic one if None
+        params (FilterParams): Parameters, the filter's current ones if None
+        size (tuple): Size of the synthetic image
+        rounds (int): Images rendered per worker and split
+        splits (list): (workers, threads) pairs, candidate_splits() if None
+
+    Returns:
+        dict: Best 'workers' and 'threads', and 'results' as a list of
+            (workers, threads, images per second)
+    """
+    params = cartoon_filter.resolve_params(params)
+    if img is None:
+        rng = np.random.default_rng(0)
+        img = cv2.resize(rng.integers(0, 256, (size[1] // 8, size[0] // 8, 3), dtype=np.uint8),
+                         size, interpolation=cv2.INTER_CUBIC)
+
+    # Warm up so one-time initialization does not count against the first split
+    cartoon_filter.apply_cartoon_effect(img, params)
+
+    results = []
+    for workers, threads in splits or candidate_splits():
+        cv2.setNumThreads(threads)
+
+        def work():
+            for _ in range(rounds):
+                cartoon_filter.apply_cartoon_effect(img, params)
+
+        start = time.perf_counter()
+        pool = [threading.Thread(target=work) for _ in range(workers)]
+        for thread in pool:
+            thread.start()
+        for thread in pool:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        results.append((workers, threads, workers * rounds / elapsed))
+
+    workers, threads, _ = max(results, key=lambda result: result[2])
+    cv2.setNumThreads(threads)
+    return {'workers': workers, 'threads': threads, 'results': results}
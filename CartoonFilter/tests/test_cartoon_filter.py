@@ -0,0 +1,26 @@
+import numpy as np
+import pytest
+from cartoon_filter import CartoonFilter
+
+
+def stroke_width(line_size, line_shape):
+    """Width of a thickened vertical 1-pixel line, measured across its middle"""
+    cartoon_filter = CartoonFilter()
+    params = cartoon_filter.resolve_params(None).replace(line_size=line_size,
+                                                        line_shape=line_shape)
+    edges = np.zeros((41, 41), dtype=np.uint8)
+    edges[:, 20] = 255
+    thick = cartoon_filter.thicken_edges(edges, params)
+    return int(np.count_nonzero(thick[20]))
+
+
+@pytest.mark.parametrize("line_size", [1, 2, 3, 4, 5, 8, 9])
+def test_square_pen_width(line_size):
+    assert stroke_width(line_size, "square") == line_size
+
+
+@pytest.mark.parametrize("line_size", [1, 2, 3, 4, 5, 8, 9])
+def test_round_pen_width(line_size):
+    # Round strokes are centred on the line, so even sizes draw one pixel less
+    expected = line_size if line_size % 2 else line_size - 1
+    assert stroke_width(line_size, "round") == expected
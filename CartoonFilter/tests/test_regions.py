@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+from cartoon_filter import CartoonFilter
+from preset_loader import PresetLoader
+import regions
+
+
+def sample_image(height=157, width=203):
+    """Noisy gradient with odd dimensions, so tiles do not line up with SIMD widths"""
+    rng = np.random.default_rng(7)
+    y, x = np.mgrid[0:height, 0:width]
+    img = np.dstack([x * 255 // width, y * 255 // height, (x + y) * 255 // (width + height)])
+    img = img + rng.integers(-30, 30, img.shape)
+    return np.clip(img, 0, 255).astype(np.uint8)
+
+
+@pytest.mark.parametrize("tile_size", [37, 64, 128])
+def test_render_tiled_matches_full_render(tile_size):
+    cartoon_filter = CartoonFilter()
+    params = PresetLoader().get_params("minimal")
+    assert regions.tiling_differences(params) == []
+
+    img = sample_image()
+    full = cartoon_filter.apply_cartoon_effect(img, params)['cartoon']
+    tiled = regions.render_tiled(cartoon_filter, img, params, tile_size=tile_size)['cartoon']
+    np.testing.assert_array_equal(tiled, full)
+
+
+def test_enhance_saturation_does_not_depend_on_width():
+    cartoon_filter = CartoonFilter()
+    params = cartoon_filter.resolve_params(None).replace(saturation_factor=1.7)
+    img = sample_image()
+    full = cartoon_filter.enhance_saturation(img, params)
+    strips = [cartoon_filter.enhance_saturation(img[:, x:x + 13], params)
+              for x in range(0, img.shape[1], 13)]
+    np.testing.assert_array_equal(np.concatenate(strips, axis=1), full)
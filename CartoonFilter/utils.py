@@ -1,8 +1,10 @@
 import os
+import math
+from concurrent.futures import ThreadPoolExecutor
 import cv2
 import numpy as np
-import matplotlib.pyplot as plt
 from PIL import Image
+from image_writer import PNGStreamWriter
 
 def load_image(file_path):
     """
@@ -56,6 +58,9 @@ def create_comparison_grid(images, titles=None, figsize=(12, 8)):
     Returns:
         matplotlib.figure.Figure: Figure with the comparison grid
     """
+    # Imported here so the rest of the module works without a plotting backend
+    import matplotlib.pyplot as plt
+
     n = len(images)
     if n <= 0:
         return None
@@ -247,4 +252,149 @@ def add_text_overlay(img, text, position=(20, 40), font_scale=1.0, color=(255, 2
     # Add main text
     cv2.putText(result, text, position, font, font_scale, color, thickness)
     
-    return result 
\ No newline at end of file
+    return result 
+
+def load_thumbnail(item, cell_size):
+    """
+    Load an image scaled to fit a cell
+    
+    JPEG files are decoded at a reduced scale close to the cell size, which
+    is much faster than decoding them at full resolution.
+    
+    Args:
+        item: BGR image, or the path of an image file
+        cell_size (tuple): Cell (width, height)
+        
+    Returns:
+        numpy.ndarray: Thumbnail (BGR) or None if the image could not be loaded
+    """
+    if isinstance(item, np.ndarray):
+        img = item
+    else:
+        try:
+            with Image.open(item) as pil_image:
+                pil_image.draft("RGB", cell_size)
+                img = pil_to_cv2(pil_image.convert("RGB"))
+        except Exception:
+            return None
+    return resize_keep_aspect_ratio(img, target_width=cell_size[0], target_height=cell_size[1])
+
+def contact_sheet_rows(items, titles=None, cell_size=(200, 150), cols=None, padding=4,
+                       label_height=20, background=(32, 32, 32), workers=4):
+    """
+    Render a contact sheet one row of cells at a time
+    
+    Thumbnails are centred in their cells, with the title (if any) drawn
+    underneath by add_text_overlay. Items that cannot be loaded leave an
+    empty cell. The thumbnails of each row are loaded on a thread pool.
+    
+    Args:
+        items (list): BGR images or image paths
+        titles (list): Label for each item
+        cell_size (tuple): Thumbnail (width, height)
+        cols (int): Cells per row, about a square sheet if None
+        padding (int): Space around every cell in pixels
+        label_height (int): Height of the label strip, 0 for no labels
+        background (tuple): Background color (BGR)
+        workers (int): Threads loading thumbnails
+        
+    Yields:
+        numpy.ndarray: Rows of the sheet, all of the same width
+    """
+    cols = cols or max(1, math.ceil(math.sqrt(len(items))))
+    cell_width, cell_height = cell_size
+    if not titles:
+        label_height = 0
+    pitch_x = cell_width + padding
+    pitch_y = cell_height + label_height + padding
+    row = np.empty((pitch_y, cols * pitch_x + padding, 3), np.uint8)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for start in range(0, len(items), cols):
+            row[:] = background
+            batch = items[start:start + cols]
+            thumbnails = executor.map(lambda item: load_thumbnail(item, cell_size), batch)
+            for col, thumbnail in enumerate(thumbnails):
+                x = padding + col * pitch_x
+                if thumbnail is not None:
+                    height, width = thumbnail.shape[:2]
+                    if thumbnail.ndim == 2:
+                        thumbnail = cv2.cvtColor(thumbnail, cv2.COLOR_GRAY2BGR)
+                    y0 = padding + (cell_height - height) // 2
+                    x0 = x + (cell_width - width) // 2
+                    row[y0:y0 + height, x0:x0 + width] = thumbnail
+                if label_height and start + col < len(titles):
+                    y = padding + cell_height
+                    label = row[y:y + label_height, x:x + cell_width]
+                    label[:] = add_text_overlay(label, str(titles[start + col]),
+                                                position=(2, label_height - 6),
+                                                font_scale=0.4, thickness=1)
+            yield row
+
+def create_contact_sheet(images, titles=None, cell_size=(200, 150), cols=None, padding=4,
+                         background=(32, 32, 32)):
+    """
+    Tile images into a single labelled image without matplotlib
+    
+    Args:
+        images (list): BGR images or image paths
+        titles (list): Label for each image
+        cell_size (tuple): Thumbnail (width, height)
+        cols (int): Images per row, about a square sheet if None
+        padding (int): Space around every image in pixels
+        background (tuple): Background color (BGR)
+        
+    Returns:
+        numpy.ndarray: Contact sheet (BGR) or None if there are no images
+    """
+    if not images:
+        return None
+    rows = contact_sheet_rows(images, titles, cell_size, cols, padding, background=background)
+    # Rows reuse one buffer, so copy each before stacking
+    sheet = [row.copy() for row in rows]
+    sheet.append(np.full((padding, sheet[0].shape[1], 3), background, np.uint8))
+    return np.vstack(sheet)
+
+def write_contact_sheet(images, file_path, titles=None, cell_size=(200, 150), cols=None,
+                        padding=4, background=(32, 32, 32), compression=6):
+    """
+    Write a contact sheet, streaming rows to disk
+    
+    PNG sheets are written row by row, so sheets with thousands of
+    thumbnails never exist in memory as a whole; pass image paths rather
+    than decoded images for such sheets. Other formats are built in memory
+    and saved with save_image.
+    
+    Args:
+        images (list): BGR images or image paths
+        file_path (str): Output path
+        titles (list): Label for each image
+        cell_size (tuple): Thumbnail (width, height)
+        cols (int): Images per row, about a square sheet if None
+        padding (int): Space around every image in pixels
+        background (tuple): Background color (BGR)
+        compression (int): zlib level of PNG output (0-9)
+        
+    Returns:
+        bool: True if the sheet was written
+    """
+    if not images:
+        return False
+    if not file_path.lower().endswith(".png"):
+        sheet = create_contact_sheet(images, titles, cell_size, cols, padding, background)
+        return save_image(sheet, file_path)
+
+    cols = cols or max(1, math.ceil(math.sqrt(len(images))))
+    rows = contact_sheet_rows(images, titles, cell_size, cols, padding, background=background)
+    try:
+        first = next(rows)
+        height = math.ceil(len(images) / cols) * first.shape[0] + padding
+        with PNGStreamWriter(file_path, first.shape[1], height, compression) as writer:
+            writer.write_rows(first)
+            for row in rows:
+                writer.write_rows(row)
+            writer.write_rows(np.full((padding, first.shape[1], 3), background, np.uint8))
+        return True
+    except Exception as e:
+        print(f"Error writing contact sheet {file_path}: {e}")
+        return False